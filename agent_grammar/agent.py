@@ -1,4 +1,6 @@
 import os
+import json
+import asyncio
 from dotenv import load_dotenv
 
 # Construct the path to the .env file in the parent directory
@@ -16,12 +18,168 @@ from google.adk.agents import Agent
 from google import genai
 from google.genai.types import (
     GenerateContentConfig,
+    HttpOptions,
 )
 
+from .batching import GrammarBatcher
+from .cache import GrammarCache, make_key, hash_schema
+
 MODEL_AGENT = "gemini-2.0-flash-001"
 MODEL_TOOL = "gemini-2.0-flash-001"
 
-def check_grammar(text_input: str) -> dict:
+# Timeout of a single grammar check, in seconds
+GRAMMAR_TIMEOUT_S = float(os.getenv("GRAMMAR_TIMEOUT_S", "30"))
+
+def create_client() -> genai.Client:
+    """Creates the Gemini client used by `check_grammar`."""
+    return genai.Client(vertexai=True,
+                        project=GOOGLE_CLOUD_PROJECT,
+                        location=GOOGLE_CLOUD_LOCATION,
+                        http_options=HttpOptions(timeout=int(GRAMMAR_TIMEOUT_S * 1000)))
+
+# The factory used to build the client. Offline harnesses swap in a stand-in
+# client with set_client_factory().
+_client_factory = create_client
+
+# The shared client and the event loop it was built in. Its async connections
+# belong to that loop, so a new client is built when the loop changes.
+_client = None
+_client_loop = None
+
+def set_client_factory(factory) -> object:
+    """Replaces the factory `check_grammar` uses to build its Gemini client.
+
+    Args:
+        factory: A callable with no arguments returning an object that exposes
+                 `aio.models.generate_content`, or None to restore `create_client`.
+
+    Returns:
+        The previously installed factory.
+    """
+    global _client_factory, _client, _client_loop
+    previous = _client_factory
+    _client_factory = factory or create_client
+    _client = _client_loop = None
+    return previous
+
+def get_client():
+    """Returns the client shared by all grammar checks on the running event loop.
+
+    The client is built lazily on first use, so its authentication and
+    connection pool are set up once instead of on every call.
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _client = _client_factory()
+        _client_loop = loop
+    return _client
+
+GRAMMAR_PROMPT = """
+Analyze the following text for grammar errors, correct them, and provide 
+explanations for each correction:
+
+Text: {text_input}
+
+Return the response as a JSON object with the following structure:
+{{
+  "corrected_text": "The corrected text.",
+  "explanations": [
+    "Explanation of the first error.",
+    "Explanation of the second error.",
+    ...
+  ],
+  "errors": [
+      "Description of the first error",
+      "Description of the second error",
+      ...
+  ]
+}}
+"""
+
+GRAMMAR_RESPONSE_SCHEMA = {
+  "type": "object",
+  "properties": {
+    "corrected_text": {
+      "type": "string",
+      "description": "The corrected text."
+    },
+    "explanations": {
+      "type": "array",
+      "items": {
+        "type": "string",
+        "description": "Explanation of a specific error."
+      },
+      "description": "An array of explanations for each correction."
+    },
+    "errors": {
+      "type": "array",
+      "items": {
+        "type": "string",
+        "description": "Description of a specific error."
+      },
+      "description": "An array of descriptions of each error."
+    }
+  },
+  "required": [
+    "corrected_text",
+    "explanations",
+    "errors"
+  ],
+  "description": "A JSON object containing corrected text, explanations, and error descriptions."
+}
+
+GRAMMAR_BATCH_PROMPT = """
+Analyze each of the following numbered texts for grammar errors, correct them,
+and provide explanations for each correction. Each text is a JSON string
+preceded by its number:
+
+{numbered_texts}
+
+Return the response as a JSON array with one object per text, with the
+following structure:
+[
+  {{
+    "index": The number of the text,
+    "corrected_text": "The corrected text.",
+    "explanations": ["Explanation of the first error.", ...],
+    "errors": ["Description of the first error", ...]
+  }},
+  ...
+]
+"""
+
+GRAMMAR_BATCH_RESPONSE_SCHEMA = {
+  "type": "array",
+  "items": {
+    **GRAMMAR_RESPONSE_SCHEMA,
+    "properties": {
+      "index": {
+        "type": "integer",
+        "description": "The number of the text this result belongs to."
+      },
+      **GRAMMAR_RESPONSE_SCHEMA["properties"],
+    },
+    "required": ["index", *GRAMMAR_RESPONSE_SCHEMA["required"]],
+  },
+  "description": "One result per numbered text."
+}
+
+# Hash of the single and batch prompts and schemas. It is part of the cache key,
+# and results of either path are cached, so changing any of them invalidates
+# the cached results.
+GRAMMAR_SCHEMA_HASH = hash_schema(GRAMMAR_PROMPT, GRAMMAR_RESPONSE_SCHEMA,
+                                  GRAMMAR_BATCH_PROMPT, GRAMMAR_BATCH_RESPONSE_SCHEMA)
+
+# Cache of check_grammar results, configured from the .env file:
+#   GRAMMAR_CACHE_SIZE: entries kept in memory (0 disables the cache)
+#   GRAMMAR_CACHE_TTL_S: seconds before an entry expires
+#   GRAMMAR_CACHE_DB: optional SQLite file that persists the cache across restarts
+grammar_cache = GrammarCache(max_entries=int(os.getenv("GRAMMAR_CACHE_SIZE", "1024")),
+                             ttl_s=float(os.getenv("GRAMMAR_CACHE_TTL_S", "86400")),
+                             db_path=os.getenv("GRAMMAR_CACHE_DB") or None)
+
+async def check_grammar(text_input: str) -> dict:
     """Checks the grammar of input text and returns corrections and explanations.
 
     This function uses the Gemini API to analyze the provided text for 
@@ -84,73 +242,62 @@ def check_grammar(text_input: str) -> dict:
         the JSON response, the "corrected_text" will be None and the "explanations"
         list will contain an error message. The "errors" list might be empty
         in such cases.
-    """
 
-    prompt = f"""
-    Analyze the following text for grammar errors, correct them, and provide 
-    explanations for each correction:
-
-    Text: {text_input}
-
-    Return the response as a JSON object with the following structure:
-    {{
-      "corrected_text": "The corrected text.",
-      "explanations": [
-        "Explanation of the first error.",
-        "Explanation of the second error.",
-        ...
-      ],
-      "errors": [
-          "Description of the first error",
-          "Description of the second error",
-          ...
-      ]
-    }}
+        The call is asynchronous, uses a client shared by all checks on the
+        event loop and fails with an error result after `GRAMMAR_TIMEOUT_S`.
+        Successful results are cached in `grammar_cache`, keyed on the
+        whitespace-normalized text, `MODEL_TOOL` and the prompt/schema hash.
+        Error results are never cached. When `GRAMMAR_BATCH_WINDOW_MS` is set,
+        checks arriving together are sent to Gemini as one batched request.
     """
 
-    response_schema = {
-      "type": "object",
-      "properties": {
-        "corrected_text": {
-          "type": "string",
-          "description": "The corrected text."
-        },
-        "explanations": {
-          "type": "array",
-          "items": {
-            "type": "string",
-            "description": "Explanation of a specific error."
-          },
-          "description": "An array of explanations for each correction."
-        },
-        "errors": {
-          "type": "array",
-          "items": {
-            "type": "string",
-            "description": "Description of a specific error."
-          },
-          "description": "An array of descriptions of each error."
-        }
-      },
-      "required": [
-        "corrected_text",
-        "explanations",
-        "errors"
-      ],
-      "description": "A JSON object containing corrected text, explanations, and error descriptions."
-    }
+    # Identical questions (up to whitespace) are answered from the cache
+    cache_key = make_key(text_input, MODEL_TOOL, GRAMMAR_SCHEMA_HASH)
+    cached_result = await grammar_cache.get_async(cache_key)
+    if cached_result is not None:
+        return cached_result
 
-    try:
-        client = genai.Client(vertexai=True, project=GOOGLE_CLOUD_PROJECT, location=GOOGLE_CLOUD_LOCATION)
+    if grammar_batcher is not None:
+        result = await grammar_batcher.submit(text_input)
+    else:
+        result = await _check_grammar_single(text_input)
+
+    # Error results are never cached, so the next call retries the model
+    if _is_valid_result(result):
+        await grammar_cache.put_async(cache_key, result)
+    return result
+
+def _is_valid_result(result) -> bool:
+    """Whether a result has the structure of GRAMMAR_RESPONSE_SCHEMA (and is not an error result)."""
+    return (isinstance(result, dict)
+            and isinstance(result.get("corrected_text"), str)
+            and isinstance(result.get("explanations"), list)
+            and isinstance(result.get("errors"), list))
+
+async def _generate_grammar_content(prompt: str, response_schema: dict):
+    """Sends a grammar prompt to MODEL_TOOL with the shared client and returns the response."""
+    client = get_client()
+
+    contents = [prompt]
 
-        contents = [prompt]
+    # The async call leaves the event loop free for other sessions while
+    # the model answers
+    return await asyncio.wait_for(
+        client.aio.models.generate_content(model=MODEL_TOOL,
+                                           contents=contents,
+                                           config=GenerateContentConfig(
+                                               response_mime_type="application/json",
+                                               response_schema=response_schema,
+                                           )),
+        timeout=GRAMMAR_TIMEOUT_S)
 
-        response = client.models.generate_content(model=MODEL_TOOL, 
-                                                  contents=contents,
-                                                  config=GenerateContentConfig(
-                                                  response_mime_type="application/json",
-                                                  response_schema=response_schema,
-                                              ))
+async def _check_grammar_single(text_input: str) -> dict:
+    """Checks the grammar of one text with its own model request."""
+
+    prompt = GRAMMAR_PROMPT.format(text_input=text_input)
+
+    try:
+        response = await _generate_grammar_content(prompt, GRAMMAR_RESPONSE_SCHEMA)
 
         try:
              return response.parsed
@@ -161,6 +308,12 @@ def check_grammar(text_input: str) -> dict:
                     "errors": []
                   }
 
+    except asyncio.TimeoutError:
+        return {
+                  "corrected_text": None,
+                  "explanations": [f"Error communicating with Gemini: no response within {GRAMMAR_TIMEOUT_S} seconds"],
+                  "errors": []
+                }
     except Exception as e:
         return {
                   "corrected_text": None,
@@ -168,6 +321,80 @@ def check_grammar(text_input: str) -> dict:
                   "errors": []
                 }  
 
+async def _check_grammar_batch(texts: list[str]) -> list[dict]:
+    """Checks the grammar of several texts with a single model request.
+
+    Args:
+        texts: The distinct texts to check.
+
+    Returns:
+        One result per text, in the same order. A text whose item is missing
+        or malformed in the response gets an error result; the other texts
+        are unaffected.
+    """
+    if len(texts) == 1:
+        return [await _check_grammar_single(texts[0])]
+
+    numbered_texts = "\n".join(f"{index}: {json.dumps(text)}" for index, text in enumerate(texts))
+    prompt = GRAMMAR_BATCH_PROMPT.format(numbered_texts=numbered_texts)
+
+    try:
+        response = await _generate_grammar_content(prompt, GRAMMAR_BATCH_RESPONSE_SCHEMA)
+        items = response.parsed
+        if not isinstance(items, list):
+            raise ValueError("the response is not a JSON array")
+    except asyncio.TimeoutError:
+        message = f"Error communicating with Gemini: no response within {GRAMMAR_TIMEOUT_S} seconds"
+        return [{"corrected_text": None, "explanations": [message], "errors": []} for _ in texts]
+    except Exception as e:
+        message = f"Error communicating with Gemini: {e}"
+        return [{"corrected_text": None, "explanations": [message], "errors": []} for _ in texts]
+
+    results_by_index = {}
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        index = item.get("index", position)
+        if isinstance(index, int) and 0 <= index < len(texts) and index not in results_by_index:
+            results_by_index[index] = {key: item.get(key) for key in ("corrected_text", "explanations", "errors")}
+
+    results = []
+    for index in range(len(texts)):
+        result = results_by_index.get(index)
+        if not _is_valid_result(result):
+            result = {
+                "corrected_text": None,
+                "explanations": [f"Error parsing Gemini response: no valid result for text {index} of the batch"],
+                "errors": []
+            }
+        results.append(result)
+    return results
+
+# Micro-batching of concurrent grammar checks, configured from the .env file:
+#   GRAMMAR_BATCH_WINDOW_MS: how long to collect checks before sending them (0 disables batching)
+#   GRAMMAR_BATCH_MAX_SIZE: maximum number of texts in one request
+GRAMMAR_BATCH_WINDOW_MS = float(os.getenv("GRAMMAR_BATCH_WINDOW_MS", "0"))
+grammar_batcher = (GrammarBatcher(_check_grammar_batch,
+                                  window_ms=GRAMMAR_BATCH_WINDOW_MS,
+                                  max_batch_size=int(os.getenv("GRAMMAR_BATCH_MAX_SIZE", "16")))
+                   if GRAMMAR_BATCH_WINDOW_MS > 0 else None)
+
+def save_grammar_state(tool, args: dict, tool_context, tool_response) -> None:
+    """Copies the result of `check_grammar` into the session state for the agents that follow.
+
+    The state gets "corrected_query", "grammar_explanation" (the explanations
+    joined into one text) and "grammar_errors" (the list of errors), so a later
+    agent can use them without reading the conversation. Error results (no
+    corrected text) leave the state unchanged. Used as `after_tool_callback`,
+    the tool response itself is never modified.
+    """
+    if tool.name != "check_grammar" or not _is_valid_result(tool_response):
+        return None
+    tool_context.state["corrected_query"] = tool_response["corrected_text"]
+    tool_context.state["grammar_explanation"] = " ".join(tool_response["explanations"])
+    tool_context.state["grammar_errors"] = tool_response["errors"]
+    return None
+
 agent_grammar = Agent(
     model=MODEL_AGENT,
     name='agent_grammar',
@@ -185,4 +412,5 @@ agent_grammar = Agent(
         Finally, provide the explanation. If there are no errors, reply with an empty string "".
     """,
     tools=[check_grammar],
+    after_tool_callback=save_grammar_state,
 )
\ No newline at end of file
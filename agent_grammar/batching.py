@@ -0,0 +1,92 @@
+import asyncio
+import copy
+import contextvars
+from typing import Awaitable, Callable, Optional
+
+# The number of texts of the batch being sent by the current task, so that
+# instrumentation can tell a batched request from a single check
+current_batch_size: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("current_batch_size",
+                                                                                  default=None)
+
+
+class GrammarBatcher:
+    """Collects concurrent grammar checks and sends them as one model request.
+
+    Texts submitted within `window_ms` of the first pending text are grouped,
+    and a group is sent as soon as it reaches `max_batch_size`. Identical texts
+    in a group are sent once. Every caller receives its own copy of the result
+    for its text.
+
+    Args:
+        send_batch: Coroutine that checks a list of distinct texts and returns
+                    one result dict per text, in the same order. It must turn
+                    per-item failures into error results instead of raising.
+        window_ms: How long to wait for more texts after the first one arrives.
+        max_batch_size: Maximum number of distinct texts in one request.
+    """
+
+    def __init__(self, send_batch: Callable[[list[str]], Awaitable[list[dict]]],
+                 window_ms: float = 20.0, max_batch_size: int = 16):
+        self.send_batch = send_batch
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.items = 0
+        self._pending: dict[str, list[asyncio.Future]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Keeps a reference to the running sends so they are not garbage collected
+        self._sends: set[asyncio.Task] = set()
+
+    async def submit(self, text: str) -> dict:
+        """Queues a text for the next batch and waits for its result."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Futures and timers belong to a loop, so nothing carries over to a new one
+            self._loop = loop
+            self._pending = {}
+            self._timer = None
+
+        future = loop.create_future()
+        self._pending.setdefault(text, []).append(future)
+        self.items += 1
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        self.batches += 1
+        # The batch is sent on behalf of every caller, so it runs in a context of its
+        # own rather than in that of the caller that happened to start the timer
+        task = self._loop.create_task(self._send(batch), context=contextvars.Context())
+        self._sends.add(task)
+        task.add_done_callback(self._sends.discard)
+
+    async def _send(self, batch: dict[str, list[asyncio.Future]]) -> None:
+        texts = list(batch)
+        current_batch_size.set(len(texts))
+        try:
+            results = await self.send_batch(texts)
+        except BaseException as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+
+        for text, result in zip(texts, results):
+            for future in batch[text]:
+                # A caller that was cancelled while waiting no longer needs its result
+                if not future.done():
+                    future.set_result(copy.deepcopy(result))
@@ -0,0 +1,224 @@
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# How long a lookup or a write waits for another process's transaction. The
+# cache is only an optimization, so a locked database counts as a miss.
+DB_TIMEOUT_S = 0.1
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes a text for use in a cache key.
+
+    Only surrounding and repeated whitespace is removed. Case and punctuation
+    are kept, since they are exactly what a grammar check looks at.
+    """
+    return " ".join(text.split())
+
+
+def make_key(text: str, model: str, schema_hash: str) -> str:
+    """Builds the cache key of a grammar check from the text, the model and the schema hash."""
+    data = json.dumps([normalize_text(text), model, schema_hash], separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def hash_schema(*parts) -> str:
+    """Returns a short stable hash of JSON serializable values (e.g. a response schema)."""
+    data = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+class GrammarCache:
+    """A bounded two-tier cache of grammar check results.
+
+    The first tier is an in-memory LRU. The optional second tier is a SQLite
+    database, so results survive restarts and can be shared by processes on
+    the same machine. Both tiers expire entries after `ttl_s` seconds and evict
+    the least recently used entries beyond their maximum size.
+
+    Values are stored as JSON strings, so every hit returns a fresh copy that
+    callers are free to modify.
+
+    The database calls block, so async code uses `get_async` and `put_async`,
+    which run the second tier in a worker thread. A database that stays locked
+    by another process for `DB_TIMEOUT_S`, or fails otherwise, counts as a
+    miss (or a skipped write) rather than an error.
+
+    Args:
+        max_entries: Maximum number of entries kept in memory. 0 disables the cache.
+        ttl_s: Time to live of an entry in seconds. None keeps entries until evicted.
+        db_path: Path of the SQLite database of the second tier, or None for memory only.
+        max_db_entries: Maximum number of entries kept in the database.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_s: Optional[float] = 86400,
+                 db_path: Optional[str] = None, max_db_entries: int = 100_000):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.max_db_entries = max_db_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.db_errors = 0
+        self._memory: OrderedDict[str, tuple[Optional[float], str]] = OrderedDict()
+        # The memory tier is used from the event loop, so it never waits for the database
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._db_entries = 0
+        if db_path and max_entries > 0:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=DB_TIMEOUT_S)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS grammar_cache ("
+                             "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS grammar_cache_accessed ON grammar_cache (accessed_at)")
+            self._db_entries = self._db.execute("SELECT COUNT(*) FROM grammar_cache").fetchone()[0]
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _expires_at(self, now: float) -> Optional[float]:
+        return now + self.ttl_s if self.ttl_s is not None else None
+
+    def get(self, key: str) -> Optional[dict]:
+        """Returns a copy of the cached result for a key, or None on a miss."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None and self._db is not None:
+            value = self._get_db(key, now)
+        return self._count(value)
+
+    async def get_async(self, key: str) -> Optional[dict]:
+        """Like `get`, with the database lookup in a worker thread so the event loop never waits for it."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None and self._db is not None:
+            value = await asyncio.to_thread(self._get_db, key, now)
+        return self._count(value)
+
+    def _count(self, value: Optional[str]) -> Optional[dict]:
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def _get_memory(self, key: str, now: float) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is None or expires_at > now:
+                self._memory.move_to_end(key)
+                return value
+            del self._memory[key]
+            return None
+
+    def _get_db(self, key: str, now: float) -> Optional[str]:
+        try:
+            with self._db_lock:
+                row = self._db.execute("SELECT value, expires_at FROM grammar_cache WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                value, expires_at = row
+                if expires_at is not None and expires_at <= now:
+                    self._db.execute("DELETE FROM grammar_cache WHERE key = ?", (key,))
+                    self._db_entries -= 1
+                    return None
+                self._db.execute("UPDATE grammar_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.Error:
+            self.db_errors += 1
+            return None
+        with self._lock:
+            self._put_memory(key, value, expires_at)
+        self.disk_hits += 1
+        return value
+
+    def put(self, key: str, result: dict) -> None:
+        """Stores a result in both tiers."""
+        if not self.enabled:
+            return
+        now = time.time()
+        value = self._put_memory_entry(key, result, now)
+        if self._db is not None:
+            self._put_db(key, value, now)
+
+    async def put_async(self, key: str, result: dict) -> None:
+        """Like `put`, with the database write in a worker thread."""
+        if not self.enabled:
+            return
+        now = time.time()
+        value = self._put_memory_entry(key, result, now)
+        if self._db is not None:
+            await asyncio.to_thread(self._put_db, key, value, now)
+
+    def _put_memory_entry(self, key: str, result: dict, now: float) -> str:
+        value = json.dumps(result, separators=(",", ":"))
+        with self._lock:
+            self._put_memory(key, value, self._expires_at(now))
+        return value
+
+    def _put_db(self, key: str, value: str, now: float) -> None:
+        try:
+            with self._db_lock:
+                cursor = self._db.execute("INSERT OR REPLACE INTO grammar_cache (key, value, expires_at, accessed_at) "
+                                          "VALUES (?, ?, ?, ?)", (key, value, self._expires_at(now), now))
+                self._db_entries += cursor.rowcount
+                self._evict_db(now)
+        except sqlite3.Error:
+            # The result stays in memory; the database misses it
+            self.db_errors += 1
+
+    def _put_memory(self, key: str, value: str, expires_at: Optional[float]) -> None:
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _evict_db(self, now: float) -> None:
+        # The row count is tracked locally (it may drift when other processes share
+        # the database), so the table is only recounted when it looks full
+        if self._db_entries <= self.max_db_entries:
+            return
+        self._db.execute("DELETE FROM grammar_cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        self._db_entries = self._db.execute("SELECT COUNT(*) FROM grammar_cache").fetchone()[0]
+        excess = self._db_entries - self.max_db_entries
+        if excess > 0:
+            self._db.execute("DELETE FROM grammar_cache WHERE key IN "
+                             "(SELECT key FROM grammar_cache ORDER BY accessed_at LIMIT ?)", (excess,))
+            self._db_entries -= excess
+            self.evictions += excess
+
+    def clear(self) -> None:
+        """Removes all entries from both tiers."""
+        with self._lock:
+            self._memory.clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM grammar_cache")
+                self._db_entries = 0
+
+    def stats(self) -> dict:
+        """Returns the hit, miss and eviction counters and the current sizes."""
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "db_errors": self.db_errors,
+            "memory_entries": len(self._memory),
+            "db_entries": self._db_entries if self._db is not None else 0,
+        }
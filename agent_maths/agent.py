@@ -1,6 +1,12 @@
+from typing import Optional, Union
+
 from google.adk.agents import Agent
 from google.genai import types
 
+from .compact import compact_large_results, scientific_notation, to_decimal_string
+from .expression import ExpressionError, evaluate_expression
+from .ranges import MAX_RANGE_PRODUCT_BITS, range_length, range_sum, range_product, range_product_bits
+
 MODEL = "gemini-2.0-flash-001"
 
 def add(numbers: list[int]) -> int:
@@ -109,6 +115,243 @@ def divide(numbers: list[int]) -> float:  # Use float for division
         result /= num
     return result
 
+def _range_error(step: int) -> Optional[dict]:
+    """Returns the error result of a range tool whose step is zero, or None."""
+    if step == 0:
+        return {"error": "The step of a range must not be zero."}
+    return None
+
+def _product_error(start: int, end: int, step: int) -> Optional[dict]:
+    """Returns the error result of a range tool whose product would be too large to compute, or None.
+
+    The product runs on the event loop, like every synchronous tool, so its
+    size is estimated before it is computed. A range that contains 0 has a
+    product of 0 and is never too large.
+    """
+    error = _range_error(step)
+    if error is None and range_product_bits(start, end, step) > MAX_RANGE_PRODUCT_BITS:
+        error = {"error": f"The product of this range would have more than {MAX_RANGE_PRODUCT_BITS} bits."}
+    return error
+
+def add_range(start: int, end: int, step: int = 1) -> Union[int, dict]:
+    """Calculates the sum of all the numbers in a range.
+
+    The range includes both ends and advances by `step`, e.g. start=1, end=10,
+    step=1 is 1, 2, ..., 10. Use it instead of `add` when the user asks about
+    "the numbers between" or "from ... to ..." two numbers, so the numbers do
+    not have to be listed. The sum is computed with the arithmetic series
+    formula, so the cost does not depend on the size of the range.
+
+    Args:
+        start: The first number of the range.
+        end: The last number of the range (included if reached by the step).
+        step: The difference between consecutive numbers. Defaults to 1.
+
+    Returns:
+        The sum of the numbers in the range. Returns 0 if the range is empty,
+        and {"error": ...} if step is 0.
+
+    Examples:
+        add_range(1, 10) == 55
+        add_range(2, 10, 2) == 30  # 2 + 4 + 6 + 8 + 10
+        add_range(10, 1) == 0
+    """
+    return _range_error(step) or range_sum(start, end, step)
+
+def subtract_range(start: int, end: int, step: int = 1) -> Union[int, dict]:
+    """Subtracts all the numbers in a range sequentially from left to right.
+
+    The range includes both ends and advances by `step`. For start=10, end=12
+    the function calculates 10 - 11 - 12, without listing the numbers.
+
+    Args:
+        start: The first number of the range.
+        end: The last number of the range (included if reached by the step).
+        step: The difference between consecutive numbers. Defaults to 1.
+
+    Returns:
+        The result of the sequential subtraction. Returns 0 if the range is
+        empty, and {"error": ...} if step is 0.
+
+    Examples:
+        subtract_range(10, 12) == -13  # 10 - 11 - 12
+        subtract_range(1, 3) == -4     # 1 - 2 - 3
+    """
+    error = _range_error(step)
+    if error is not None:
+        return error
+    if range_length(start, end, step) == 0:
+        return 0
+    return 2 * start - range_sum(start, end, step)
+
+def multiply_range(start: int, end: int, step: int = 1) -> Union[int, dict]:
+    """Calculates the product of all the numbers in a range.
+
+    The range includes both ends and advances by `step`. Use it instead of
+    `multiply` for requests like "multiply all the numbers between 1 and 10",
+    so the numbers do not have to be listed.
+
+    Args:
+        start: The first number of the range.
+        end: The last number of the range (included if reached by the step).
+        step: The difference between consecutive numbers. Defaults to 1.
+
+    Returns:
+        The product of the numbers in the range. Returns 1 if the range is
+        empty, and {"error": ...} if step is 0 or the product would have more
+        than about 1.2 million digits.
+
+    Examples:
+        multiply_range(1, 10) == 3628800
+        multiply_range(1, 9, 2) == 945  # 1 * 3 * 5 * 7 * 9
+        multiply_range(-2, 2) == 0
+    """
+    error = _product_error(start, end, step)
+    if error is not None:
+        return error
+    return range_product(start, end, step)
+
+def divide_range(start: int, end: int, step: int = 1) -> Union[float, dict]:
+    """Divides the numbers in a range sequentially from left to right.
+
+    The range includes both ends and advances by `step`. For start=100, end=102
+    the function calculates 100 / 101 / 102, without listing the numbers.
+
+    Args:
+        start: The first number of the range.
+        end: The last number of the range (included if reached by the step).
+        step: The difference between consecutive numbers. Defaults to 1.
+
+    Returns:
+        The result of the sequential division as a float. Returns 0.0 if the
+        range is empty, and {"error": ...} if step is 0 or the divisor would
+        have more than about 1.2 million digits.
+
+    Raises:
+        ZeroDivisionError: If zero is one of the numbers after the first one.
+
+    Examples:
+        divide_range(2, 4, 2) == 0.5  # 2 / 4
+    """
+    # The divisor is the product of the range without its first number
+    error = _product_error(start + step, end, step)
+    if error is not None:
+        return error
+    count = range_length(start, end, step)
+    if count == 0:
+        return 0.0
+    divisor = range_product(start + step, end, step) if count > 1 else 1
+    if divisor == 0:
+        raise ZeroDivisionError("Cannot divide by zero.")
+    # Integer true division stays exact even when the divisor is too big for a float
+    return start / divisor
+
+def alternating_sum_range(start: int, end: int, step: int = 1) -> Union[int, dict]:
+    """Alternately adds and subtracts the numbers in a range.
+
+    The range includes both ends and advances by `step`. For start=1, end=5
+    the function calculates 1 - 2 + 3 - 4 + 5, in constant time.
+
+    Args:
+        start: The first number of the range.
+        end: The last number of the range (included if reached by the step).
+        step: The difference between consecutive numbers. Defaults to 1.
+
+    Returns:
+        The alternating sum of the numbers in the range. Returns 0 if the range
+        is empty, and {"error": ...} if step is 0.
+
+    Examples:
+        alternating_sum_range(1, 5) == 3   # 1 - 2 + 3 - 4 + 5
+        alternating_sum_range(1, 4) == -2  # 1 - 2 + 3 - 4
+    """
+    error = _range_error(step)
+    if error is not None:
+        return error
+    count = range_length(start, end, step)
+    # Every (+a, -(a + step)) pair contributes -step
+    pairs = count // 2
+    result = -step * pairs
+    if count % 2:
+        result += start + (count - 1) * step
+    return result
+
+def evaluate(expression: str) -> dict:
+    """Evaluates a whole arithmetic expression in a single step.
+
+    Use it for requests with several steps or operations, such as "first
+    multiply numbers 1 to 3 and then add 4", by writing them as one
+    expression: "prod(range(1, 3)) + 4". The result is exact: fractions are
+    kept as fractions instead of being rounded.
+
+    Supported syntax:
+        - Numbers, parentheses and the operators + - * / // % ** (× ÷ and ^ also work).
+        - range(start, end, step): the numbers from start to end, both included
+          (step is optional and defaults to 1). It is never written out.
+        - sum(...) and prod(...): the sum or product of a range, a list such as
+          [1, 2, 3], or of their arguments.
+        - abs(x).
+    Exponents are limited to 10000, products of ranges to about 1.2 million
+    digits and other results to about 300,000 digits.
+
+    Args:
+        expression: The arithmetic expression to evaluate.
+
+    Returns:
+        A dictionary with:
+            "result": The exact result, as an integer when it is whole or as a
+                      "numerator/denominator" string otherwise.
+            "decimal": The result as a decimal number, or as a string in
+                       scientific notation when it is too large for one.
+        or, if the expression is invalid or too large:
+            "error": A description of the problem.
+
+    Examples:
+        evaluate("prod(range(1, 3)) + 4") == {"result": 10, "decimal": 10.0}
+        evaluate("(1 + 2) × 3 ÷ 4") == {"result": "9/4", "decimal": 2.25}
+        evaluate("sum(range(1, 100))") == {"result": 5050, "decimal": 5050.0}
+    """
+    try:
+        result = evaluate_expression(expression)
+    except (ExpressionError, OverflowError) as e:
+        return {"error": str(e)}
+    try:
+        decimal = float(result)
+    except OverflowError:
+        # Too large for a float: infinity is not valid JSON, so the value is written out instead
+        decimal = scientific_notation(result.numerator, result.denominator)
+    if result.denominator == 1:
+        return {"result": result.numerator, "decimal": decimal}
+    return {"result": f"{to_decimal_string(result.numerator)}/{to_decimal_string(result.denominator)}", "decimal": decimal}
+
+async def save_math_state(tool, args: dict, tool_context, tool_response):
+    """Summarizes huge results and records the calculation in the session state.
+
+    Runs as the `after_tool_callback` of agent_math. The response is first
+    passed through `compact_large_results`, then the state gets "math_result"
+    (the result the model sees) and "calculation_steps" (one line per tool call
+    of the current invocation, e.g. "multiply(numbers=[1, 10]) = 10"), so later
+    agents can use them without reading the conversation.
+
+    Returns:
+        The compacted response, or None to keep the response unchanged.
+    """
+    compacted = await compact_large_results(tool, args, tool_context, tool_response)
+    response = compacted if compacted is not None else tool_response
+    result = response.get("result", response) if isinstance(response, dict) else response
+    arguments = ", ".join(f"{name}={value!r}" for name, value in args.items())
+    step = f"{tool.name}({arguments}) = {result}"
+
+    state = tool_context.state
+    # Steps of earlier invocations of the same session are not part of this calculation
+    if state.get("calculation_steps_invocation_id") == tool_context.invocation_id and state.get("calculation_steps"):
+        step = state["calculation_steps"] + "\n" + step
+    state["calculation_steps"] = step
+    state["calculation_steps_invocation_id"] = tool_context.invocation_id
+    if not (isinstance(response, dict) and "error" in response):
+        state["math_result"] = result
+    return compacted
+
 #print("Model:" + MODEL)
 agent_math = Agent(
     model=MODEL,
@@ -119,7 +362,18 @@ agent_math = Agent(
       Tell me the numbers you want to operate on. 
       For example, you can say 'add 3 5', 'multiply 2, 4 and 3', 'Subtract 10 from 20', 'Divide 10 by 2'.
       You can also provide a range: 'Multiply the numbers between 1 and 10'.
+      For ranges, use the range tools (add_range, subtract_range, multiply_range, divide_range,
+      alternating_sum_range) with the first and last number instead of listing every number.
+      For requests with several steps, e.g. 'First multiply numbers 1 to 3 and then add 4',
+      write them as one expression and call evaluate once: evaluate("prod(range(1, 3)) + 4").
+      Very large results come back in scientific notation with their digit count, leading and
+      trailing digits; report them that way and mention that the exact value was saved as an artifact.
     """,
     generate_content_config=types.GenerateContentConfig(temperature=0.2),
-    tools=[add, subtract, multiply, divide],
+    tools=[add, subtract, multiply, divide,
+           add_range, subtract_range, multiply_range, divide_range, alternating_sum_range,
+           evaluate],
+    # Huge results are summarized before they reach the model (see agent_maths/compact.py)
+    # and every result is recorded in the session state
+    after_tool_callback=save_math_state,
 )
\ No newline at end of file
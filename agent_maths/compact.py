@@ -0,0 +1,205 @@
+import os
+import re
+import math
+import decimal
+from typing import Optional
+
+from google.genai import types
+
+# Results with more decimal digits than this are returned in compact form (0 disables it).
+# Keep it well below Python's 4300 digit limit on int/str conversions.
+MAX_RESULT_DIGITS = int(os.getenv("MATH_MAX_RESULT_DIGITS", "1000"))
+# Number of leading and trailing digits kept in a compact result
+EDGE_DIGITS = int(os.getenv("MATH_EDGE_DIGITS", "15"))
+
+_LOG10_2 = math.log10(2)
+# Precision of the approximations used for the scientific notation and the digit count
+_APPROX_PRECISION = 60
+_FRACTION_PATTERN = re.compile(r"^(-?\d+)/(\d+)$")
+_NEAR_TEN = decimal.Decimal("9." + "9" * 40)
+
+
+def estimate_digits(n: int) -> int:
+    """Estimates the number of decimal digits of an integer from its bit length.
+
+    The estimate never exceeds the exact count by more than one and costs
+    nothing, since no decimal string is produced.
+
+    Examples:
+        estimate_digits(999) == 3
+        estimate_digits(2 ** 100) == 31
+    """
+    return int(abs(n).bit_length() * _LOG10_2) + 1
+
+
+def _approximate_context() -> decimal.Context:
+    return decimal.Context(prec=_APPROX_PRECISION, rounding=decimal.ROUND_DOWN,
+                           Emax=decimal.MAX_EMAX, Emin=decimal.MIN_EMIN)
+
+
+def _approximate(n: int) -> decimal.Decimal:
+    """Returns |n| rounded down to _APPROX_PRECISION significant digits, without converting n to decimal."""
+    n = abs(n)
+    # The top 256 bits are more than enough for _APPROX_PRECISION digits
+    shift = max(0, n.bit_length() - 256)
+    ctx = _approximate_context()
+    return ctx.multiply(decimal.Decimal(n >> shift), ctx.power(2, shift))
+
+
+def count_digits(n: int) -> int:
+    """Returns the exact number of decimal digits of an integer (without the sign)."""
+    if n == 0:
+        return 1
+    approximation = _approximate(n)
+    digits = approximation.adjusted() + 1
+    # The approximation is a lower bound, so it can only fall short of a power of
+    # ten when n is within a hair of it, which is checked exactly
+    if approximation.scaleb(1 - digits, _approximate_context()) >= _NEAR_TEN and abs(n) >= 10 ** digits:
+        digits += 1
+    return digits
+
+
+def to_decimal_string(n: int) -> str:
+    """Converts an integer of any size to its decimal string.
+
+    str() is quadratic in the number of digits and refuses integers above 4300
+    digits. This splits the integer in binary halves and joins them with the
+    decimal module, whose multiplication is subquadratic, e.g. a million digits
+    take well under a second instead of tens of seconds.
+    """
+    if estimate_digits(n) < 4000:
+        return str(n)
+    powers: dict[int, decimal.Decimal] = {}
+
+    def power_of_two(bits: int) -> decimal.Decimal:
+        if bits not in powers:
+            if bits <= 1024:
+                powers[bits] = decimal.Decimal(2) ** bits
+            else:
+                half = bits >> 1
+                powers[bits] = power_of_two(half) * power_of_two(bits - half)
+        return powers[bits]
+
+    def convert(value: int, bits: int) -> decimal.Decimal:
+        if bits <= 1024:
+            return decimal.Decimal(value)
+        half = bits >> 1
+        high = value >> half
+        low = value - (high << half)
+        return convert(low, half) + convert(high, bits - half) * power_of_two(half)
+
+    with decimal.localcontext() as ctx:
+        ctx.prec = decimal.MAX_PREC
+        ctx.Emax = decimal.MAX_EMAX
+        ctx.traps[decimal.Inexact] = True
+        text = str(convert(abs(n), abs(n).bit_length()))
+    return "-" + text if n < 0 else text
+
+
+def scientific_notation(numerator: int, denominator: int = 1, significant_digits: int = EDGE_DIGITS) -> str:
+    """Writes a fraction of any size in scientific notation, without converting it to a decimal string.
+
+    Examples:
+        scientific_notation(10 ** 400, 3, 5) == "3.3333e+399"
+    """
+    ctx = _approximate_context()
+    value = ctx.divide(_approximate(numerator), _approximate(denominator))
+    sign = "-" if (numerator < 0) != (denominator < 0) and numerator != 0 else ""
+    return f"{sign}{value:.{max(significant_digits - 1, 0)}e}"
+
+
+def compact_int(n: int, edge_digits: int = EDGE_DIGITS) -> dict:
+    """Describes a huge integer without writing out all of its digits.
+
+    Args:
+        n: The integer.
+        edge_digits: How many leading and trailing digits to include.
+
+    Returns:
+        A dictionary with:
+            "result": The value in scientific notation, e.g. "2.8242294079603e+456573".
+            "digits": The exact number of decimal digits.
+            "leading_digits": The first `edge_digits` digits.
+            "trailing_digits": The last `edge_digits` digits.
+
+    Examples:
+        compact_int(2 ** 10000, 5) == {"result": "1.9950e+3010", "digits": 3011,
+                                       "leading_digits": "19950", "trailing_digits": "09376"}
+    """
+    digits = count_digits(n)
+    edge_digits = min(edge_digits, digits)
+    sign = "-" if n < 0 else ""
+    # The approximation rounds down, so its leading digits are the leading digits of n
+    leading = int(_approximate(n).scaleb(edge_digits - digits, _approximate_context()))
+    # Just above a power of ten the approximation still reads 999..., but n starts with 1000...
+    leading_digits = str(max(leading, 10 ** (edge_digits - 1)))
+    mantissa = leading_digits[0] + ("." + leading_digits[1:] if edge_digits > 1 else "")
+    return {
+        "result": f"{sign}{mantissa}e+{digits - 1}",
+        "digits": digits,
+        "leading_digits": leading_digits,
+        "trailing_digits": str(abs(n) % 10 ** edge_digits).zfill(edge_digits),
+    }
+
+
+def compact_fraction_text(text: str, edge_digits: int = EDGE_DIGITS) -> dict:
+    """Describes a huge "numerator/denominator" string by its value and the sizes of its parts."""
+    numerator, denominator = text.split("/")
+    ctx = _approximate_context()
+    value = ctx.divide(decimal.Decimal(numerator), decimal.Decimal(denominator))
+    return {
+        "result": f"{value:.{max(edge_digits - 1, 0)}e}",
+        "numerator_digits": len(numerator.lstrip("-")),
+        "denominator_digits": len(denominator),
+    }
+
+
+def _is_too_large(value) -> bool:
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return estimate_digits(value) > MAX_RESULT_DIGITS
+    return isinstance(value, str) and len(value) > MAX_RESULT_DIGITS and _FRACTION_PATTERN.match(value) is not None
+
+
+async def compact_large_results(tool, args: dict, tool_context, tool_response) -> Optional[dict]:
+    """Replaces huge numbers in a tool response with a compact description.
+
+    Use it as the `after_tool_callback` of an agent. Integers (and exact
+    "numerator/denominator" fractions) with more than MAX_RESULT_DIGITS digits
+    would otherwise be written out in full into the function response, the
+    session history and every later model request. Their size is estimated from
+    the bit length, so small results cost nothing. Huge ones are replaced with
+    the description from `compact_int` (or `compact_fraction_text`), and their
+    exact decimal value is saved as a text artifact, named in "artifact", that
+    the application can load with `load_artifact`.
+
+    Returns:
+        The compacted response, or None to keep the response unchanged.
+    """
+    if MAX_RESULT_DIGITS <= 0:
+        return None
+    bare = not isinstance(tool_response, dict)
+    response = {"result": tool_response} if bare else dict(tool_response)
+    large = [key for key, value in response.items() if _is_too_large(value)]
+    if not large:
+        return None
+
+    for key in large:
+        value = response[key]
+        if isinstance(value, int):
+            compact, exact = compact_int(value), to_decimal_string(value)
+        else:
+            compact, exact = compact_fraction_text(value), value
+        call_id = tool_context.function_call_id or "call"
+        filename = f"{tool.name}_{call_id}_{key}.txt"
+        try:
+            await tool_context.save_artifact(filename, types.Part.from_bytes(data=exact.encode("ascii"),
+                                                                             mime_type="text/plain"))
+            compact["artifact"] = filename
+        except ValueError:
+            # The runner has no artifact service, so the exact value is not kept
+            compact["artifact"] = None
+        response[key] = compact
+
+    return response["result"] if bare else response
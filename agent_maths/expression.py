@@ -0,0 +1,232 @@
+import ast
+import math
+import operator
+from fractions import Fraction
+from functools import lru_cache
+from typing import Callable, Union
+
+from .ranges import MAX_RANGE_PRODUCT_BITS, range_length, range_product, range_product_bits, range_sum
+
+# Limits that keep a single expression cheap to evaluate
+MAX_EXPRESSION_LENGTH = 1000
+MAX_EXPONENT = 10_000
+MAX_RESULT_BITS = 1_000_000  # about 300,000 decimal digits
+
+# Symbols people (and models) write that Python spells differently
+_SYMBOLS = {"×": "*", "÷": "/", "−": "-", "^": "**"}
+
+
+class ExpressionError(ValueError):
+    """Raised when an expression is invalid, unsupported or too expensive to evaluate."""
+
+
+class _Range:
+    """An inclusive range that is never materialized; sum() and prod() use closed forms."""
+
+    def __init__(self, start: int, end: int, step: int = 1):
+        if step == 0:
+            raise ExpressionError("range() step must not be zero.")
+        self.start, self.end, self.step = start, end, step
+
+    def __len__(self):
+        return range_length(self.start, self.end, self.step)
+
+    def __iter__(self):
+        return (Fraction(term) for term in range(self.start, self.end + (1 if self.step > 0 else -1), self.step))
+
+
+Value = Union[Fraction, _Range, list]
+
+
+def _bits(value: Fraction) -> int:
+    return max(value.numerator.bit_length(), value.denominator.bit_length())
+
+
+def _check_size(bits: int) -> None:
+    if bits > MAX_RESULT_BITS:
+        raise ExpressionError(f"The result would have more than {MAX_RESULT_BITS} bits.")
+
+
+def _number(value: Value) -> Fraction:
+    if not isinstance(value, Fraction):
+        raise ExpressionError("Expected a number, got a list or range.")
+    return value
+
+
+def _whole(value: Value, what: str) -> int:
+    value = _number(value)
+    if value.denominator != 1:
+        raise ExpressionError(f"{what} must be a whole number.")
+    return value.numerator
+
+
+def _multiply(left: Fraction, right: Fraction) -> Fraction:
+    _check_size(_bits(left) + _bits(right))
+    return left * right
+
+
+def _divide(left: Fraction, right: Fraction) -> Fraction:
+    if right == 0:
+        raise ExpressionError("Cannot divide by zero.")
+    return left / right
+
+
+def _floor_divide(left: Fraction, right: Fraction) -> Fraction:
+    return Fraction(_divide(left, right).__floor__())
+
+
+def _modulo(left: Fraction, right: Fraction) -> Fraction:
+    if right == 0:
+        raise ExpressionError("Cannot divide by zero.")
+    return left % right
+
+
+def _power(base: Fraction, exponent: Fraction) -> Fraction:
+    exponent = _whole(exponent, "The exponent")
+    if abs(exponent) > MAX_EXPONENT:
+        raise ExpressionError(f"The exponent must be between -{MAX_EXPONENT} and {MAX_EXPONENT}.")
+    if base == 0 and exponent < 0:
+        raise ExpressionError("Cannot divide by zero.")
+    _check_size(_bits(base) * abs(exponent))
+    return base ** exponent
+
+
+_BINARY_OPERATORS: dict[type, Callable[[Fraction, Fraction], Fraction]] = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: _multiply,
+    ast.Div: _divide,
+    ast.FloorDiv: _floor_divide,
+    ast.Mod: _modulo,
+    ast.Pow: _power,
+}
+
+_UNARY_OPERATORS: dict[type, Callable[[Fraction], Fraction]] = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+def _terms(args: list[Value]) -> Union[list[Fraction], _Range]:
+    """Returns the numbers sum() and prod() work on: one list or range, or the arguments themselves."""
+    if len(args) == 1 and isinstance(args[0], (list, _Range)):
+        return args[0]
+    return [_number(arg) for arg in args]
+
+
+def _sum(*args: Value) -> Fraction:
+    terms = _terms(list(args))
+    if isinstance(terms, _Range):
+        return Fraction(range_sum(terms.start, terms.end, terms.step))
+    return sum(terms, Fraction(0))
+
+
+def _prod(*args: Value) -> Fraction:
+    terms = _terms(list(args))
+    if isinstance(terms, _Range):
+        if len(terms) == 0:
+            return Fraction(1)
+        # Range products have their own, higher limit, like multiply_range
+        if range_product_bits(terms.start, terms.end, terms.step) > MAX_RANGE_PRODUCT_BITS:
+            raise ExpressionError(f"The product of this range would have more than {MAX_RANGE_PRODUCT_BITS} bits.")
+        return Fraction(range_product(terms.start, terms.end, terms.step))
+    product = Fraction(1)
+    for term in terms:
+        product = _multiply(product, term)
+    return product
+
+
+def _range(*args: Value) -> _Range:
+    if len(args) not in (2, 3):
+        raise ExpressionError("range() takes a start, an end and an optional step.")
+    return _Range(*(_whole(arg, "A range() argument") for arg in args))
+
+
+def _abs(value: Value) -> Fraction:
+    return abs(_number(value))
+
+
+_FUNCTIONS: dict[str, Callable[..., Value]] = {
+    "sum": _sum,
+    "prod": _prod,
+    "range": _range,
+    "abs": _abs,
+}
+
+
+def _compile_node(node: ast.AST) -> Callable[[], Value]:
+    """Turns a validated AST node into a closure that evaluates it."""
+    if isinstance(node, ast.Expression):
+        return _compile_node(node.body)
+
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        # Literals such as 1e999 are parsed as inf, which has no exact value
+        if isinstance(node.value, float) and not math.isfinite(node.value):
+            raise ExpressionError("A number in the expression is too large.")
+        # str() keeps decimal literals exact, e.g. 0.1 is 1/10
+        value = Fraction(str(node.value)) if isinstance(node.value, float) else Fraction(node.value)
+        return lambda: value
+
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        apply = _BINARY_OPERATORS[type(node.op)]
+        left, right = _compile_node(node.left), _compile_node(node.right)
+        return lambda: apply(_number(left()), _number(right()))
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        apply = _UNARY_OPERATORS[type(node.op)]
+        operand = _compile_node(node.operand)
+        return lambda: apply(_number(operand()))
+
+    if isinstance(node, (ast.List, ast.Tuple)):
+        elements = [_compile_node(element) for element in node.elts]
+        return lambda: [_number(element()) for element in elements]
+
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+            and node.func.id in _FUNCTIONS and not node.keywords):
+        function = _FUNCTIONS[node.func.id]
+        args = [_compile_node(arg) for arg in node.args]
+        return lambda: function(*(arg() for arg in args))
+
+    raise ExpressionError(f"Unsupported syntax: {ast.unparse(node)}")
+
+
+@lru_cache(maxsize=1024)
+def compile_expression(expression: str) -> Callable[[], Value]:
+    """Parses and validates an expression once and returns a reusable evaluator.
+
+    Only numbers, + - * / // % ** (also × ÷ ^), parentheses, lists and the
+    functions sum(), prod(), range() and abs() are accepted. Nothing is ever
+    passed to eval(). Compiled expressions are cached, so repeated expressions
+    skip parsing.
+
+    Raises:
+        ExpressionError: If the expression is too long or uses unsupported syntax.
+    """
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise ExpressionError(f"The expression is longer than {MAX_EXPRESSION_LENGTH} characters.")
+    for symbol, replacement in _SYMBOLS.items():
+        expression = expression.replace(symbol, replacement)
+    try:
+        return _compile_node(ast.parse(expression.strip(), mode="eval"))
+    except SyntaxError as e:
+        raise ExpressionError(f"Invalid expression: {e.msg}") from None
+    except RecursionError:
+        raise ExpressionError("The expression is nested too deeply.") from None
+
+
+def evaluate_expression(expression: str) -> Fraction:
+    """Evaluates an arithmetic expression exactly.
+
+    Args:
+        expression: The expression, e.g. "prod(range(1, 3)) + 4".
+
+    Returns:
+        The exact result as a Fraction.
+
+    Raises:
+        ExpressionError: If the expression is invalid or exceeds the limits.
+    """
+    result = compile_expression(expression)()
+    if isinstance(result, (list, _Range)):
+        raise ExpressionError("The expression must evaluate to a number, not a list or range.")
+    return result
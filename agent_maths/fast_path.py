@@ -0,0 +1,160 @@
+import re
+from typing import AsyncGenerator, Callable, Optional
+
+from google.adk.agents import BaseAgent
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event
+from google.adk.flows.llm_flows.functions import generate_client_function_call_id
+from google.genai import types
+
+from .agent import add, subtract, multiply, divide
+
+# Requests are only answered locally when they are short and their numbers small
+MAX_NUMBERS = 20
+MAX_NUMBER_DIGITS = 15
+
+_TOOLS: dict[str, Callable[[list[int]], object]] = {
+    "add": add,
+    "subtract": subtract,
+    "multiply": multiply,
+    "divide": divide,
+}
+_SYMBOLS = {"add": "+", "subtract": "-", "multiply": "×", "divide": "÷"}
+
+_NUMBER = rf"-?\d{{1,{MAX_NUMBER_DIGITS}}}"
+# "Please", "Hi," or "Can you" in front of the request, and "?", "." or "!" after it
+_PREFIX = r"(?:(?:hi|hello|please)[,!.]?\s+)?(?:(?:can|could|would)\s+you\s+)?(?:please\s+)?"
+_SUFFIX = r"\s*(?:please)?\s*[?.!]?"
+# Numbers separated by commas, spaces or "and"; multiplying and dividing also accept "by"
+_LIST_SEPARATOR = r"(?:\s*,\s*(?:and\s+)?|\s+and\s+|\s+)"
+_BY_SEPARATOR = r"(?:\s*,\s*(?:and\s+)?|\s+and\s+|\s+by\s+|\s+)"
+
+_PATTERNS = [
+    # "Subtract 10 from 20" is 20 - 10
+    ("subtract_from", re.compile(rf"^{_PREFIX}subtract\s+({_NUMBER})\s+from\s+({_NUMBER}){_SUFFIX}$", re.IGNORECASE)),
+    ("add", re.compile(rf"^{_PREFIX}add\s+((?:{_NUMBER}{_LIST_SEPARATOR})+{_NUMBER}){_SUFFIX}$", re.IGNORECASE)),
+    ("subtract", re.compile(rf"^{_PREFIX}subtract\s+((?:{_NUMBER}{_LIST_SEPARATOR})+{_NUMBER}){_SUFFIX}$", re.IGNORECASE)),
+    ("multiply", re.compile(rf"^{_PREFIX}multiply\s+((?:{_NUMBER}{_BY_SEPARATOR})+{_NUMBER}){_SUFFIX}$", re.IGNORECASE)),
+    ("divide", re.compile(rf"^{_PREFIX}divide\s+((?:{_NUMBER}{_BY_SEPARATOR})+{_NUMBER}){_SUFFIX}$", re.IGNORECASE)),
+]
+_NUMBERS = re.compile(_NUMBER)
+
+
+def parse_arithmetic(query: str) -> Optional[tuple[str, list[int]]]:
+    """Parses a plainly arithmetic request into a math tool and its numbers.
+
+    Only whole requests of the form "<operation> <numbers>" are recognized,
+    e.g. "Multiply 1 and 10", "Add 123 and 3 and 4", "Divide 10 by 2" or
+    "Subtract 10 from 20". Anything else (ranges, several steps, decimals,
+    extra words, a single number, division by zero) is ambiguous and returns
+    None, so the query can be left to the model.
+
+    Args:
+        query: The user's query.
+
+    Returns:
+        A (tool name, numbers) tuple, or None if the query is not plainly arithmetic.
+
+    Examples:
+        parse_arithmetic("Add 123 and 3 and 4") == ("add", [123, 3, 4])
+        parse_arithmetic("Subtract 10 from 20") == ("subtract", [20, 10])
+        parse_arithmetic("Multiply the numbers between 1 and 10") is None
+    """
+    query = query.strip()
+    for name, pattern in _PATTERNS:
+        match = pattern.match(query)
+        if not match:
+            continue
+        if name == "subtract_from":
+            name, numbers = "subtract", [int(match.group(2)), int(match.group(1))]
+        else:
+            numbers = [int(number) for number in _NUMBERS.findall(match.group(1))]
+        if len(numbers) > MAX_NUMBERS or (name == "divide" and 0 in numbers[1:]):
+            return None
+        return name, numbers
+    return None
+
+
+def _format_number(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_answer(name: str, numbers: list[int], result) -> str:
+    """Writes the answer of a fast-path calculation, e.g. "1 × 10 = 10"."""
+    expression = f" {_SYMBOLS[name]} ".join(f"({number})" if number < 0 else str(number) for number in numbers)
+    return f"The answer is {_format_number(result)}.\n\n{expression} = {_format_number(result)}"
+
+
+class FastPathAgent(BaseAgent):
+    """Answers plainly arithmetic queries locally and sends everything else to its sub-agent.
+
+    Queries recognized by `parse_arithmetic` are calculated with the math tools
+    of `agent_maths` without any model call. The agent then emits the same
+    events the math agent would: a function call, its function response and a
+    final text answer, authored by the agent in the sub-agent tree that owns the
+    tool. All other queries are handed to the only sub-agent unchanged.
+
+    A hit saves the two model calls of `agent_math`, or the four model calls
+    and the grammar check of `agent_teaching_assistant`.
+
+    Attributes:
+        hits: Number of queries answered locally.
+        misses: Number of queries passed to the sub-agent.
+
+    Examples:
+        agent = FastPathAgent(name="agent_math_fast_path", sub_agents=[agent_math])
+    """
+
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of the queries answered locally (0.0 before the first query)."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _tool_owner(self, tool_name: str) -> str:
+        """Returns the name of the agent that would have called a tool."""
+        pending = list(self.sub_agents)
+        while pending:
+            agent = pending.pop(0)
+            if any(getattr(tool, "__name__", getattr(tool, "name", None)) == tool_name
+                   for tool in getattr(agent, "tools", [])):
+                return agent.name
+            pending.extend(agent.sub_agents)
+        return self.name
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        if len(self.sub_agents) != 1:
+            raise ValueError(f"{self.name} needs exactly one sub-agent to fall back to.")
+
+        query = ""
+        if ctx.user_content and ctx.user_content.parts:
+            query = "".join(part.text for part in ctx.user_content.parts if part.text)
+        parsed = parse_arithmetic(query)
+        if parsed is None:
+            self.misses += 1
+            async for event in self.sub_agents[0].run_async(ctx):
+                yield event
+            return
+
+        self.hits += 1
+        name, numbers = parsed
+        result = _TOOLS[name](numbers)
+        author = self._tool_owner(name)
+        function_call_id = generate_client_function_call_id()
+
+        yield Event(invocation_id=ctx.invocation_id, author=author, branch=ctx.branch,
+                    content=types.Content(role="model", parts=[types.Part(function_call=types.FunctionCall(
+                        id=function_call_id, name=name, args={"numbers": numbers}))]))
+
+        response_part = types.Part.from_function_response(name=name, response={"result": result})
+        response_part.function_response.id = function_call_id
+        yield Event(invocation_id=ctx.invocation_id, author=author, branch=ctx.branch,
+                    content=types.Content(role="user", parts=[response_part]))
+
+        yield Event(invocation_id=ctx.invocation_id, author=author, branch=ctx.branch,
+                    content=types.Content(role="model", parts=[types.Part(text=format_answer(name, numbers, result))]))
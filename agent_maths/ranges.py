@@ -0,0 +1,101 @@
+import os
+import math
+
+# Largest product of a range the range tools compute, in bits (4,000,000 bits is
+# about 1.2 million digits, around a second of work). Such results never reach
+# the model in full, see compact_large_results.
+MAX_RANGE_PRODUCT_BITS = int(os.getenv("MATH_MAX_RANGE_PRODUCT_BITS", "4000000"))
+
+
+def range_length(start: int, end: int, step: int = 1) -> int:
+    """Returns the number of terms of the inclusive range start, start + step, ..., end."""
+    if step == 0:
+        raise ValueError("step must not be zero.")
+    if (step > 0 and start > end) or (step < 0 and start < end):
+        return 0
+    return (end - start) // step + 1
+
+
+def range_last(start: int, end: int, step: int = 1) -> int:
+    """Returns the last term of a non-empty inclusive range (end, or the last term before it)."""
+    return start + (range_length(start, end, step) - 1) * step
+
+
+def range_sum(start: int, end: int, step: int = 1) -> int:
+    """Returns the sum of an inclusive range with the arithmetic series formula."""
+    count = range_length(start, end, step)
+    last = start + (count - 1) * step
+    return count * (start + last) // 2
+
+
+def range_contains_zero(start: int, end: int, step: int = 1) -> bool:
+    """Whether zero is one of the terms of an inclusive range."""
+    count = range_length(start, end, step)
+    if count == 0:
+        return False
+    last = start + (count - 1) * step
+    return min(start, last) <= 0 <= max(start, last) and start % step == 0
+
+
+def _log2_progression_product(first: int, count: int, step: int) -> float:
+    """Returns log2 of the product of `count` positive terms first, first + step, ... (step > 0).
+
+    The product is step ** count * Γ(first / step + count) / Γ(first / step).
+    """
+    if count == 0:
+        return 0.0
+    if first > 10 ** 12 * step:
+        # The difference of two huge lgamma values would lose the precision it needs;
+        # the terms are then close enough to each other for the largest one to do
+        return count * (first + (count - 1) * step).bit_length()
+    x = first / step
+    return (count * math.log(step) + math.lgamma(x + count) - math.lgamma(x)) / math.log(2)
+
+
+def range_product_bits(start: int, end: int, step: int = 1) -> int:
+    """Returns an upper bound of the bit length of the product of an inclusive range, without computing it.
+
+    The bound is the sum of the logarithms of the terms, computed with
+    `math.lgamma`, plus a small margin for rounding: it is within a few bits
+    of the exact bit length. A product that contains zero has 0 bits.
+    """
+    count = range_length(start, end, step)
+    if count == 0:
+        return 1
+    if range_contains_zero(start, end, step):
+        return 0
+    last = start + (count - 1) * step
+    low, step = min(start, last), abs(step)
+    # The terms below zero (as absolute values) and above zero are two progressions
+    negative = min(count, -low // step + 1) if low < 0 else 0
+    bits = _log2_progression_product(low + negative * step, count - negative, step)
+    if negative:
+        bits += _log2_progression_product(-(low + (negative - 1) * step), negative, step)
+    return math.ceil(bits * (1 + 1e-12)) + 2
+
+
+def product_tree(start: int, count: int, step: int) -> int:
+    """Multiplies `count` terms of an arithmetic progression by splitting it in balanced halves.
+
+    Multiplying numbers of similar size keeps every big-integer multiplication
+    balanced, which is much faster than accumulating the product term by term.
+    """
+    if count <= 32:
+        return math.prod(range(start, start + count * step, step))
+    half = count // 2
+    return product_tree(start, half, step) * product_tree(start + half * step, count - half, step)
+
+
+def range_product(start: int, end: int, step: int = 1) -> int:
+    """Returns the product of an inclusive range (1 if the range is empty)."""
+    count = range_length(start, end, step)
+    if count == 0:
+        return 1
+    if range_contains_zero(start, end, step):
+        return 0
+    last = start + (count - 1) * step
+    low, high = min(start, last), max(start, last)
+    if abs(step) == 1 and low > 0:
+        # high! / (low - 1)!, computed by the C implementation of perm()
+        return math.perm(high, count)
+    return product_tree(start, count, step)
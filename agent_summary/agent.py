@@ -61,6 +61,28 @@ summary_instruction_prompt = """
         Now, take the inputs from agent_grammar and agent_math and generate the response for the student.
         """
 
+# The outputs of agent_grammar and agent_math as they are stored in the session
+# state. Appended to the prompts of a summary that does not read the conversation.
+# Every field is optional, so a missing one is left empty instead of failing.
+state_inputs_prompt = """
+
+        agent_grammar Output:
+        corrected_query: {corrected_query?}
+        grammar_explanation: {grammar_explanation?}
+        agent_math Output:
+        math_result: {math_result?}
+        calculation_steps: {calculation_steps?}
+        """
+
+# Used instead of summary_instruction_prompt when the question had no grammar
+# mistakes and the math result is a single number (see agent_teaching_assistant/pipelines.py)
+math_only_summary_instruction_prompt = """
+        You are agent_summary, a friendly, patient, and encouraging teaching assistant for a young student.
+        The student's question had no grammar mistakes, so do not talk about grammar.
+        In two or three short, warm sentences, give the student the math_result from agent_math
+        and encourage them to keep asking questions.
+        """
+
 #print("Model:" + MODEL)
 agent_summary = Agent(
     model=MODEL,
@@ -0,0 +1,18 @@
+from google.adk.agents import SequentialAgent
+
+from agent_maths.agent import agent_math
+from agent_grammar.agent import agent_grammar
+from agent_summary.agent import agent_summary
+
+from .pipelines import build_parallel_pipeline
+
+# The same pipeline chapter3 and chapter4 build in their __main__ blocks, exposed
+# as a module so that harnesses (benchmarks, servers) can import it directly
+agent_teaching_assistant = SequentialAgent(
+    name="agent_teaching_assistant",
+    description="This agent acts as a friendly teaching assistant, checking the grammar of kids' questions, performing math calculations using corrected or original text (if grammatically correct), and providing results or grammar feedback in a friendly tone.",
+    sub_agents=[agent_grammar, agent_math, agent_summary],
+)
+
+# Grammar and math side by side, then summary (see pipelines.py)
+agent_teaching_assistant_parallel = build_parallel_pipeline()
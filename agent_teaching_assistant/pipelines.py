@@ -0,0 +1,288 @@
+import os
+import re
+from typing import AsyncGenerator
+
+from google.adk.agents import BaseAgent, ParallelAgent, SequentialAgent
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event, EventActions
+from google.genai import types
+
+from agent_maths.agent import agent_math
+from agent_grammar.agent import agent_grammar
+from agent_summary.agent import (agent_summary, math_only_summary_instruction_prompt,
+                                 state_inputs_prompt, summary_instruction_prompt)
+
+# Whether agent_summary reads the structured results that agent_grammar and
+# agent_math leave in the session state, instead of the whole conversation
+STRUCTURED_HANDOFF = os.getenv("TEACHING_STRUCTURED_HANDOFF", "1") == "1"
+
+# Session state written by agent_grammar (save_grammar_state) and agent_math (save_math_state)
+HANDOFF_STATE_KEYS = ("corrected_query", "grammar_explanation", "grammar_errors",
+                      "math_result", "calculation_steps")
+
+# Whether the parallel pipeline re-runs agent_math when the grammar correction
+# changed the numbers or operators of the query
+MATH_RECHECK = os.getenv("TEACHING_MATH_RECHECK", "1") == "1"
+
+# How agent_summary runs when the grammar was clean and math returned a single number:
+# "full" always runs it, "short" uses a math-only prompt, "template" makes no model call
+SUMMARY_FULL = "full"
+SUMMARY_SHORT = "short"
+SUMMARY_TEMPLATE = "template"
+SUMMARY_MODE = os.getenv("TEACHING_SUMMARY_MODE", SUMMARY_FULL)
+
+TEMPLATE_ANSWER = ("Hi there! You asked your question perfectly, so there is nothing to fix. 😊\n\n"
+                   "The answer is: {result}.\n\n"
+                   "Great job asking your question and doing the math thinking! Keep asking questions! ✨")
+
+# Words and symbols that decide which calculation a query asks for, mapped to
+# the operation they stand for
+_OPERATORS = {
+    "add": "add", "adds": "add", "added": "add", "adding": "add", "addition": "add",
+    "plus": "add", "sum": "add", "total": "add", "+": "add",
+    "subtract": "subtract", "subtracts": "subtract", "subtracted": "subtract", "subtracting": "subtract",
+    "subtraction": "subtract", "minus": "subtract", "-": "subtract", "−": "subtract",
+    "multiply": "multiply", "multiplies": "multiply", "multiplied": "multiply", "multiplying": "multiply",
+    "multiplication": "multiply", "times": "multiply", "product": "multiply",
+    "*": "multiply", "×": "multiply", "x": "multiply",
+    "divide": "divide", "divides": "divide", "divided": "divide", "dividing": "divide",
+    "division": "divide", "over": "divide", "/": "divide", "÷": "divide",
+    "between": "range",
+}
+_TOKEN_PATTERN = re.compile(r"\d+(?:\.\d+)?|[a-z]+|[+\-−*×/÷]")
+
+
+def arithmetic_signature(text: str) -> list[str]:
+    """Returns the numbers and operators of a query, in order.
+
+    Two texts with the same signature ask for the same calculation, however
+    differently the rest of their words are spelled.
+
+    Examples:
+        arithmetic_signature("Could she help me to multiply all the numbers between 1 and 10?")
+            == ["multiply", "range", "1", "10"]
+    """
+    return [_OPERATORS.get(token, token) for token in _TOKEN_PATTERN.findall(text.lower())
+            if token in _OPERATORS or token[0].isdigit()]
+
+
+def query_text(ctx: InvocationContext) -> str:
+    """Returns the text of the user's query of an invocation."""
+    if not ctx.user_content or not ctx.user_content.parts:
+        return ""
+    return "".join(part.text for part in ctx.user_content.parts if part.text)
+
+
+def reset_handoff_state(callback_context: CallbackContext) -> None:
+    """Clears the hand-off state left by the previous query of the session.
+
+    Used as the `before_agent_callback` of the pipelines, so a stage that
+    produces no result this time cannot pass on the result of the last query.
+    The keys are emptied rather than removed, since the state has no delete.
+    """
+    for key in HANDOFF_STATE_KEYS:
+        if callback_context.state.get(key, "") != "":
+            callback_context.state[key] = ""
+    return None
+
+
+class MathRecheckAgent(BaseAgent):
+    """Re-runs the math agent on the corrected query when grammar changed the calculation.
+
+    It runs after a stage in which grammar and math ran side by side, so math
+    worked on the original query. If the "corrected_query" that agent_grammar
+    left in the session state has different numbers or operators (see
+    `arithmetic_signature`), the only sub-agent, a math agent whose instruction
+    reads the corrected query from the state, runs again. Otherwise nothing
+    happens and the first math result stands.
+
+    Before the re-run, "math_result" and "calculation_steps" are emptied, so
+    the steps of the first run are not passed on with those of the re-run and
+    a re-run that calls no tool leaves no stale result.
+
+    Attributes:
+        enabled: Whether to re-run math at all.
+        rechecks: Number of times math was re-run.
+    """
+
+    enabled: bool = True
+    rechecks: int = 0
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        if not self.enabled:
+            return
+        corrected = ctx.session.state.get("corrected_query")
+        if not corrected or arithmetic_signature(corrected) == arithmetic_signature(query_text(ctx)):
+            return
+
+        self.rechecks += 1
+        # Its own branch hides the first math run from the re-run
+        branch = f"{ctx.branch}.{self.name}" if ctx.branch else self.name
+        yield Event(invocation_id=ctx.invocation_id, author=self.name, branch=branch,
+                    actions=EventActions(state_delta={"math_result": "", "calculation_steps": ""}))
+        async for event in self.sub_agents[0].run_async(ctx.model_copy(update={"branch": branch})):
+            yield event
+
+
+def _single_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _format_number(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class SummaryGateAgent(BaseAgent):
+    """Runs the summary only when there is something to explain.
+
+    After grammar and math, their structured results in the session state are
+    checked. If `check_grammar` found no errors and the math tool returned a
+    single number, there is no grammar feedback to give and the summary would
+    only restate the number, so depending on `mode` it is replaced:
+
+    - "template": a templated answer with the number, with no model call.
+    - "short": the second sub-agent, a summary with a short math-only prompt.
+    - "full": the first sub-agent, the full summary, as for any other query.
+
+    Attributes:
+        mode: One of "full", "short" or "template".
+        full_summaries: Number of queries that got the full summary.
+        short_summaries: Number of queries that got the short summary.
+        templated: Number of queries answered with the template.
+    """
+
+    mode: str = SUMMARY_TEMPLATE
+    full_summaries: int = 0
+    short_summaries: int = 0
+    templated: int = 0
+
+    def model_post_init(self, __context) -> None:
+        super().model_post_init(__context)
+        if self.mode not in (SUMMARY_FULL, SUMMARY_SHORT, SUMMARY_TEMPLATE):
+            raise ValueError(f"Unknown summary mode: {self.mode}")
+        if self.mode == SUMMARY_SHORT and len(self.sub_agents) < 2:
+            raise ValueError("The short summary mode needs a second sub-agent with the short prompt.")
+
+    def _math_result(self, ctx: InvocationContext):
+        """Returns the single number math returned when grammar was clean, otherwise None."""
+        state = ctx.session.state
+        if not isinstance(state.get("corrected_query"), str) or state.get("grammar_errors") != []:
+            return None
+        result = state.get("math_result")
+        return result if _single_number(result) else None
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        result = self._math_result(ctx) if self.mode != SUMMARY_FULL else None
+        if result is None:
+            self.full_summaries += 1
+            summary = self.sub_agents[0]
+        elif self.mode == SUMMARY_SHORT:
+            self.short_summaries += 1
+            summary = self.sub_agents[1]
+        else:
+            self.templated += 1
+            text = TEMPLATE_ANSWER.format(result=_format_number(result))
+            yield Event(invocation_id=ctx.invocation_id, author=self.sub_agents[0].name, branch=ctx.branch,
+                        content=types.Content(role="model", parts=[types.Part(text=text)]))
+            return
+        async for event in summary.run_async(ctx):
+            yield event
+
+
+def _summary(instruction: str, structured: bool) -> BaseAgent:
+    """Copies agent_summary with an instruction, reading either the state fields or the conversation."""
+    if not structured:
+        return _copy(agent_summary, instruction=instruction)
+    # include_contents="none" leaves the whole transcript, tool calls included, out of the request
+    return _copy(agent_summary, instruction=instruction + state_inputs_prompt, include_contents="none")
+
+
+def summary_stage(mode: str = SUMMARY_MODE, structured: bool = STRUCTURED_HANDOFF) -> BaseAgent:
+    """Returns the last stage of a teaching pipeline: `agent_summary`, gated unless mode is "full".
+
+    Args:
+        mode: "full", "short" or "template", see `SummaryGateAgent`.
+        structured: Whether the summary gets only the hand-off state fields
+                    (see `HANDOFF_STATE_KEYS`) instead of the conversation.
+    """
+    full_summary = _summary(summary_instruction_prompt, structured)
+    if mode == SUMMARY_FULL:
+        return full_summary
+    sub_agents = [full_summary]
+    if mode == SUMMARY_SHORT:
+        sub_agents.append(_summary(math_only_summary_instruction_prompt, structured))
+    return SummaryGateAgent(name="summary_gate", mode=mode, sub_agents=sub_agents)
+
+
+def _copy(agent: BaseAgent, **update) -> BaseAgent:
+    """Copies an agent so that it can be used in another pipeline (an agent has only one parent)."""
+    return agent.model_copy(update={"parent_agent": None, **update})
+
+
+def build_sequential_pipeline(name: str = "agent_teaching_assistant",
+                              summary_mode: str = SUMMARY_MODE,
+                              structured_handoff: bool = STRUCTURED_HANDOFF) -> SequentialAgent:
+    """Builds the sequential teaching assistant (grammar, math, summary) with a summary mode.
+
+    Args:
+        name: The name of the root agent.
+        summary_mode: How to summarize when grammar was clean and math returned a
+                      single number, see `SummaryGateAgent`.
+        structured_handoff: Whether the summary gets only the grammar and math
+                            results from the session state instead of the conversation.
+
+    Returns:
+        The root agent of the pipeline, built from copies of the chapter agents.
+    """
+    return SequentialAgent(
+        name=name,
+        description="This agent acts as a friendly teaching assistant, checking the grammar of kids' questions, performing math calculations using corrected or original text (if grammatically correct), and providing results or grammar feedback in a friendly tone.",
+        sub_agents=[_copy(agent_grammar), _copy(agent_math), summary_stage(summary_mode, structured_handoff)],
+        before_agent_callback=reset_handoff_state,
+    )
+
+
+def build_parallel_pipeline(name: str = "agent_teaching_assistant_parallel",
+                            recheck_math: bool = MATH_RECHECK,
+                            summary_mode: str = SUMMARY_MODE,
+                            structured_handoff: bool = STRUCTURED_HANDOFF) -> SequentialAgent:
+    """Builds a teaching assistant that checks grammar and calculates at the same time.
+
+    The sequential pipeline runs grammar, math and summary one after the other.
+    Since math rarely depends on the grammar correction, this pipeline runs
+    grammar and math in a ParallelAgent, then summary, so the latency is
+    max(grammar, math) + summary instead of grammar + math + summary. If the
+    correction changed the numbers or operators, math is re-run on the
+    corrected query before summary (see `MathRecheckAgent`).
+
+    Args:
+        name: The name of the root agent.
+        recheck_math: Whether to re-run math when the correction changed the calculation.
+        summary_mode: How to summarize when grammar was clean and math returned a
+                      single number, see `SummaryGateAgent`.
+        structured_handoff: Whether the summary gets only the grammar and math
+                            results from the session state instead of the conversation.
+
+    Returns:
+        The root agent of the pipeline. It uses copies of `agent_grammar`,
+        `agent_math` and `agent_summary`, so it can be used next to the sequential pipeline.
+    """
+    math_recheck = _copy(agent_math, instruction=agent_math.instruction + """
+      The question was corrected for grammar and now reads: "{corrected_query?}".
+      Solve the corrected question.
+    """)
+    return SequentialAgent(
+        name=name,
+        description=("This agent acts as a friendly teaching assistant, checking the grammar of kids' questions "
+                     "while performing their math calculations, and providing results and grammar feedback "
+                     "in a friendly tone."),
+        sub_agents=[
+            ParallelAgent(name="grammar_and_math", sub_agents=[_copy(agent_grammar), _copy(agent_math)]),
+            MathRecheckAgent(name="math_recheck", enabled=recheck_math, sub_agents=[math_recheck]),
+            summary_stage(summary_mode, structured_handoff),
+        ],
+        before_agent_callback=reset_handoff_state,
+    )
@@ -9,6 +9,8 @@ from google.adk.runners import Runner
 from google.adk.sessions import InMemorySessionService
 from google.genai import types
 
+from harness.query import send_queries
+
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -32,7 +34,8 @@ async def send_query_to_agent(agent, query, user_id="user", session_id="user_ses
     """
 
     # Create a new session - if you want to keep the history of interruction you need to move the 
-    # creation of the session outside of this function. Here we create a new session per query
+    # creation of the session outside of this function. Here we create a new session per query.
+    # In long conversations, harness/history.py keeps the resent history to the last turns and a summary
     session = await session_service.create_session(app_name=AGENT_APP_NAME,
                                                    user_id=user_id,
                                                    session_id=session_id)
@@ -89,12 +92,13 @@ if __name__ == '__main__':
     # Send a single query to the agent
     asyncio.run(send_query_to_agent(basic_agent, "Hi, how are you?"))
 
-    # Example of sending multiple queries to the agent (commented out)
+    # Example of sending multiple queries to the agent (commented out).
+    # send_queries reuses one Runner and runs the queries concurrently, each in its own session
     # queries = [
     #     "Hi, I am Tom",
     #     "Could you let me know what you could do for me?",
     #     "How were you built?",
     # ]
 
-    # for query in queries:
-    #     asyncio.run(send_query_to_agent(basic_agent, query))
+    # for result in asyncio.run(send_queries(basic_agent, queries, concurrency=3)):
+    #     print(f'{result.latency_ms} ms | {result.query} -> {result.response}')
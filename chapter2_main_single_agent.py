@@ -9,6 +9,7 @@ from google.adk.sessions import InMemorySessionService
 from google.genai import types
 
 from agent_maths.agent import agent_math
+from harness.query import send_queries
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -102,12 +103,12 @@ if __name__ == '__main__':
     asyncio.run(send_query_to_agent(agent_math, "First multiply numbers 1 to 3 and then add 4"))
     #send_query_to_agent(agent_math, "How much is 1 and 2 and 3?")
 
-    # Send multiple queries against the basic agent
+    # Send multiple queries concurrently against the math agent
     # queries = [
     #     "Multiply 1 and 10",
     #     "Add 123 and 3 and 4",
     #     "Multiply the numbers between 1 and 10",
     # ]
 
-    # for query in queries:
-    #     asyncio.run(send_query_to_agent(agent_math, query))
+    # for result in asyncio.run(send_queries(agent_math, queries, concurrency=3)):
+    #     print(f'{result.latency_ms} ms | {result.query} -> {result.response}')
@@ -4,15 +4,22 @@ import asyncio
 
 from google.adk.agents import Agent
 from google.adk.agents import SequentialAgent
-from google.adk.artifacts import InMemoryArtifactService
+from google.adk.agents.run_config import RunConfig, StreamingMode
 from google.adk.runners import Runner
-from google.adk.sessions import InMemorySessionService
 from google.genai import types
 from google.adk.tools.agent_tool import AgentTool
 
 from agent_maths.agent import agent_math
 from agent_grammar.agent import agent_grammar
 from agent_summary.agent import agent_summary
+from harness.query import send_conversation, send_queries
+from harness.history import HistoryPolicy, apply_history
+from harness.deadlines import DeadlinePolicy, install_deadlines
+from harness.response_cache import ResponseCache, run_cached
+from harness.bounded_services import BoundedInMemoryArtifactService, BoundedInMemorySessionService
+from harness.sqlite_sessions import SqliteSessionService
+from harness.tracing import Tracer, export_chrome_trace, format_trace, instrument
+from harness.usage import format_usage_report, usage_report
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -21,15 +28,27 @@ load_dotenv()
 MODEL = os.getenv("MODEL", "gemini-2.0-flash-001") # The model ID for the agent
 AGENT_APP_NAME = 'multi_agent'
 
-session_service = InMemorySessionService()
-artifact_service = InMemoryArtifactService()
+# Sessions are kept in memory, within the SESSION_* limits of the .env file, unless
+# SESSION_DB names a SQLite file, which keeps them across restarts and lets several
+# worker processes share them
+artifact_service = BoundedInMemoryArtifactService()
+session_service = (SqliteSessionService(os.getenv("SESSION_DB")) if os.getenv("SESSION_DB")
+                   else BoundedInMemorySessionService(on_evict=artifact_service.delete_session_artifacts))
 
-async def send_query_to_agent(agent, query, user_id="user", session_id="user_session"):
+async def send_query_to_agent(agent, query, user_id="user", session_id="user_session", response_cache=None,
+                              stream=False, deadline_s=None):
     """Sends a query to the specified agent and prints the response.
 
         Args:
             agent: The agent to send the query to.
             query: The query to send to the agent.
+            response_cache: Optional ResponseCache. A repeated query is answered by
+                            replaying the events of its earlier run.
+            stream: If True, the model answers are streamed and printed as they
+                    arrive, and the time to first and last token of every agent is printed.
+            deadline_s: Optional deadline of the query in seconds. When it expires, the
+                        agents are cancelled and the answer is what they wrote so far,
+                        or a fallback answer, authored "deadline".
 
         Returns:
             A tuple containing the elapsed time (in milliseconds) and the final response from the agent.
@@ -51,11 +70,23 @@ async def send_query_to_agent(agent, query, user_id="user", session_id="user_ses
     runner = Runner(app_name=AGENT_APP_NAME, agent=agent, artifact_service=artifact_service, session_service=session_service)
     # Alternatively you can use InMemoryRunner
 
+    # With SSE streaming the model answers arrive as partial events before the final response
+    run_config = RunConfig(streaming_mode=StreamingMode.SSE if stream else StreamingMode.NONE)
+
     # Run the interaction with the agent and get a stream of events
-    events = runner.run_async(user_id=user_id, session_id=session_id, new_message=content)
+    if response_cache is not None:
+        events = run_cached(runner, response_cache, user_id, session_id, content, run_config=run_config)
+    else:
+        events = runner.run_async(user_id=user_id, session_id=session_id, new_message=content, run_config=run_config)
+    if deadline_s:
+        events = DeadlinePolicy(timeout_s=deadline_s).run(events)
 
     final_response = None
     elapsed_time_ms = 0.0
+    # Time to first and last token of every agent (milliseconds)
+    first_token_ms = {}
+    last_token_ms = {}
+    streaming_author = None
 
     # Loop through the events returned by the runner
     async for event in events:
@@ -67,14 +98,38 @@ async def send_query_to_agent(agent, query, user_id="user", session_id="user_ses
         if not event.content:
              continue
 
+        if event.content.parts and event.content.parts[0].text:
+            token_time_ms = round((time.time() - start_time) * 1000, 3)
+            first_token_ms.setdefault(event.author, token_time_ms)
+            last_token_ms[event.author] = token_time_ms
+
+        if event.partial:
+            # Print the partial text as it arrives
+            if streaming_author != event.author:
+                print("-----------------------------")
+                print('>>> Streaming response <<<')
+                print("-----------------------------")
+                print(f'Agent: {event.author}')
+                streaming_author = event.author
+            print(event.content.parts[0].text or "", end="", flush=True)
+            continue
+
         if is_final_response:
             end_time = time.time()
             elapsed_time_ms = round((end_time - start_time) * 1000, 3)
+            final_response = event.content.parts[0].text # Get the final response from the agent
+
+            if streaming_author == event.author:
+                # The text was already printed while it was streamed
+                streaming_author = None
+                print(f'\n\nResponse time: {elapsed_time_ms} ms')
+                print(f'Time to first token: {first_token_ms[event.author]} ms')
+                print("----------------------------------------------------------\n")
+                continue
 
             print("-----------------------------")
             print('>>> Inside final response <<<')
             print("-----------------------------")
-            final_response = event.content.parts[0].text # Get the final response from the agent
             print(f'Agent: {event.author}')
             print(f'Response time: {elapsed_time_ms} ms\n')
             print(f'Final Response:\n{final_response}')
@@ -98,6 +153,10 @@ async def send_query_to_agent(agent, query, user_id="user", session_id="user_ses
                     print(f'Function Name: {function_response.name}')
                     print(f'Function Results: {function_response.response}')
 
+    if stream:
+        for author in first_token_ms:
+            print(f'{author}: first token {first_token_ms[author]} ms, last token {last_token_ms[author]} ms')
+
     return elapsed_time_ms, final_response
 
 if __name__ == '__main__':
@@ -110,12 +169,46 @@ if __name__ == '__main__':
 
     asyncio.run(send_query_to_agent(agent_teaching_assistant, "Hi teacher. Could she help me to multiply all the numbers between 1 and 10?"))
 
-    # Send multiple queries against the basic agent
+    # Send multiple queries concurrently against the teaching assistant
     #queries = [
     #    "Multiply 1 and 10",
     #    "Add 123 and 3 and 4",
     #    "Multiply the numbers between 1 and 10",
     #]
 
-    #for query in queries:
-    #    asyncio.run(send_query_to_agent(agent_math, query))
+    #for result in asyncio.run(send_queries(agent_teaching_assistant, queries, concurrency=3)):
+    #    print(f'{result.latency_ms} ms | {result.query} -> {result.response}')
+
+    # Hold one long conversation in a single session. The history policy keeps the last turns verbatim and
+    # folds older ones into a rolling summary in the background, so the prompt of every turn stays bounded
+    #history = HistoryPolicy(keep_turns=6, summarize_every=4)
+    #apply_history(agent_teaching_assistant, history)
+    #for result in asyncio.run(send_conversation(agent_teaching_assistant, queries * 20)):
+    #    print(f'{result.latency_ms} ms | {sum(result.input_tokens.values())} input tokens | {result.query}')
+
+    # Answer repeated questions from a cache (add db_path="responses.sqlite3" to keep it across runs)
+    #response_cache = ResponseCache()
+    #for session_id in ["session_1", "session_2"]:
+    #    asyncio.run(send_query_to_agent(agent_teaching_assistant, "Multiply 1 and 10", session_id=session_id,
+    #                                    response_cache=response_cache))
+
+    # Stream the answers and print the time to first and last token of every agent
+    #asyncio.run(send_query_to_agent(agent_teaching_assistant, "Multiply 1 and 10", session_id="user_session_stream",
+    #                                stream=True))
+
+    # Give up on a query after 2 seconds and answer with what the agents wrote so far. install_deadlines
+    # bounds every model and tool call by the deadline too, and tells at which stage time ran out
+    #install_deadlines(agent_teaching_assistant)
+    #asyncio.run(send_query_to_agent(agent_teaching_assistant, "Multiply 1 and 10", session_id="user_session_deadline",
+    #                                deadline_s=2))
+
+    # Break a query down into agent turns, model calls and tool calls (open trace.json in https://ui.perfetto.dev)
+    #tracer = Tracer()
+    #instrument(agent_teaching_assistant, tracer)
+    #asyncio.run(send_query_to_agent(agent_teaching_assistant, "Multiply 1 and 10", session_id="user_session_trace"))
+    #for spans in tracer.traces().values():
+    #    print(format_trace(spans))
+    #export_chrome_trace(tracer, "trace.json")
+
+    # Tokens, estimated cost and tokens/sec of the traced queries by agent, model and tool
+    #print(format_usage_report(usage_report(tracer)))
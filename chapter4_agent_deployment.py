@@ -168,6 +168,58 @@ def parse_event_content(event: dict) -> list:
 
     return results
 
+def consume_event_stream(events, start_time: float) -> dict:
+    """
+    Consumes the events of stream_query, printing partial text as it arrives,
+    and measures the time to first and last token of every agent.
+
+    With streaming_mode "sse" an agent's answer arrives as partial events with
+    chunks of text, followed by one event with the whole text, which is not
+    printed again. Other events are printed with parse_event_content.
+
+    Args:
+        events: The events returned by stream_query (dictionaries).
+        start_time: time.time() when the query was sent.
+
+    Returns:
+        A dictionary keyed by agent name. Each value is a dictionary with
+        'first_token_ms' and 'last_token_ms', in milliseconds since start_time.
+    """
+    timings = {}
+    streaming_author = None
+
+    for event in events:
+        author = event.get('author')
+        content = event.get('content') if isinstance(event.get('content'), dict) else {}
+        parts = content.get('parts') if isinstance(content.get('parts'), list) else []
+        text = "".join(part['text'] for part in parts if isinstance(part, dict) and part.get('text'))
+
+        if text:
+            token_time_ms = round((time.time() - start_time) * 1000, 3)
+            timing = timings.setdefault(author, {'first_token_ms': token_time_ms})
+            timing['last_token_ms'] = token_time_ms
+
+        if event.get('partial'):
+            # Print the chunk as soon as it arrives
+            if streaming_author != author:
+                print("-----------------------------")
+                print('>>> Streaming response <<<')
+                print("-----------------------------")
+                print(f'Agent: {author}')
+                streaming_author = author
+            print(text, end="", flush=True)
+            continue
+
+        if text and streaming_author == author:
+            # The whole text of an answer that was already printed chunk by chunk
+            streaming_author = None
+            print()
+            continue
+
+        parse_event_content(event)
+
+    return timings
+
 
 if __name__ == '__main__':
 
@@ -228,14 +280,23 @@ if __name__ == '__main__':
     print('>>>> Interact with Agent <<<<')
     print("-----------------------------")
     start_time = time.time()
-    
-    events = deployed_agent.stream_query(user_id=user_id, session_id=session_id,message="Hi teacher. Could she help me to multiply all the numbers between 1 and 10?",)
-    
+
+    # "sse" streams the answers of the agents as partial events
+    events = deployed_agent.stream_query(user_id=user_id, session_id=session_id,message="Hi teacher. Could she help me to multiply all the numbers between 1 and 10?",
+                                         run_config={"streaming_mode": "sse"},)
+
+    # stream_query returns a generator, so the query only runs while the events are consumed
+    timings = consume_event_stream(events, start_time)
+
     end_time = time.time()
     elapsed_time_ms = round((end_time - start_time) * 1000, 3)
 
-    for event in events:
-        parse_event_content(event)
+    print("-----------------------------")
+    print('>>>>>>  Response times  <<<<<<')
+    print("-----------------------------")
+    for author, timing in timings.items():
+        print(f"{author}: first token {timing['first_token_ms']} ms, last token {timing['last_token_ms']} ms")
+    print(f"Total: {elapsed_time_ms} ms")
 
     if(IS_REMOTE_DEPLOYMENT == 1):
         print("-----------------------------")
@@ -0,0 +1,84 @@
+import weakref
+from typing import Callable, Iterator, TypeVar
+
+from google.adk.agents import BaseAgent, LlmAgent
+from google.adk.models.base_llm import BaseLlm
+
+T = TypeVar("T")
+
+# The objects installed on each agent (see record_installed), by id() of the agent.
+# Agents are not hashable; the weak reference drops the entry with its agent.
+_installed: dict[int, tuple[weakref.ref, list]] = {}
+
+
+def iter_agents(agent: BaseAgent) -> Iterator[BaseAgent]:
+    """Yields an agent and all of its sub-agents, depth first."""
+    yield agent
+    for sub_agent in agent.sub_agents:
+        yield from iter_agents(sub_agent)
+
+
+def iter_llm_agents(agent: BaseAgent) -> Iterator[LlmAgent]:
+    """Yields every LLM agent (the agents that call a model) in an agent tree."""
+    for node in iter_agents(agent):
+        if isinstance(node, LlmAgent):
+            yield node
+
+
+def set_models(agent: BaseAgent, factory: Callable[[LlmAgent], BaseLlm]) -> None:
+    """Replaces the model of every LLM agent in an agent tree.
+
+    Args:
+        agent: The root of the agent tree.
+        factory: Called with each LLM agent and returns the model to install.
+                 The agent's current model is available as `canonical_model`,
+                 which lets the factory wrap it instead of replacing it.
+
+    Examples:
+        set_models(agent_teaching_assistant, lambda agent: FakeLlm(latency_ms=50))
+    """
+    for llm_agent in iter_llm_agents(agent):
+        llm_agent.model = factory(llm_agent)
+
+
+def prepend_callback(callbacks, callback) -> list:
+    """Puts a callback first in a list of agent callbacks, so that no other callback can skip it by returning a value.
+
+    Args:
+        callbacks: The current callbacks: None, one callable or a list.
+        callback: The callback to put first. It is not added twice.
+
+    Returns:
+        The new list of callbacks.
+    """
+    if callbacks is None:
+        callbacks = []
+    elif not isinstance(callbacks, list):
+        callbacks = [callbacks]
+    return [callback] + [existing for existing in callbacks if existing != callback]
+
+
+def record_installed(agent: BaseAgent, installed_object) -> None:
+    """Records that an object (a tracer, a history policy...) was installed on an agent.
+
+    Code that has to find it later looks it up with `installed`, rather than
+    guessing it from the agent's callbacks.
+    """
+    key = id(agent)
+    entry = _installed.get(key)
+    if entry is None or entry[0]() is not agent:
+        def forget(ref: weakref.ref) -> None:
+            if _installed.get(key, (None,))[0] is ref:
+                del _installed[key]
+        entry = (weakref.ref(agent, forget), [])
+        _installed[key] = entry
+    if not any(existing is installed_object for existing in entry[1]):
+        entry[1].append(installed_object)
+
+
+def installed(agent: BaseAgent, kind: type[T]) -> list[T]:
+    """Returns the objects of a type recorded on an agent with `record_installed`, in the order they were installed."""
+    entry = _installed.get(id(agent))
+    if entry is None or entry[0]() is not agent:
+        return []
+    return [installed_object for installed_object in entry[1] if isinstance(installed_object, kind)]
@@ -0,0 +1,329 @@
+import sys
+import math
+import json
+import time
+import asyncio
+import argparse
+import resource
+from typing import Optional
+
+from google.adk.agents import Agent
+from google.genai import types
+
+from harness.agent_tree import set_models
+from harness.fake_llm import FakeLlm, FakeGenaiClient
+from harness.query import default_session_service, send_queries
+from harness.rate_limit import RateLimiter, install_rate_limiter
+from harness.hedging import HedgePolicy, install_hedging
+from harness.deadlines import DeadlinePolicy, install_deadlines
+from harness.response_cache import ResponseCache
+from harness.sqlite_sessions import SqliteSessionService
+from harness.tracing import Tracer, export_chrome_trace, export_jsonl, format_trace, instrument
+from harness.usage import export_usage_report, format_usage_report, usage_report
+
+# Queries taken from the examples of each chapter
+CORPORA = {
+    "basic": [
+        "Hi, how are you?",
+        "Hi, I am Tom",
+        "Could you let me know what you could do for me?",
+        "How were you built?",
+    ],
+    "math": [
+        "First multiply numbers 1 to 3 and then add 4",
+        "Multiply 1 and 10",
+        "Add 123 and 3 and 4",
+        "Multiply the numbers between 1 and 10",
+    ],
+    "teaching": [
+        "Hi teacher. Could she help me to multiply all the numbers between 1 and 10?",
+        "Multiply 1 and 10",
+        "Add 123 and 3 and 4",
+        "Multiply the numbers between 1 and 10",
+    ],
+}
+CORPORA["grammar"] = CORPORA["teaching"]
+CORPORA["teaching_parallel"] = CORPORA["teaching"]
+
+SUMMARY_ANSWER = ("Hi there! That's a great question you asked! The answer is right above. "
+                  "Great job asking your question and doing the math thinking!")
+
+
+def build_basic_agent() -> Agent:
+    """Builds the basic agent of chapter1."""
+    return Agent(model="gemini-2.0-flash",
+        name="agent_basic",
+        description="This agent responds to inquiries about its creation by stating it was built using the Google Agent Development Kit.",
+        instruction="If they ask you how you were created, tell them you were created with the Google Agent Development Kit.",
+        generate_content_config=types.GenerateContentConfig(temperature=0.2),
+    )
+
+
+def load_pipeline(name: str, summary_mode: str = "full", structured_handoff: bool = False):
+    """Returns the root agent of a benchmarked pipeline.
+
+    The sequential teaching pipeline is the one of chapter3 unless `summary_mode`
+    or `structured_handoff` ask for a variant. The parallel one is always built
+    with them (see agent_teaching_assistant/pipelines.py).
+    """
+    if name == "basic":
+        return build_basic_agent()
+    if name == "math":
+        from agent_maths.agent import agent_math
+        return agent_math
+    if name == "grammar":
+        from agent_grammar.agent import agent_grammar
+        return agent_grammar
+    if name == "teaching":
+        if summary_mode != "full" or structured_handoff:
+            from agent_teaching_assistant.pipelines import build_sequential_pipeline
+            return build_sequential_pipeline(summary_mode=summary_mode, structured_handoff=structured_handoff)
+        from agent_teaching_assistant.agent import agent_teaching_assistant
+        return agent_teaching_assistant
+    if name == "teaching_parallel":
+        from agent_teaching_assistant.pipelines import build_parallel_pipeline
+        return build_parallel_pipeline(summary_mode=summary_mode, structured_handoff=structured_handoff)
+    raise ValueError(f"Unknown pipeline: {name}")
+
+
+def install_fake_models(agent, latency_ms: float, jitter_ms: float = 0.0, tool_latency_ms: float = 0.0,
+                        chunk_latency_ms: float = 0.0, error_rate: float = 0.0, slow_rate: float = 0.0,
+                        slow_ms: float = 0.0) -> None:
+    """Replaces every model of a pipeline, and the Gemini client of `check_grammar`, with fakes.
+
+    The fake models keep the name of the model they stand in for, so the usage
+    report can price them. `error_rate` is the fraction of calls that fail with
+    a 429, and `slow_rate` the fraction of calls that take `slow_ms` longer.
+    """
+    from agent_grammar import agent as grammar_module
+
+    set_models(agent, lambda llm_agent: FakeLlm(model=llm_agent.canonical_model.model,
+                                                latency_ms=latency_ms,
+                                                jitter_ms=jitter_ms,
+                                                chunk_latency_ms=chunk_latency_ms,
+                                                error_rate=error_rate,
+                                                slow_rate=slow_rate,
+                                                slow_ms=slow_ms,
+                                                answers={"agent_summary": SUMMARY_ANSWER}))
+    grammar_client = FakeGenaiClient(latency_ms=tool_latency_ms, jitter_ms=jitter_ms, error_rate=error_rate,
+                                     slow_rate=slow_rate, slow_ms=slow_ms)
+    grammar_module.set_client_factory(lambda: grammar_client)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Returns the nearest-rank percentile of a list of values (0.0 if empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+async def run_benchmark(pipeline: str, num_queries: int, concurrency: int,
+                        latency_ms: float, jitter_ms: float = 0.0, tool_latency_ms: float = 0.0,
+                        fast_path: bool = False, summary_mode: str = "full",
+                        structured_handoff: bool = False, response_cache: bool = False,
+                        stream: bool = False, chunk_latency_ms: float = 0.0,
+                        trace_path: Optional[str] = None, usage_path: Optional[str] = None,
+                        session_db: Optional[str] = None, error_rate: float = 0.0,
+                        rate_limit: bool = False, slow_rate: float = 0.0, slow_ms: float = 0.0,
+                        hedge: bool = False, deadline_ms: Optional[float] = None) -> dict:
+    """Runs a pipeline against the fake model and returns the latency report.
+
+    Args:
+        pipeline: One of "basic", "math", "grammar", "teaching" or "teaching_parallel".
+        num_queries: Number of queries to send. The corpus of the pipeline is repeated as needed.
+        concurrency: Maximum number of queries in flight.
+        latency_ms: Simulated latency of every agent model call.
+        jitter_ms: Maximum random latency added to every model call.
+        tool_latency_ms: Simulated latency of the Gemini call inside `check_grammar`.
+        fast_path: Whether to put the arithmetic fast path (`agent_maths/fast_path.py`)
+                   in front of the pipeline.
+        summary_mode: "full", "short" or "template": how the teaching pipelines
+                      summarize queries without grammar errors and a single number result.
+        structured_handoff: Whether the teaching pipelines hand the grammar and
+                            math results to the summary through the session state.
+        response_cache: Whether to answer repeated queries from a response cache
+                        (see `harness/response_cache.py`).
+        stream: Whether the models stream their answers.
+        chunk_latency_ms: Simulated generation time of every chunk of a text answer.
+        trace_path: If given, the spans of every agent turn, model call and tool call
+                    are written to this file: a Chrome trace if it ends with ".json",
+                    otherwise JSONL (see `harness/tracing.py`).
+        usage_path: If given, the token and cost report of the batch, with the
+                    totals of every query, is written to this file as JSON
+                    (see `harness/usage.py`).
+        session_db: If given, sessions are kept in this SQLite database
+                    (see `harness/sqlite_sessions.py`) instead of in memory.
+        error_rate: Fraction of the model and `check_grammar` calls that fail with a 429.
+        rate_limit: Whether to send the model calls through a `RateLimiter`
+                    (see `harness/rate_limit.py`), which retries the failed ones.
+        slow_rate: Fraction of the model and `check_grammar` calls that take `slow_ms` longer.
+        slow_ms: Extra latency of the slow calls.
+        hedge: Whether to hedge slow model calls with a `HedgePolicy` (see `harness/hedging.py`).
+        deadline_ms: If given, every query is cut short after this many milliseconds
+                     and answered with a partial or fallback answer (see `harness/deadlines.py`).
+
+    Returns:
+        A dictionary with the latency percentiles, throughput and peak memory of the run.
+    """
+    agent = load_pipeline(pipeline, summary_mode, structured_handoff)
+    install_fake_models(agent, latency_ms, jitter_ms, tool_latency_ms, chunk_latency_ms, error_rate,
+                        slow_rate, slow_ms)
+    limiter = None
+    if rate_limit:
+        limiter = RateLimiter()
+        install_rate_limiter(agent, limiter)
+    hedging = None
+    if hedge:
+        hedging = HedgePolicy()
+        install_hedging(agent, hedging)
+    deadlines = None
+    if deadline_ms:
+        deadlines = DeadlinePolicy(timeout_s=deadline_ms / 1000)
+        install_deadlines(agent)
+    tracer = None
+    if trace_path or usage_path:
+        tracer = Tracer()
+        instrument(agent, tracer)
+    if fast_path:
+        from agent_maths.fast_path import FastPathAgent
+        agent = FastPathAgent(name=f"{agent.name}_fast_path", sub_agents=[agent])
+
+    corpus = CORPORA[pipeline]
+    queries = [corpus[i % len(corpus)] for i in range(num_queries)]
+
+    cache = ResponseCache() if response_cache else None
+    session_service = SqliteSessionService(session_db) if session_db else None
+    start_time = time.perf_counter()
+    results = await send_queries(agent, queries, concurrency=concurrency, cache=cache, stream=stream,
+                                 session_service=session_service, deadlines=deadlines)
+    wall_time_s = time.perf_counter() - start_time
+
+    latencies = [result.latency_ms for result in results if result.error is None]
+    # When the user starts reading the answer: the first token of the agent that gives it
+    first_tokens = [result.time_to_first_token_ms[result.author] for result in results
+                    if result.error is None and result.author in result.time_to_first_token_ms]
+    num_events = sum(result.num_events for result in results)
+    # Mean prompt tokens per query of each agent (stage) of the pipeline
+    input_tokens: dict[str, float] = {}
+    for result in results:
+        for author, tokens in result.input_tokens.items():
+            input_tokens[author] = input_tokens.get(author, 0) + tokens
+    report = {
+        "pipeline": pipeline,
+        "queries": num_queries,
+        "concurrency": concurrency,
+        "errors": sum(1 for result in results if result.error is not None),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "first_token_p50_ms": percentile(first_tokens, 50),
+        "first_token_p95_ms": percentile(first_tokens, 95),
+        "queries_per_s": round(num_queries / wall_time_s, 2),
+        "events_per_s": round(num_events / wall_time_s, 2),
+        "wall_time_s": round(wall_time_s, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "input_tokens_per_query": {author: round(tokens / num_queries, 1) for author, tokens in input_tokens.items()},
+    }
+    if hasattr(session_service or default_session_service, "stats"):
+        report["session_store"] = (session_service or default_session_service).stats()
+    if limiter is not None:
+        report["rate_limiter"] = limiter.stats()
+    if hedging is not None:
+        report["hedging"] = hedging.stats()
+    if deadlines is not None:
+        report["deadlines"] = deadlines.stats()
+    if cache is not None:
+        report["response_cache_hits"] = cache.hits
+    if fast_path:
+        report["fast_path_hit_rate"] = round(agent.hit_rate, 3)
+    if usage_path:
+        usage = usage_report(tracer, per_query=True)
+        export_usage_report(usage, usage_path)
+        report["cost_usd_per_query"] = usage.get("cost_usd_per_query", 0.0)
+        report["usage"] = format_usage_report(usage)
+    if trace_path:
+        export = export_chrome_trace if trace_path.endswith(".json") else export_jsonl
+        report["trace_spans"] = export(tracer, trace_path)
+        # The breakdown of the slowest query, stage by stage
+        traces = [spans for spans in tracer.traces().values() if spans[0].parent_id is None]
+        if traces:
+            report["slowest_trace"] = format_trace(max(traces, key=lambda spans: spans[0].duration_ms))
+    return report
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline latency benchmark for the walkthrough pipelines.")
+    parser.add_argument("--pipeline", choices=sorted(CORPORA), default="teaching")
+    parser.add_argument("--queries", type=int, default=100, help="Number of queries to send.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of queries in flight.")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Simulated latency of every model call.")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Maximum random latency added to every call.")
+    parser.add_argument("--tool-latency-ms", type=float, default=50.0, help="Simulated latency of the check_grammar Gemini call.")
+    parser.add_argument("--fast-path", action="store_true", help="Answer plainly arithmetic queries without the model.")
+    parser.add_argument("--summary-mode", choices=["full", "short", "template"], default="full",
+                        help="How the teaching pipelines summarize clean queries with a single number result.")
+    parser.add_argument("--structured-handoff", action="store_true",
+                        help="Give agent_summary the grammar and math results from the session state instead of the conversation.")
+    parser.add_argument("--response-cache", action="store_true", help="Answer repeated queries from a response cache.")
+    parser.add_argument("--stream", action="store_true", help="Stream the model answers (SSE).")
+    parser.add_argument("--chunk-latency-ms", type=float, default=0.0,
+                        help="Simulated generation time of every four-word chunk of a text answer.")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="Write the spans of every stage to PATH (Chrome trace if it ends with .json, otherwise JSONL).")
+    parser.add_argument("--usage-report", metavar="PATH",
+                        help="Write the token and cost report by agent, model and tool to PATH (JSON).")
+    parser.add_argument("--session-db", metavar="PATH", help="Keep the sessions in a SQLite database at PATH.")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of the model and check_grammar calls that fail with a 429.")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="Pace and retry the model calls with harness/rate_limit.py (MODEL_RATE_LIMITS, LLM_*).")
+    parser.add_argument("--slow-rate", type=float, default=0.0,
+                        help="Fraction of the model and check_grammar calls that take --slow-ms longer.")
+    parser.add_argument("--slow-ms", type=float, default=1000.0, help="Extra latency of the slow calls.")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Hedge slow model calls with harness/hedging.py (HEDGE_*).")
+    parser.add_argument("--deadline-ms", type=float,
+                        help="Cut every query short after this many milliseconds, with a partial or fallback answer.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    parser.add_argument("--max-p95-ms", type=float, help="Exit with status 1 if p95 latency exceeds this value.")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_benchmark(args.pipeline, args.queries, args.concurrency,
+                                       args.latency_ms, args.jitter_ms, args.tool_latency_ms,
+                                       args.fast_path, args.summary_mode, args.structured_handoff,
+                                       args.response_cache, args.stream, args.chunk_latency_ms,
+                                       args.trace, args.usage_report,
+                                       args.session_db, args.error_rate, args.rate_limit,
+                                       args.slow_rate, args.slow_ms, args.hedge, args.deadline_ms))
+    if args.json:
+        print(json.dumps(report))
+    else:
+        slowest_trace = report.pop("slowest_trace", None)
+        usage = report.pop("usage", None)
+        width = max(len(key) for key in report)
+        for key, value in report.items():
+            print(f"{key:>{width}}: {value}")
+        if usage:
+            print(f"\n{usage}")
+        if slowest_trace:
+            print(f"\nSlowest query:\n{slowest_trace}")
+
+    if report["errors"]:
+        return 1
+    if args.max_p95_ms is not None and report["p95_ms"] > args.max_p95_ms:
+        print(f"p95 latency {report['p95_ms']} ms exceeds the limit of {args.max_p95_ms} ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,335 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+from google.adk.artifacts import InMemoryArtifactService
+from google.adk.events import Event
+from google.adk.sessions import InMemorySessionService, Session
+from google.adk.sessions.base_session_service import GetSessionConfig, ListSessionsResponse
+from google.genai import types
+from pydantic import PrivateAttr
+
+# Default limits of the bounded services, configured from the .env file (0 disables a limit)
+MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+MAX_EVENTS_PER_SESSION = int(os.getenv("SESSION_MAX_EVENTS", "1000"))
+MAX_SESSION_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+SESSION_IDLE_TTL_S = float(os.getenv("SESSION_IDLE_TTL_S", "3600"))
+MAX_ARTIFACT_BYTES = int(os.getenv("ARTIFACT_MAX_BYTES", str(256 * 1024 * 1024)))
+
+SessionKey = tuple[str, str, str]
+
+
+def event_size(event: Event) -> int:
+    """Approximates the memory an event takes by the size of its JSON."""
+    return len(event.model_dump_json(exclude_none=True))
+
+
+def part_size(part: types.Part) -> int:
+    """Approximates the memory an artifact takes by the size of its data or text."""
+    if part.inline_data and part.inline_data.data:
+        return len(part.inline_data.data)
+    return len(part.text or "")
+
+
+class BoundedInMemorySessionService(InMemorySessionService):
+    """An `InMemorySessionService` whose memory use is bounded.
+
+    A session that was not used for `idle_ttl_s` seconds expires, and when
+    there are more than `max_sessions` sessions, or their events take more than
+    `max_bytes`, the least recently used sessions are evicted. A session keeps
+    at most its `max_events_per_session` most recent events (its state is kept
+    in full). The limits are checked on every call, so memory stays flat under
+    sustained load without a background task.
+
+    Args:
+        max_sessions: Maximum number of sessions.
+        max_events_per_session: Maximum number of events kept per session.
+        max_bytes: Maximum approximate size of all events (see `event_size`).
+        idle_ttl_s: Seconds after its last use before a session expires.
+        on_evict: Optional callable `(app_name, user_id, session_id)` called for
+                  every evicted, expired or deleted session, e.g.
+                  `BoundedInMemoryArtifactService.delete_session_artifacts`.
+
+    Any limit set to 0 (or None) is disabled.
+
+    Examples:
+        artifact_service = BoundedInMemoryArtifactService()
+        session_service = BoundedInMemorySessionService(on_evict=artifact_service.delete_session_artifacts)
+    """
+
+    def __init__(self, max_sessions: Optional[int] = MAX_SESSIONS,
+                 max_events_per_session: Optional[int] = MAX_EVENTS_PER_SESSION,
+                 max_bytes: Optional[int] = MAX_SESSION_BYTES,
+                 idle_ttl_s: Optional[float] = SESSION_IDLE_TTL_S,
+                 on_evict: Optional[Callable[[str, str, str], Any]] = None):
+        super().__init__()
+        self.max_sessions = max_sessions
+        self.max_events_per_session = max_events_per_session
+        self.max_bytes = max_bytes
+        self.idle_ttl_s = idle_ttl_s
+        self.on_evict = on_evict
+        # Least recently used first: key -> (last use, approximate bytes of its events)
+        self._lru: OrderedDict[SessionKey, list] = OrderedDict()
+        self.num_events = 0
+        self.num_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.trimmed_events = 0
+
+    def stats(self) -> dict:
+        """Returns the live counters: sessions, events, approximate bytes, evictions and expirations."""
+        return {
+            "sessions": len(self._lru),
+            "events": self.num_events,
+            "bytes": self.num_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "trimmed_events": self.trimmed_events,
+        }
+
+    def _stored(self, key: SessionKey) -> Optional[Session]:
+        app_name, user_id, session_id = key
+        return self.sessions.get(app_name, {}).get(user_id, {}).get(session_id)
+
+    def _remove(self, key: SessionKey) -> None:
+        """Forgets a session and its counters."""
+        entry = self._lru.pop(key, None)
+        if entry is None:
+            return
+        app_name, user_id, session_id = key
+        session = self.sessions[app_name][user_id].pop(session_id, None)
+        self.num_events -= len(session.events) if session else 0
+        self.num_bytes -= entry[1]
+        # Empty maps of users and apps would otherwise pile up
+        if not self.sessions[app_name][user_id]:
+            del self.sessions[app_name][user_id]
+            if not self.sessions[app_name]:
+                del self.sessions[app_name]
+        if self.on_evict:
+            self.on_evict(app_name, user_id, session_id)
+
+    def _enforce_limits(self, keep: Optional[SessionKey] = None) -> None:
+        """Expires idle sessions, then evicts the least recently used ones beyond the limits."""
+        if self.idle_ttl_s:
+            deadline = time.time() - self.idle_ttl_s
+            while self._lru:
+                key, (last_used, _) = next(iter(self._lru.items()))
+                if last_used >= deadline:
+                    break
+                self._remove(key)
+                self.expirations += 1
+        while self._lru and ((self.max_sessions and len(self._lru) > self.max_sessions)
+                             or (self.max_bytes and self.num_bytes > self.max_bytes)):
+            key = next(iter(self._lru))
+            if key == keep:
+                # The session in use is never evicted, even if it alone is over the limit
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def _touch(self, key: SessionKey) -> None:
+        entry = self._lru.get(key)
+        if entry is not None:
+            entry[0] = time.time()
+            self._lru.move_to_end(key)
+
+    # The deprecated *_sync methods of InMemorySessionService do the same bookkeeping as the async ones
+
+    async def create_session(self, *, app_name: str, user_id: str, state: Optional[dict[str, Any]] = None,
+                             session_id: Optional[str] = None, replace: bool = True) -> Session:
+        """Creates a session.
+
+        Args:
+            replace: Whether the session replaces an existing one with the same id.
+                     If False, `ValueError` is raised instead.
+        """
+        self._before_create(app_name, user_id, session_id, replace)
+        session = await super().create_session(app_name=app_name, user_id=user_id, state=state,
+                                                session_id=session_id)
+        return self._after_create(session)
+
+    def create_session_sync(self, *, app_name: str, user_id: str, state: Optional[dict[str, Any]] = None,
+                            session_id: Optional[str] = None, replace: bool = True) -> Session:
+        self._before_create(app_name, user_id, session_id, replace)
+        session = super().create_session_sync(app_name=app_name, user_id=user_id, state=state,
+                                              session_id=session_id)
+        return self._after_create(session)
+
+    def _before_create(self, app_name: str, user_id: str, session_id: Optional[str], replace: bool) -> None:
+        if session_id and session_id.strip():
+            key = (app_name, user_id, session_id.strip())
+            if not replace:
+                # An idle session that expired no longer exists
+                self._enforce_limits()
+                if self._stored(key) is not None:
+                    raise ValueError(f"Session already exists: {session_id.strip()}")
+            # Creating over an existing session replaces it
+            self._remove(key)
+
+    def _after_create(self, session: Session) -> Session:
+        key = (session.app_name, session.user_id, session.id)
+        self._lru[key] = [time.time(), 0]
+        self._enforce_limits(keep=key)
+        return session
+
+    async def get_session(self, *, app_name: str, user_id: str, session_id: str,
+                          config: Optional[GetSessionConfig] = None) -> Optional[Session]:
+        self._before_get((app_name, user_id, session_id))
+        return await super().get_session(app_name=app_name, user_id=user_id, session_id=session_id, config=config)
+
+    def get_session_sync(self, *, app_name: str, user_id: str, session_id: str,
+                         config: Optional[GetSessionConfig] = None) -> Optional[Session]:
+        self._before_get((app_name, user_id, session_id))
+        return super().get_session_sync(app_name=app_name, user_id=user_id, session_id=session_id, config=config)
+
+    def _before_get(self, key: SessionKey) -> None:
+        self._enforce_limits()
+        self._touch(key)
+
+    async def list_sessions(self, *, app_name: str, user_id: str) -> ListSessionsResponse:
+        # Expired sessions are not listed
+        self._enforce_limits()
+        return await super().list_sessions(app_name=app_name, user_id=user_id)
+
+    def list_sessions_sync(self, *, app_name: str, user_id: str) -> ListSessionsResponse:
+        self._enforce_limits()
+        return super().list_sessions_sync(app_name=app_name, user_id=user_id)
+
+    async def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        self._remove((app_name, user_id, session_id))
+
+    def delete_session_sync(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        self._remove((app_name, user_id, session_id))
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        key = (session.app_name, session.user_id, session.id)
+        stored = self._stored(key)
+        num_stored_events = len(stored.events) if stored else 0
+        await super().append_event(session=session, event=event)
+        entry = self._lru.get(key)
+        if stored is None or entry is None or len(stored.events) == num_stored_events:
+            # Partial event, or a session that was evicted in the meantime
+            return event
+
+        size = event_size(event)
+        entry[1] += size
+        self.num_bytes += size
+        self.num_events += 1
+        if self.max_events_per_session and len(stored.events) > self.max_events_per_session:
+            excess = len(stored.events) - self.max_events_per_session
+            trimmed = sum(event_size(old_event) for old_event in stored.events[:excess])
+            del stored.events[:excess]
+            entry[1] -= trimmed
+            self.num_bytes -= trimmed
+            self.num_events -= excess
+            self.trimmed_events += excess
+        self._touch(key)
+        self._enforce_limits(keep=key)
+        return event
+
+
+class BoundedInMemoryArtifactService(InMemoryArtifactService):
+    """An `InMemoryArtifactService` whose memory use is bounded.
+
+    Artifacts not used for `idle_ttl_s` seconds expire, and when all versions
+    of all artifacts take more than `max_bytes`, the least recently used
+    artifacts are evicted with all their versions. Each artifact keeps at most
+    its `max_versions` latest versions; older versions load as None, and the
+    version numbers of newer ones do not change.
+
+    Attributes:
+        max_bytes: Maximum total size of the artifacts (see `part_size`).
+        max_versions: Maximum number of versions kept per artifact.
+        idle_ttl_s: Seconds after its last use before an artifact expires.
+
+    Any limit set to 0 (or None) is disabled.
+    """
+
+    max_bytes: Optional[int] = MAX_ARTIFACT_BYTES
+    max_versions: Optional[int] = 10
+    idle_ttl_s: Optional[float] = SESSION_IDLE_TTL_S
+    num_bytes: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    # Least recently used first: path -> [last use, bytes of its kept versions]
+    _lru: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+
+    def stats(self) -> dict:
+        """Returns the live counters: artifacts, versions, bytes, evictions and expirations."""
+        return {
+            "artifacts": len(self._lru),
+            "versions": sum(sum(1 for part in versions if part is not None) for versions in self.artifacts.values()),
+            "bytes": self.num_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _remove(self, path: str) -> None:
+        entry = self._lru.pop(path, None)
+        self.artifacts.pop(path, None)
+        if entry is not None:
+            self.num_bytes -= entry[1]
+
+    def _enforce_limits(self, keep: Optional[str] = None) -> None:
+        if self.idle_ttl_s:
+            deadline = time.time() - self.idle_ttl_s
+            while self._lru:
+                path, (last_used, _) = next(iter(self._lru.items()))
+                if last_used >= deadline:
+                    break
+                self._remove(path)
+                self.expirations += 1
+        while self._lru and self.max_bytes and self.num_bytes > self.max_bytes:
+            path = next(iter(self._lru))
+            if path == keep:
+                break
+            self._remove(path)
+            self.evictions += 1
+
+    async def save_artifact(self, *, app_name: str, user_id: str, session_id: str, filename: str,
+                            artifact: types.Part) -> int:
+        version = await super().save_artifact(app_name=app_name, user_id=user_id, session_id=session_id,
+                                              filename=filename, artifact=artifact)
+        path = self._artifact_path(app_name, user_id, session_id, filename)
+        entry = self._lru.setdefault(path, [0.0, 0])
+        entry[0] = time.time()
+        self._lru.move_to_end(path)
+        size = part_size(artifact)
+        entry[1] += size
+        self.num_bytes += size
+
+        versions = self.artifacts[path]
+        if self.max_versions and len(versions) > self.max_versions:
+            # Old versions are blanked rather than removed, so version numbers stay valid
+            for index in range(len(versions) - self.max_versions):
+                if versions[index] is not None:
+                    entry[1] -= part_size(versions[index])
+                    self.num_bytes -= part_size(versions[index])
+                    versions[index] = None
+        self._enforce_limits(keep=path)
+        return version
+
+    async def load_artifact(self, *, app_name: str, user_id: str, session_id: str, filename: str,
+                            version: Optional[int] = None) -> Optional[types.Part]:
+        self._enforce_limits()
+        path = self._artifact_path(app_name, user_id, session_id, filename)
+        entry = self._lru.get(path)
+        if entry is not None:
+            entry[0] = time.time()
+            self._lru.move_to_end(path)
+        return await super().load_artifact(app_name=app_name, user_id=user_id, session_id=session_id,
+                                           filename=filename, version=version)
+
+    async def list_versions(self, *, app_name: str, user_id: str, session_id: str, filename: str) -> list[int]:
+        path = self._artifact_path(app_name, user_id, session_id, filename)
+        return [version for version, part in enumerate(self.artifacts.get(path) or []) if part is not None]
+
+    async def delete_artifact(self, *, app_name: str, user_id: str, session_id: str, filename: str) -> None:
+        self._remove(self._artifact_path(app_name, user_id, session_id, filename))
+
+    def delete_session_artifacts(self, app_name: str, user_id: str, session_id: str) -> None:
+        """Deletes the artifacts of a session (not the user: ones shared by the user's sessions)."""
+        prefix = f"{app_name}/{user_id}/{session_id}/"
+        for path in [path for path in self.artifacts if path.startswith(prefix)]:
+            self._remove(path)
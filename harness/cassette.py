@@ -0,0 +1,338 @@
+import os
+import sys
+import gzip
+import json
+import time
+import runpy
+import asyncio
+import hashlib
+import argparse
+from typing import AsyncGenerator, Optional
+
+from pydantic import Field
+
+from google.adk.models import Gemini, LLMRegistry
+from google.adk.models.base_llm import BaseLlm
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+from google.genai import types
+
+from harness.agent_tree import set_models
+from harness.fake_llm import FakeGrammarResponse
+
+RECORD = "record"
+REPLAY = "replay"
+
+# Kinds of traffic stored in a cassette
+LLM = "llm"
+TOOL = "tool"
+
+
+class CassetteMiss(LookupError):
+    """Raised in replay mode when a request was never recorded."""
+
+
+def _hash(payload) -> str:
+    data = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+def llm_request_key(llm_request: LlmRequest) -> str:
+    """Returns the replay key of an agent model request.
+
+    The key covers the model, the conversation and the generation config
+    (system instruction, tools, schema), so any change to the prompt or the
+    conversation is a different request.
+    """
+    return _hash(llm_request.model_dump(mode="json", exclude_none=True,
+                                        include={"model", "contents", "config"}))
+
+
+def tool_request_key(model: str, contents, config) -> str:
+    """Returns the replay key of a `generate_content` call made by a tool."""
+    if hasattr(config, "model_dump"):
+        config = config.model_dump(mode="json", exclude_none=True)
+    return _hash({"model": model, "contents": [str(content) for content in contents], "config": config})
+
+
+class Cassette:
+    """Recorded model and tool traffic, stored as (optionally gzipped) JSON lines.
+
+    Every entry holds the kind of traffic, the request key, the observed latency
+    and the recorded response. Requests recorded more than once are replayed in
+    the order they were recorded, starting over when exhausted.
+
+    Args:
+        path: The cassette file. Paths ending in ".gz" are gzip compressed.
+        mode: RECORD to capture traffic, REPLAY to serve it back.
+        realtime: In replay mode, whether to wait for the recorded latency
+                  (True) or answer immediately (False).
+    """
+
+    def __init__(self, path: str, mode: str = REPLAY, realtime: bool = True):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.realtime = realtime
+        self.entries: list[dict] = []
+        self.hits = 0
+        self.misses = 0
+        self._index: dict[tuple[str, str], list[dict]] = {}
+        self._cursor: dict[tuple[str, str], int] = {}
+        if mode == REPLAY:
+            self.load()
+
+    def _open(self, mode: str):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, mode + "t", encoding="utf-8")
+        return open(self.path, mode, encoding="utf-8")
+
+    def load(self) -> None:
+        """Reads the cassette file and indexes its entries."""
+        with self._open("r") as f:
+            for line in f:
+                if line.strip():
+                    self._add(json.loads(line))
+
+    def save(self) -> None:
+        """Writes all entries to the cassette file, replacing it atomically."""
+        final_path = self.path
+        self.path = final_path + ".tmp" + (".gz" if final_path.endswith(".gz") else "")
+        try:
+            with self._open("w") as f:
+                for entry in self.entries:
+                    f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            os.replace(self.path, final_path)
+        finally:
+            self.path = final_path
+
+    def _add(self, entry: dict) -> None:
+        self.entries.append(entry)
+        self._index.setdefault((entry["kind"], entry["key"]), []).append(entry)
+
+    def record(self, kind: str, key: str, latency_ms: float, response) -> None:
+        """Adds one request/response pair to the cassette."""
+        self._add({"kind": kind, "key": key, "latency_ms": round(latency_ms, 3), "response": response})
+
+    def lookup(self, kind: str, key: str) -> dict:
+        """Returns the next recorded entry for a request.
+
+        Raises:
+            CassetteMiss: If the request was never recorded.
+        """
+        entries = self._index.get((kind, key))
+        if not entries:
+            self.misses += 1
+            raise CassetteMiss(f"No recorded {kind} response for request {key} in {self.path}")
+        self.hits += 1
+        cursor = self._cursor.get((kind, key), 0)
+        self._cursor[(kind, key)] = cursor + 1
+        return entries[cursor % len(entries)]
+
+    def replay_delay_s(self, entry: dict) -> float:
+        """Returns how long to wait before serving a recorded entry."""
+        return entry["latency_ms"] / 1000 if self.realtime else 0.0
+
+
+class CassetteLlm(BaseLlm):
+    """Records or replays the model calls of an agent.
+
+    Attributes:
+        cassette: The cassette to record into or replay from.
+        inner: The model that serves the requests while recording.
+    """
+
+    model: str = "cassette"
+    cassette: Cassette
+    inner: Optional[BaseLlm] = None
+
+    async def generate_content_async(
+        self, llm_request: LlmRequest, stream: bool = False
+    ) -> AsyncGenerator[LlmResponse, None]:
+        # The key is computed before the inner model sees (and possibly mutates) the request
+        key = llm_request_key(llm_request)
+
+        if self.cassette.mode == REPLAY:
+            entry = self.cassette.lookup(LLM, key)
+            delay_s = self.cassette.replay_delay_s(entry)
+            if delay_s:
+                await asyncio.sleep(delay_s)
+            for response in entry["response"]:
+                yield LlmResponse.model_validate(response)
+            return
+
+        start_time = time.perf_counter()
+        responses = []
+        async for llm_response in self.inner.generate_content_async(llm_request, stream=stream):
+            responses.append(llm_response.model_dump(mode="json", exclude_none=True))
+            yield llm_response
+        self.cassette.record(LLM, key, (time.perf_counter() - start_time) * 1000, responses)
+
+
+class _CassetteModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, *, model, contents, config=None):
+        cassette = self._client.cassette
+        key = tool_request_key(model, contents, config)
+
+        if cassette.mode == REPLAY:
+            entry = cassette.lookup(TOOL, key)
+            delay_s = cassette.replay_delay_s(entry)
+            if delay_s:
+                time.sleep(delay_s)
+            return _to_response(entry["response"])
+
+        start_time = time.perf_counter()
+        response = self._client.inner.models.generate_content(model=model, contents=contents, config=config)
+        cassette.record(TOOL, key, (time.perf_counter() - start_time) * 1000, _from_response(response))
+        return response
+
+
+class _CassetteAsyncModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    async def generate_content(self, *, model, contents, config=None):
+        cassette = self._client.cassette
+        key = tool_request_key(model, contents, config)
+
+        if cassette.mode == REPLAY:
+            entry = cassette.lookup(TOOL, key)
+            delay_s = cassette.replay_delay_s(entry)
+            if delay_s:
+                await asyncio.sleep(delay_s)
+            return _to_response(entry["response"])
+
+        start_time = time.perf_counter()
+        response = await self._client.inner.aio.models.generate_content(model=model, contents=contents, config=config)
+        cassette.record(TOOL, key, (time.perf_counter() - start_time) * 1000, _from_response(response))
+        return response
+
+
+class _CassetteAio:
+
+    def __init__(self, client):
+        self.models = _CassetteAsyncModels(client)
+
+
+def _from_response(response) -> dict:
+    usage_metadata = getattr(response, "usage_metadata", None)
+    return {
+        "parsed": response.parsed,
+        "usage_metadata": usage_metadata.model_dump(mode="json", exclude_none=True) if usage_metadata else None,
+    }
+
+
+def _to_response(recorded: dict) -> FakeGrammarResponse:
+    usage_metadata = recorded.get("usage_metadata")
+    return FakeGrammarResponse(
+        recorded["parsed"],
+        types.GenerateContentResponseUsageMetadata.model_validate(usage_metadata) if usage_metadata else None,
+    )
+
+
+class CassetteGenaiClient:
+    """Records or replays the `generate_content` calls a tool makes through a genai client.
+
+    Args:
+        cassette: The cassette to record into or replay from.
+        inner: The real client, required when recording.
+    """
+
+    def __init__(self, cassette: Cassette, inner=None):
+        self.cassette = cassette
+        self.inner = inner
+        self.models = _CassetteModels(self)
+        self.aio = _CassetteAio(self)
+
+
+def use_cassette(agent, cassette: Cassette) -> None:
+    """Routes all model calls of an agent tree and of `check_grammar` through a cassette.
+
+    Args:
+        agent: The root of the agent tree.
+        cassette: The cassette to record into or replay from.
+    """
+    from agent_grammar import agent as grammar_module
+
+    set_models(agent, lambda llm_agent: CassetteLlm(cassette=cassette, inner=llm_agent.canonical_model))
+    inner_factory = grammar_module.set_client_factory(None)
+    grammar_module.set_client_factory(
+        lambda: CassetteGenaiClient(cassette, inner_factory() if cassette.mode == RECORD else None))
+
+
+# Cassette used by Gemini models resolved through the LLMRegistry (see run_script)
+_active_cassette: Optional[Cassette] = None
+
+
+class _RegisteredCassetteLlm(CassetteLlm):
+    """Serves every Gemini model name while `run_script` has a cassette active."""
+
+    cassette: Cassette = Field(default_factory=lambda: _active_cassette)
+
+    @staticmethod
+    def supported_models() -> list[str]:
+        return Gemini.supported_models()
+
+    def model_post_init(self, __context) -> None:
+        if self.inner is None and self.cassette.mode == RECORD:
+            self.inner = Gemini(model=self.model)
+
+
+def run_script(script: str, cassette: Cassette) -> None:
+    """Runs a chapter script with all of its Gemini traffic going through a cassette.
+
+    Agents are usually built inside the script's `__main__` block with a model
+    name, so the cassette is hooked into the LLMRegistry, which resolves model
+    names to model classes, rather than into the agents themselves.
+
+    Args:
+        script: Path to the script, e.g. "chapter3_main_multi_agent.py".
+        cassette: The cassette to record into or replay from.
+    """
+    global _active_cassette
+    from agent_grammar import agent as grammar_module
+
+    _active_cassette = cassette
+    LLMRegistry.register(_RegisteredCassetteLlm)
+    LLMRegistry.resolve.cache_clear()
+    inner_factory = grammar_module.set_client_factory(None)
+    grammar_module.set_client_factory(
+        lambda: CassetteGenaiClient(cassette, inner_factory() if cassette.mode == RECORD else None))
+    try:
+        runpy.run_path(script, run_name="__main__")
+    finally:
+        LLMRegistry.register(Gemini)
+        LLMRegistry.resolve.cache_clear()
+        grammar_module.set_client_factory(inner_factory)
+        _active_cassette = None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Record or replay the model traffic of a chapter script.")
+    parser.add_argument("mode", choices=[RECORD, REPLAY])
+    parser.add_argument("cassette", help="Cassette file, e.g. chapter3.jsonl.gz")
+    parser.add_argument("script", nargs="?", default="chapter3_main_multi_agent.py", help="The script to run.")
+    parser.add_argument("--zero-latency", action="store_true", help="Replay without waiting for the recorded latencies.")
+    args = parser.parse_args(argv)
+
+    cassette = Cassette(args.cassette, mode=args.mode, realtime=not args.zero_latency)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.script)))
+    try:
+        run_script(args.script, cassette)
+    finally:
+        if args.mode == RECORD:
+            cassette.save()
+            print(f"Recorded {len(cassette.entries)} responses to {args.cassette}")
+        else:
+            print(f"Replayed {cassette.hits} responses from {args.cassette} ({cassette.misses} misses)")
+    return 1 if cassette.misses else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
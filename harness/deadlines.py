@@ -0,0 +1,418 @@
+import os
+import asyncio
+import contextvars
+from collections import Counter
+from typing import Any, AsyncGenerator, Awaitable, Optional, TypeVar
+
+from google.adk.agents import BaseAgent, LlmAgent
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.events import Event
+from google.adk.models.base_llm import BaseLlm
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+from google.adk.tools import FunctionTool
+from google.adk.tools.tool_context import ToolContext
+from google.genai import types
+
+from harness.agent_tree import iter_agents, prepend_callback, set_models
+
+T = TypeVar("T")
+
+# Deadline of a whole query in seconds (0 for none), and the answer given when it
+# expires before any agent has written one, configured from the .env file
+QUERY_DEADLINE_S = float(os.getenv("QUERY_DEADLINE_S", "0"))
+DEADLINE_FALLBACK_ANSWER = os.getenv("DEADLINE_FALLBACK_ANSWER",
+                                     "Sorry, I could not finish my answer in time. Please ask me again.")
+
+# Author and error code of the event that ends a query whose deadline expired
+DEADLINE_AUTHOR = "deadline"
+DEADLINE_ERROR_CODE = "DEADLINE_EXCEEDED"
+
+# The deadline of the query running in the current task. Tasks copy the context
+# they are created in, so the sub-agents of a ParallelAgent see it too.
+_current_deadline: contextvars.ContextVar[Optional["Deadline"]] = contextvars.ContextVar("current_deadline",
+                                                                                         default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised by a bounded stage when the deadline of its query expires.
+
+    It is not a `TimeoutError`, so the rate limiter does not retry it.
+
+    Attributes:
+        stage: The stage that was running, e.g. "llm agent_grammar".
+    """
+
+    def __init__(self, stage: str):
+        super().__init__(f"the query deadline expired during {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """The deadline of one query, and the stages it is going through.
+
+    A stage is an agent turn ("agent_math"), a model call ("llm agent_math"),
+    a tool call ("tool check_grammar") or a model call inside a tool
+    ("tool_llm gemini-2.0-flash-001"), named like the spans of
+    `harness/tracing.py`. When the deadline expires, the innermost stage
+    entered last is the one blamed for it.
+
+    Args:
+        timeout_s: Seconds from now until the deadline.
+
+    Attributes:
+        expires_at: The deadline, in event loop time.
+        expired_stage: The stage blamed for the expiry, once the deadline expired.
+    """
+
+    def __init__(self, timeout_s: float):
+        self.timeout_s = timeout_s
+        self.expires_at = asyncio.get_running_loop().time() + timeout_s
+        self.expired_stage: Optional[str] = None
+        self._stages: list[str] = []
+        # The task that runs the query; the others are branches of a ParallelAgent
+        self._task = asyncio.current_task()
+
+    @property
+    def stage(self) -> str:
+        """The stage running now, or "runner" between stages."""
+        return self._stages[-1] if self._stages else "runner"
+
+    def remaining_s(self) -> float:
+        return max(0.0, self.expires_at - asyncio.get_running_loop().time())
+
+    def enter(self, stage: str) -> None:
+        self._stages.append(stage)
+
+    def exit(self, stage: str) -> None:
+        # Stages of parallel branches do not end in order
+        for index in range(len(self._stages) - 1, -1, -1):
+            if self._stages[index] == stage:
+                del self._stages[index]
+                return
+
+    async def bound(self, stage: Optional[str], awaitable: Awaitable[T]) -> T:
+        """Awaits a stage, cancelling it when the deadline expires.
+
+        Args:
+            stage: The name of the stage, or None to bound an awaitable without
+                   entering a stage (e.g. a step of the runner, which spans the stages).
+            awaitable: The work of the stage.
+
+        Raises:
+            DeadlineExceeded: If the deadline expired first.
+        """
+        if stage is not None:
+            self.enter(stage)
+        try:
+            async with asyncio.timeout_at(self.expires_at):
+                return await awaitable
+        except (TimeoutError, asyncio.CancelledError) as e:
+            if self.remaining_s() > 0:
+                # Some other timeout or cancellation inside the stage
+                raise
+            # Bounds that expire together unwind from the innermost one, which is
+            # where the time ran out; the stages it was in are still entered
+            if self.expired_stage is None:
+                self.expired_stage = self.stage
+            if isinstance(e, asyncio.CancelledError):
+                # An outer bound expired first and the cancellation is its to handle
+                raise
+            task = asyncio.current_task()
+            if task is not self._task:
+                # ParallelAgent does not wait for the branches it stopped reading, so
+                # their error is marked as retrieved rather than logged when it is not
+                task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            raise DeadlineExceeded(self.expired_stage) from None
+        finally:
+            if stage is not None:
+                self.exit(stage)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """Returns the deadline of the query running in the current task, if it has one."""
+    return _current_deadline.get()
+
+
+async def bounded(stage: str, awaitable: Awaitable[T]) -> T:
+    """Awaits a stage within the deadline of the current query, if it has one."""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return await awaitable
+    return await deadline.bound(stage, awaitable)
+
+
+def _event_text(event: Event) -> str:
+    if not event.content or not event.content.parts:
+        return ""
+    return "".join(part.text for part in event.content.parts if part.text and not part.thought)
+
+
+class DeadlinePolicy:
+    """Gives every query a deadline that covers all of its agents, model calls and tools.
+
+    `run(events)` wraps the events of a run (`runner.run_async` or
+    `run_cached`): the deadline is set for everything the run does, including
+    the sub-agents a ParallelAgent runs in their own tasks, and when it
+    expires the run is cancelled and closed, and a last, final event authored
+    "deadline" is yielded instead. Its text is the partial answer: the text
+    the agent in progress had streamed so far, else the last answer an agent
+    finished, else `fallback_answer`. The event has the error code
+    "DEADLINE_EXCEEDED" and the stage that was running in its
+    `custom_metadata["deadline_stage"]`. It is not saved in the session.
+
+    With `install_deadlines`, every model call, function tool call and Gemini
+    call of `check_grammar` is bounded by the deadline too, so work left
+    running in other tasks (ParallelAgent does not cancel its branches) stops
+    at the deadline as well, and the expiry is blamed on the right stage.
+    Synchronous tools cannot be interrupted; the run stops once they return.
+
+    Args:
+        timeout_s: Default deadline of a query, in seconds. 0 or None for no deadline.
+        fallback_answer: The answer when no agent has written any text before the deadline.
+
+    Attributes:
+        queries: Number of runs started.
+        expired: Number of runs whose deadline expired.
+        expired_by_stage: Number of expired runs by the stage that was running.
+
+    Examples:
+        deadlines = DeadlinePolicy(timeout_s=10)
+        install_deadlines(agent_teaching_assistant)
+        async for event in deadlines.run(runner.run_async(user_id=user_id, session_id=session_id,
+                                                          new_message=content)):
+            ...
+    """
+
+    def __init__(self, timeout_s: Optional[float] = QUERY_DEADLINE_S,
+                 fallback_answer: str = DEADLINE_FALLBACK_ANSWER):
+        self.timeout_s = timeout_s
+        self.fallback_answer = fallback_answer
+        self.queries = 0
+        self.expired = 0
+        self.expired_by_stage: Counter[str] = Counter()
+
+    def stats(self) -> dict:
+        """Returns the number of runs, how many expired, and at which stage."""
+        return {
+            "queries": self.queries,
+            "expired": self.expired,
+            "expired_rate": round(self.expired / self.queries, 4) if self.queries else 0.0,
+            "expired_by_stage": dict(self.expired_by_stage.most_common()),
+        }
+
+    async def run(self, events: AsyncGenerator[Event, None],
+                  timeout_s: Optional[float] = None) -> AsyncGenerator[Event, None]:
+        """Passes the events of a run through, within a deadline.
+
+        Args:
+            events: The events of the run.
+            timeout_s: The deadline of this run, in seconds. Defaults to the policy's.
+
+        Yields:
+            The events of the run, then a "deadline" event if the deadline expired.
+        """
+        timeout_s = self.timeout_s if timeout_s is None else timeout_s
+        self.queries += 1
+        if not timeout_s:
+            async for event in events:
+                yield event
+            return
+
+        deadline = Deadline(timeout_s)
+        last_answer = None
+        streamed_text = ""
+        invocation_id = ""
+        try:
+            while True:
+                # The context variable is set around each step only: the steps run in the
+                # caller's task, and it must not leak into what the caller does in between
+                token = _current_deadline.set(deadline)
+                try:
+                    event = await deadline.bound(None, anext(events))
+                except StopAsyncIteration:
+                    return
+                finally:
+                    _current_deadline.reset(token)
+                invocation_id = event.invocation_id
+                text = _event_text(event)
+                if event.partial:
+                    streamed_text += text
+                elif text:
+                    streamed_text = ""
+                    if event.is_final_response():
+                        last_answer = text
+                yield event
+        except DeadlineExceeded as e:
+            self.expired += 1
+            self.expired_by_stage[e.stage] += 1
+            await events.aclose()
+            answer = streamed_text or last_answer or self.fallback_answer
+            yield Event(invocation_id=invocation_id, author=DEADLINE_AUTHOR, error_code=DEADLINE_ERROR_CODE,
+                        error_message=str(e), interrupted=True, custom_metadata={"deadline_stage": e.stage},
+                        content=types.Content(role="model", parts=[types.Part(text=answer)]))
+        finally:
+            await events.aclose()
+
+
+class DeadlineLlm(BaseLlm):
+    """Bounds the model calls of an agent by the deadline of their query.
+
+    Every step of the answer, the first response and each streamed chunk, is
+    awaited within the deadline. The calls of queries without a deadline are
+    passed through.
+
+    Attributes:
+        inner: The model that serves the calls.
+        agent_name: The agent the calls belong to, to name the stage.
+    """
+
+    inner: BaseLlm
+    agent_name: str
+
+    async def generate_content_async(
+        self, llm_request: LlmRequest, stream: bool = False
+    ) -> AsyncGenerator[LlmResponse, None]:
+        responses = self.inner.generate_content_async(llm_request, stream=stream)
+        deadline = _current_deadline.get()
+        if deadline is None:
+            async for llm_response in responses:
+                yield llm_response
+            return
+        stage = f"llm {self.agent_name}"
+        try:
+            while True:
+                try:
+                    llm_response = await deadline.bound(stage, anext(responses))
+                except StopAsyncIteration:
+                    return
+                yield llm_response
+        finally:
+            await responses.aclose()
+
+
+def _before_agent(callback_context: CallbackContext) -> None:
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.enter(callback_context.agent_name)
+
+
+def _after_agent(callback_context: CallbackContext) -> None:
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.exit(callback_context.agent_name)
+
+
+class DeadlineTool(FunctionTool):
+    """A function tool whose calls are bounded by the deadline of their query.
+
+    An async function (e.g. `check_grammar`) is cancelled when the deadline
+    expires. A synchronous one cannot be interrupted: it runs to the end, and
+    the run stops at its next bounded stage.
+    """
+
+    async def run_async(self, *, args: dict[str, Any], tool_context: ToolContext) -> Any:
+        return await bounded(f"tool {self.name}", super().run_async(args=args, tool_context=tool_context))
+
+
+def _bounded_tool(tool):
+    # Other kinds of tools (e.g. AgentTool) are left as they are, and only recorded as stages
+    if isinstance(tool, DeadlineTool):
+        return tool
+    if type(tool) is FunctionTool:
+        return DeadlineTool(tool.func)
+    if callable(tool) and not isinstance(tool, FunctionTool):
+        return DeadlineTool(tool)
+    return tool
+
+
+def _before_tool(tool, args: dict, tool_context) -> None:
+    deadline = _current_deadline.get()
+    if deadline is not None and not isinstance(tool, DeadlineTool):
+        deadline.enter(f"tool {tool.name}")
+
+
+def _after_tool(tool, args: dict, tool_context, tool_response) -> None:
+    deadline = _current_deadline.get()
+    if deadline is not None and not isinstance(tool, DeadlineTool):
+        deadline.exit(f"tool {tool.name}")
+
+
+class _BoundedModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, *, model, contents, config=None):
+        # The synchronous client is used by nothing in the walkthrough; a blocking call cannot be cancelled anyway
+        return self._client.inner.models.generate_content(model=model, contents=contents, config=config)
+
+
+class _BoundedAsyncModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    async def generate_content(self, *, model, contents, config=None):
+        return await bounded(f"tool_llm {model}",
+                             self._client.inner.aio.models.generate_content(model=model, contents=contents,
+                                                                            config=config))
+
+
+class _BoundedAio:
+
+    def __init__(self, client):
+        self.models = _BoundedAsyncModels(client)
+
+
+class DeadlineGenaiClient:
+    """Bounds the `generate_content` calls a tool makes through a genai client by the query deadline.
+
+    `check_grammar` turns the `DeadlineExceeded` into an error result, like its
+    own `GRAMMAR_TIMEOUT_S`, and the run then ends at its next bounded stage.
+
+    Args:
+        inner: The client that serves the calls.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.models = _BoundedModels(self)
+        self.aio = _BoundedAio(self)
+
+
+def install_deadlines(agent: BaseAgent) -> None:
+    """Bounds every model call and function tool call of an agent tree, and the Gemini calls of `check_grammar`, by the query deadline.
+
+    The function tools of the LLM agents are replaced by `DeadlineTool`s. The
+    agent turns, and the calls of other kinds of tools, are recorded as
+    stages, so that an expired deadline is blamed on the stage that was
+    running. Install it last, after `install_rate_limiter` and
+    `install_hedging`, so that one bound covers the retries and hedges of a
+    call. Installing it twice has no effect.
+    """
+    from agent_grammar import agent as grammar_module
+
+    for node in iter_agents(agent):
+        node.before_agent_callback = prepend_callback(node.before_agent_callback, _before_agent)
+        node.after_agent_callback = prepend_callback(node.after_agent_callback, _after_agent)
+        if isinstance(node, LlmAgent):
+            node.tools = [_bounded_tool(tool) for tool in node.tools]
+            node.before_tool_callback = prepend_callback(node.before_tool_callback, _before_tool)
+            node.after_tool_callback = prepend_callback(node.after_tool_callback, _after_tool)
+
+    set_models(agent, lambda llm_agent: (
+        llm_agent.canonical_model if isinstance(llm_agent.canonical_model, DeadlineLlm)
+        else DeadlineLlm(model=llm_agent.canonical_model.model, inner=llm_agent.canonical_model,
+                         agent_name=llm_agent.name)))
+
+    inner_factory = grammar_module.set_client_factory(None)
+    if getattr(inner_factory, "deadlines", False):
+        grammar_module.set_client_factory(inner_factory)
+        return
+
+    def bounded_factory():
+        return DeadlineGenaiClient(inner_factory())
+
+    bounded_factory.deadlines = True
+    grammar_module.set_client_factory(bounded_factory)
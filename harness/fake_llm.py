@@ -0,0 +1,336 @@
+import re
+import json
+import time
+import random
+import asyncio
+from typing import AsyncGenerator, Callable, Optional
+
+from google.adk.models.base_llm import BaseLlm
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+from google.genai import errors, types
+
+# Tool chosen for each operation word found in a math query
+_MATH_OPERATIONS = {
+    "add": "add", "sum": "add", "plus": "add",
+    "subtract": "subtract", "minus": "subtract",
+    "multiply": "multiply", "product": "multiply", "times": "multiply",
+    "divide": "divide",
+}
+_OPERATION_PATTERN = re.compile(r"\b(" + "|".join(_MATH_OPERATIONS) + r")\b", re.IGNORECASE)
+_RANGE_PATTERN = re.compile(r"(?:between|from)?\s*(-?\d+)\s*(?:and|to)\s*(-?\d+)", re.IGNORECASE)
+_NUMBER_PATTERN = re.compile(r"-?\d+")
+
+DEFAULT_ANSWER = "I am doing well, thank you for asking. How can I help you today?"
+
+
+def resource_exhausted() -> errors.ClientError:
+    """Returns the error the genai client raises when a quota is exceeded (HTTP 429)."""
+    return errors.ClientError(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED",
+                                              "message": "Resource has been exhausted (e.g. check quota)."}})
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimates the number of tokens of a text (about four characters per token)."""
+    return max(1, len(text) // 4) if text else 0
+
+
+def _request_text(llm_request: LlmRequest) -> str:
+    """Returns all text the model would read for a request, including the system instruction."""
+    texts = []
+    if llm_request.config and isinstance(llm_request.config.system_instruction, str):
+        texts.append(llm_request.config.system_instruction)
+    for content in llm_request.contents:
+        for part in content.parts or []:
+            if part.text:
+                texts.append(part.text)
+            elif part.function_call:
+                texts.append(str(part.function_call.args))
+            elif part.function_response:
+                texts.append(str(part.function_response.response))
+    return "\n".join(texts)
+
+
+def _query_text(llm_request: LlmRequest) -> str:
+    """Returns the user's query, which is the last user text that is not another agent's reply.
+
+    The replies of other agents reach the model as user messages starting
+    with "For context:", and in a conversation the earlier queries come first.
+    """
+    for content in reversed(llm_request.contents):
+        if content.role != "user" or not content.parts or content.parts[0].text == "For context:":
+            continue
+        for part in content.parts:
+            if part.text:
+                return part.text
+    return ""
+
+
+def _last_function_response(llm_request: LlmRequest) -> Optional[types.FunctionResponse]:
+    """Returns the function response the model is answering, if the last turn is one."""
+    if not llm_request.contents:
+        return None
+    for part in llm_request.contents[-1].parts or []:
+        if part.function_response:
+            return part.function_response
+    return None
+
+
+def parse_math_call(query: str, tool_names=()) -> Optional[types.FunctionCall]:
+    """Parses a math query into a call of one of the `agent_maths` tools.
+
+    Ranges ("between 1 and 10", "1 to 3") are sent to the matching range tool
+    (e.g. `multiply_range`) when it is in `tool_names`, and are otherwise
+    expanded into the list of numbers the model would write out.
+
+    Args:
+        query: The query text.
+        tool_names: The names of the tools available to the agent.
+
+    Returns:
+        The function call, or None if no operation was recognized.
+    """
+    operation = _OPERATION_PATTERN.search(query)
+    if not operation:
+        return None
+    name = _MATH_OPERATIONS[operation.group(1).lower()]
+    tail = query[operation.end():]
+    range_match = _RANGE_PATTERN.search(tail)
+    if range_match and re.search(r"\b(between|from|to)\b", range_match.group(0), re.IGNORECASE):
+        start, end = int(range_match.group(1)), int(range_match.group(2))
+        if f"{name}_range" in tool_names:
+            return types.FunctionCall(name=f"{name}_range", args={"start": start, "end": end})
+        numbers = list(range(start, end + 1))
+    else:
+        numbers = [int(number) for number in _NUMBER_PATTERN.findall(tail)]
+    return types.FunctionCall(name=name, args={"numbers": numbers})
+
+
+def default_script(llm_request: LlmRequest, answers: dict[str, str]) -> LlmResponse:
+    """Scripts a plausible model turn for the walkthrough agents.
+
+    - An agent with the `check_grammar` tool first calls it with the query.
+    - An agent with the math tools calls the tool matching the query.
+    - After a function response, the agent answers with the tool result.
+    - Otherwise the agent answers with its scripted text from `answers`
+      (keyed by agent name), or a default answer.
+
+    Args:
+        llm_request: The request sent to the model.
+        answers: Scripted text answers, keyed by agent name.
+
+    Returns:
+        The scripted model response.
+    """
+    agent_name = (llm_request.config.labels or {}).get("adk_agent_name", "") if llm_request.config else ""
+    query = _query_text(llm_request)
+
+    function_response = _last_function_response(llm_request)
+    if function_response:
+        response = function_response.response or {}
+        if function_response.name == "check_grammar":
+            text = f"{response.get('corrected_text') or query}\n\n{' '.join(response.get('explanations') or [])}"
+        else:
+            text = f"The answer is {response.get('result', response)}."
+        return LlmResponse(content=types.Content(role="model", parts=[types.Part(text=text)]))
+
+    function_call = None
+    if "check_grammar" in llm_request.tools_dict:
+        function_call = types.FunctionCall(name="check_grammar", args={"text_input": query})
+    elif llm_request.tools_dict:
+        function_call = parse_math_call(query, llm_request.tools_dict)
+        if function_call and function_call.name not in llm_request.tools_dict:
+            function_call = None
+    if function_call:
+        return LlmResponse(content=types.Content(role="model", parts=[types.Part(function_call=function_call)]))
+
+    text = answers.get(agent_name, DEFAULT_ANSWER)
+    return LlmResponse(content=types.Content(role="model", parts=[types.Part(text=text)]))
+
+
+class FakeLlm(BaseLlm):
+    """A local stand-in for Gemini that needs no network.
+
+    Every call waits for the configured latency and returns a scripted response,
+    so the chapter agents and pipelines can be run and timed offline. Install it
+    with `harness.agent_tree.set_models`.
+
+    Text answers take `chunk_latency_ms` more per chunk of `chunk_words` words,
+    as if the model generated them. When the runner streams (SSE), the chunks
+    are yielded as partial responses as they are "generated", followed by the
+    whole text, like Gemini does; otherwise the whole text is returned at the end.
+
+    Attributes:
+        latency_ms: Simulated latency of every model call (until the first chunk).
+        jitter_ms: Maximum random latency added on top of `latency_ms`.
+        chunk_latency_ms: Simulated generation time of every chunk of a text answer.
+        chunk_words: Number of words per chunk.
+        error_rate: Fraction of the calls that fail with a 429, as when a quota is exceeded.
+        slow_rate: Fraction of the calls that take `slow_ms` longer, as the occasional slow response.
+        slow_ms: Extra latency of the slow calls.
+        max_concurrency: If set, the calls beyond this many in flight fail with a 429.
+        answers: Scripted text answers, keyed by agent name.
+        script: Optional callable `(llm_request, answers) -> LlmResponse` that
+                replaces `default_script`.
+        calls: Number of calls served so far.
+        in_flight: Number of calls being served.
+    """
+
+    model: str = "fake-llm"
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    chunk_latency_ms: float = 0.0
+    chunk_words: int = 4
+    error_rate: float = 0.0
+    slow_rate: float = 0.0
+    slow_ms: float = 0.0
+    max_concurrency: int = 0
+    answers: dict[str, str] = {}
+    script: Optional[Callable[[LlmRequest, dict[str, str]], LlmResponse]] = None
+    calls: int = 0
+    in_flight: int = 0
+
+    async def generate_content_async(
+        self, llm_request: LlmRequest, stream: bool = False
+    ) -> AsyncGenerator[LlmResponse, None]:
+        self.calls += 1
+        self.in_flight += 1
+        try:
+            delay_ms = self.latency_ms + random.uniform(0, self.jitter_ms)
+            if random.random() < self.slow_rate:
+                delay_ms += self.slow_ms
+            if delay_ms > 0:
+                await asyncio.sleep(delay_ms / 1000)
+            if (self.max_concurrency and self.in_flight > self.max_concurrency) or random.random() < self.error_rate:
+                raise resource_exhausted()
+        finally:
+            self.in_flight -= 1
+
+        llm_response = (self.script or default_script)(llm_request, self.answers)
+        chunks = self._chunks(llm_response)
+        if stream and len(chunks) > 1:
+            for chunk in chunks:
+                if self.chunk_latency_ms > 0:
+                    await asyncio.sleep(self.chunk_latency_ms / 1000)
+                yield LlmResponse(content=types.Content(role="model", parts=[types.Part(text=chunk)]), partial=True)
+        elif chunks and self.chunk_latency_ms > 0:
+            await asyncio.sleep(len(chunks) * self.chunk_latency_ms / 1000)
+
+        if llm_response.usage_metadata is None:
+            prompt_tokens = estimate_tokens(_request_text(llm_request))
+            completion_tokens = estimate_tokens(str(llm_response.content.model_dump(exclude_none=True))) if llm_response.content else 0
+            llm_response.usage_metadata = types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=completion_tokens,
+                total_token_count=prompt_tokens + completion_tokens,
+            )
+        yield llm_response
+
+    def _chunks(self, llm_response: LlmResponse) -> list[str]:
+        """Splits the text of a response into the chunks a streaming model would send."""
+        if not llm_response.content or not llm_response.content.parts or not llm_response.content.parts[0].text:
+            return []
+        words = re.findall(r"\s*\S+\s*", llm_response.content.parts[0].text)
+        size = max(1, self.chunk_words)
+        return ["".join(words[i:i + size]) for i in range(0, len(words), size)]
+
+
+class FakeGrammarResponse:
+    """Mimics the parts of `GenerateContentResponse` that `check_grammar` reads."""
+
+    def __init__(self, parsed, usage_metadata: types.GenerateContentResponseUsageMetadata):
+        self.parsed = parsed
+        self.usage_metadata = usage_metadata
+
+
+class _FakeModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, *, model, contents, config=None):
+        # The synchronous call blocks the calling thread, like the real one does
+        self._client.calls += 1
+        delay_ms = self._client.delay_ms()
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+        return self._client.respond(contents, config)
+
+
+class _FakeAsyncModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    async def generate_content(self, *, model, contents, config=None):
+        self._client.calls += 1
+        delay_ms = self._client.delay_ms()
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+        return self._client.respond(contents, config)
+
+
+class _FakeAio:
+
+    def __init__(self, client):
+        self.models = _FakeAsyncModels(client)
+
+
+class FakeGenaiClient:
+    """A local stand-in for the `genai.Client` used inside `check_grammar`.
+
+    Install it with `agent_grammar.agent.set_client_factory(lambda: client)`.
+
+    Args:
+        latency_ms: Simulated latency of every call.
+        jitter_ms: Maximum random latency added on top of `latency_ms`.
+        corrections: Scripted results keyed by the input text. Texts without a
+                     scripted result are returned unchanged with no errors.
+        error_rate: Fraction of the calls that fail with a 429, as when a quota is exceeded.
+        slow_rate: Fraction of the calls that take `slow_ms` longer.
+        slow_ms: Extra latency of the slow calls.
+    """
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, corrections: Optional[dict[str, dict]] = None,
+                 error_rate: float = 0.0, slow_rate: float = 0.0, slow_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.corrections = corrections or {}
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.calls = 0
+        self.models = _FakeModels(self)
+        self.aio = _FakeAio(self)
+
+    def delay_ms(self) -> float:
+        """Returns the simulated latency of a call."""
+        delay_ms = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if random.random() < self.slow_rate:
+            delay_ms += self.slow_ms
+        return delay_ms
+
+    def correct(self, text: str) -> dict:
+        """Returns the scripted result for a text."""
+        return dict(self.corrections.get(text, {"corrected_text": text, "explanations": [], "errors": []}))
+
+    def respond(self, contents, config=None) -> FakeGrammarResponse:
+        if random.random() < self.error_rate:
+            raise resource_exhausted()
+        prompt = "\n".join(str(content) for content in contents)
+        schema = getattr(config, "response_schema", None)
+        if isinstance(schema, dict) and schema.get("type") == "array":
+            # Batched request: one numbered JSON string per line
+            numbered = re.findall(r"^(\d+): (\".*\")$", prompt, re.MULTILINE)
+            parsed = [{"index": int(index), **self.correct(json.loads(text))} for index, text in numbered]
+        else:
+            match = re.search(r"Text: (.*?)\n\s*\n", prompt, re.DOTALL)
+            parsed = self.correct(match.group(1).strip() if match else prompt)
+        prompt_tokens = estimate_tokens(prompt)
+        completion_tokens = estimate_tokens(str(parsed))
+        usage_metadata = types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=completion_tokens,
+            total_token_count=prompt_tokens + completion_tokens,
+        )
+        return FakeGrammarResponse(parsed, usage_metadata)
@@ -0,0 +1,325 @@
+import os
+import math
+import time
+import asyncio
+from collections import deque
+from typing import AsyncGenerator, Awaitable, Callable, Optional, TypeVar
+
+from google.adk.agents import BaseAgent
+from google.adk.models.base_llm import BaseLlm
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+
+from harness.agent_tree import set_models
+from harness.rate_limit import RetryBudget
+
+T = TypeVar("T")
+
+# Defaults of the hedging policy, configured from the .env file
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.05"))
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "50"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "1000"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "50"))
+
+
+class LatencyWindow:
+    """The latencies of the most recent calls of one kind, and a percentile of them.
+
+    The percentile is recomputed every `refresh` new samples rather than on every call.
+    """
+
+    def __init__(self, size: int = HEDGE_WINDOW, refresh: int = 16):
+        self._samples: deque[float] = deque(maxlen=size)
+        self._refresh = refresh
+        self._since_refresh = 0
+        self._cached: dict[float, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, latency_ms: float) -> None:
+        self._samples.append(latency_ms)
+        self._since_refresh += 1
+        if self._since_refresh >= self._refresh:
+            self._cached.clear()
+            self._since_refresh = 0
+
+    def percentile(self, pct: float) -> float:
+        """Returns the nearest-rank percentile of the window (0.0 if empty)."""
+        if pct not in self._cached:
+            ordered = sorted(self._samples)
+            self._cached[pct] = ordered[max(1, math.ceil(pct / 100 * len(ordered))) - 1] if ordered else 0.0
+        return self._cached[pct]
+
+
+class HedgeStats:
+    """Counters of the hedged calls of one kind."""
+
+    def __init__(self):
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "budget_denied": self.budget_denied,
+            # Share of the calls that were hedged, and share of the hedges that answered first
+            "hedge_rate": round(self.hedges / self.calls, 4) if self.calls else 0.0,
+            "win_rate": round(self.hedge_wins / self.hedges, 4) if self.hedges else 0.0,
+        }
+
+
+class HedgePolicy:
+    """Sends a second copy of a slow call and keeps whichever answers first.
+
+    A few slow model answers dominate the tail latency of the pipelines: one
+    slow `agent_grammar` or `agent_summary` turn stalls the whole
+    `SequentialAgent`. With hedging, a call that has not answered after the
+    `percentile` of the recent latencies of its kind (at least
+    `min_delay_ms`) is sent again; the first copy to succeed is used and the
+    other is cancelled. If one copy fails, the other one is awaited.
+
+    Hedges cost extra requests, so they are capped: every call earns
+    `max_rate` of a hedge, up to a small reserve, and a hedge spends one. With
+    the defaults, at most about 5% of the calls are hedged, which is about
+    what a 95th percentile delay hedges anyway when latencies are steady; the
+    cap matters when the endpoint slows down as a whole, where hedging
+    everything would only add load. No call is hedged until `min_samples`
+    latencies of its kind are known.
+
+    Args:
+        percentile: Percentile of the recent latencies after which a call is hedged.
+        max_rate: Maximum share of the calls that are hedged.
+        min_delay_ms: Minimum wait before hedging a call.
+        window: Number of recent latencies kept per kind of call.
+        min_samples: Number of latencies needed before calls of a kind are hedged.
+
+    Examples:
+        hedging = HedgePolicy(percentile=95, max_rate=0.05)
+        install_hedging(agent_teaching_assistant, hedging)
+        print(hedging.stats())
+    """
+
+    def __init__(self, percentile: float = HEDGE_PERCENTILE, max_rate: float = HEDGE_MAX_RATE,
+                 min_delay_ms: float = HEDGE_MIN_DELAY_MS, window: int = HEDGE_WINDOW,
+                 min_samples: int = HEDGE_MIN_SAMPLES):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_delay_ms = min_delay_ms
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies: dict[str, LatencyWindow] = {}
+        self._stats: dict[str, HedgeStats] = {}
+        self._budget = RetryBudget(max_rate, max_tokens=10.0)
+
+    def hedge_delay_ms(self, key: str) -> Optional[float]:
+        """Returns how long a call of a kind may run before it is hedged, or None if it is not hedged."""
+        latencies = self._latencies.get(key)
+        if latencies is None or len(latencies) < self.min_samples:
+            return None
+        return max(self.min_delay_ms, latencies.percentile(self.percentile))
+
+    def _record(self, key: str, latency_ms: float) -> None:
+        latencies = self._latencies.get(key)
+        if latencies is None:
+            latencies = self._latencies[key] = LatencyWindow(self.window)
+        latencies.record(latency_ms)
+
+    async def call(self, key: str, send: Callable[[], Awaitable[T]],
+                   discard: Optional[Callable[[T], Awaitable[None]]] = None) -> T:
+        """Makes a call, hedging it if it is slow.
+
+        The latency of the copy that answers first is recorded. When the hedge
+        wins, the time the primary had been running is recorded too: it is a
+        lower bound of its latency, and leaving it out would hide exactly the
+        slow calls from the window, so the hedge delay would shrink.
+
+        Args:
+            key: The kind of call, e.g. the agent that makes it. Each kind has
+                 its own latency window and hedge delay.
+            send: Makes the call; called once more for the hedge.
+            discard: Releases the result of a copy that succeeded but was not
+                     used, e.g. closes a stream.
+
+        Returns:
+            The result of the first copy that succeeds.
+
+        Raises:
+            The error of the first copy, if every copy failed.
+        """
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = HedgeStats()
+        stats.calls += 1
+        self._budget.deposit()
+
+        async def timed() -> tuple[T, float]:
+            start_time = time.perf_counter()
+            result = await send()
+            return result, (time.perf_counter() - start_time) * 1000
+
+        start_time = time.perf_counter()
+        primary = asyncio.ensure_future(timed())
+        delay_ms = self.hedge_delay_ms(key)
+        tasks = [primary]
+        winner = None
+        try:
+            if delay_ms is not None:
+                await asyncio.wait([primary], timeout=delay_ms / 1000)
+                if not primary.done():
+                    if self._budget.withdraw():
+                        stats.hedges += 1
+                        tasks.append(asyncio.ensure_future(timed()))
+                    else:
+                        stats.budget_denied += 1
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # The primary first, so that a tie goes to it
+                for task in sorted(done, key=tasks.index):
+                    if task.exception() is None:
+                        winner = task
+                        result, latency_ms = task.result()
+                        self._record(key, latency_ms)
+                        if task is not primary:
+                            stats.hedge_wins += 1
+                            if not primary.done():
+                                self._record(key, (time.perf_counter() - start_time) * 1000)
+                        return result
+            # Every copy failed
+            raise primary.exception()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            # The losers are awaited so that they release what they hold before the call returns
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if discard is not None:
+                for task in tasks:
+                    if task is not winner and not task.cancelled() and task.exception() is None:
+                        await discard(task.result()[0])
+
+    def stats(self) -> dict:
+        """Returns the counters of every kind of call, with its hedge rate, win rate and current hedge delay."""
+        report = {}
+        for key, stats in self._stats.items():
+            report[key] = stats.to_dict()
+            delay_ms = self.hedge_delay_ms(key)
+            report[key]["hedge_delay_ms"] = round(delay_ms, 3) if delay_ms is not None else None
+        return report
+
+
+class HedgedLlm(BaseLlm):
+    """Hedges the model calls of an agent with a `HedgePolicy`.
+
+    Only the wait for the first response is hedged: the copy that answers
+    first also streams the rest of the answer, and the other one is cancelled.
+
+    Attributes:
+        inner: The model that serves the calls.
+        policy: The policy shared with the other agents and `check_grammar`.
+        key: The kind of call the latencies are tracked under, by default the agent's name.
+    """
+
+    inner: BaseLlm
+    policy: HedgePolicy
+    key: str
+
+    async def generate_content_async(
+        self, llm_request: LlmRequest, stream: bool = False
+    ) -> AsyncGenerator[LlmResponse, None]:
+
+        async def start() -> tuple[Optional[LlmResponse], AsyncGenerator[LlmResponse, None]]:
+            responses = self.inner.generate_content_async(llm_request, stream=stream)
+            try:
+                return await anext(responses, None), responses
+            except BaseException:
+                await responses.aclose()
+                raise
+
+        # A copy that answered but lost still has its stream open
+        first_response, responses = await self.policy.call(self.key, start,
+                                                            discard=lambda result: result[1].aclose())
+        if first_response is None:
+            return
+        yield first_response
+        async for llm_response in responses:
+            yield llm_response
+
+
+class _HedgedModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, *, model, contents, config=None):
+        # The synchronous client is used by nothing in the walkthrough; it is passed through unhedged
+        return self._client.inner.models.generate_content(model=model, contents=contents, config=config)
+
+
+class _HedgedAsyncModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    async def generate_content(self, *, model, contents, config=None):
+        return await self._client.policy.call(
+            f"check_grammar:{model}",
+            lambda: self._client.inner.aio.models.generate_content(model=model, contents=contents, config=config))
+
+
+class _HedgedAio:
+
+    def __init__(self, client):
+        self.models = _HedgedAsyncModels(client)
+
+
+class HedgedGenaiClient:
+    """Hedges the `generate_content` calls a tool makes through a genai client with a `HedgePolicy`.
+
+    Args:
+        policy: The policy shared with the agents' models.
+        inner: The client that serves the calls.
+    """
+
+    def __init__(self, policy: HedgePolicy, inner):
+        self.policy = policy
+        self.inner = inner
+        self.models = _HedgedModels(self)
+        self.aio = _HedgedAio(self)
+
+
+def install_hedging(agent: BaseAgent, policy: HedgePolicy) -> None:
+    """Hedges every model call of an agent tree, and those of `check_grammar`, with a policy.
+
+    Install it after `install_rate_limiter`, so the hedges also go through
+    the rate limiter. Installing the same policy twice has no effect.
+
+    Args:
+        agent: The root of the agent tree.
+        policy: The hedging policy, usually one per process.
+    """
+    from agent_grammar import agent as grammar_module
+
+    set_models(agent, lambda llm_agent: (
+        llm_agent.canonical_model
+        if isinstance(llm_agent.canonical_model, HedgedLlm) and llm_agent.canonical_model.policy is policy
+        else HedgedLlm(model=llm_agent.canonical_model.model, inner=llm_agent.canonical_model, policy=policy,
+                       key=llm_agent.name)))
+
+    inner_factory = grammar_module.set_client_factory(None)
+    if getattr(inner_factory, "hedging", None) is policy:
+        grammar_module.set_client_factory(inner_factory)
+        return
+
+    def hedged_factory():
+        return HedgedGenaiClient(policy, inner_factory())
+
+    hedged_factory.hedging = policy
+    grammar_module.set_client_factory(hedged_factory)
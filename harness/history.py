@@ -0,0 +1,246 @@
+import os
+import time
+import asyncio
+from typing import Optional, Union
+
+from google.adk.agents import BaseAgent
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.events import Event, EventActions
+from google.adk.models.base_llm import BaseLlm
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.registry import LLMRegistry
+from google.adk.sessions import BaseSessionService
+from google.adk.sessions.base_session_service import GetSessionConfig
+from google.genai import types
+
+from harness.agent_tree import prepend_callback, record_installed
+
+# Defaults of the history policy, configured from the .env file
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", "6"))
+HISTORY_SUMMARIZE_EVERY = int(os.getenv("HISTORY_SUMMARIZE_EVERY", "4"))
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gemini-2.0-flash-001")
+HISTORY_SUMMARY_WORDS = int(os.getenv("HISTORY_SUMMARY_WORDS", "200"))
+
+# Session state holding the rolling summary, and the timestamp of the last event it covers
+SUMMARY_STATE_KEY = "history_summary"
+SUMMARY_UNTIL_STATE_KEY = "history_summary_until"
+# Author of the (content-less) events that store a new summary in the session state
+SUMMARY_AUTHOR = "history_summarizer"
+
+SUMMARY_PROMPT = """
+You keep a running summary of a conversation between a young student and a
+teaching assistant made of several agents. Update the summary with the new
+turns below. Keep what the student asked, the answers and results they got,
+their recurring grammar mistakes and anything they said about themselves.
+Drop greetings and repetitions. Write at most {max_words} words of plain text.
+
+Summary so far:
+{summary}
+
+New turns:
+{transcript}
+"""
+
+# Introduces the summary where the older turns used to be
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def split_turns(events: list[Event]) -> list[list[Event]]:
+    """Splits the events of a session into turns, each starting with a message of the user.
+
+    Events before the first message of the user (if any) form a turn of their own.
+    """
+    turns: list[list[Event]] = []
+    for event in events:
+        if not turns or (event.author == "user" and event.content):
+            turns.append([])
+        turns[-1].append(event)
+    return turns
+
+
+def turn_transcript(turns: list[list[Event]]) -> str:
+    """Formats the text of turns as "author: text" lines. Tool calls and responses are left out."""
+    lines = []
+    for turn in turns:
+        for event in turn:
+            if event.partial or not event.content or not event.content.parts:
+                continue
+            text = "".join(part.text for part in event.content.parts if part.text and not part.thought).strip()
+            if text:
+                lines.append(f"{event.author}: {text}")
+    return "\n".join(lines)
+
+
+class HistoryPolicy:
+    """Keeps the prompt of long conversations bounded.
+
+    Reusing a session across queries makes every agent read the whole
+    transcript again on every turn, so prompt tokens and latency grow with the
+    length of the conversation. With the policy installed on the root agent
+    (see `apply_history`), the agents of a turn see only:
+
+    - the last `keep_turns` turns verbatim, and
+    - a rolling summary of the turns before them, as a first user message.
+
+    The summary is kept in the session state and updated incrementally: once
+    `summarize_every` turns have left the window, a background task folds them
+    into the summary with one model call, while the turn that triggered it
+    goes on. A turn never waits for the summary; until the summary catches up,
+    the turns it does not cover yet stay in the prompt verbatim, so nothing is
+    lost. The prompt therefore holds at most about `keep_turns +
+    summarize_every` turns and a summary of at most `max_summary_words` words,
+    however long the conversation runs.
+
+    Only the agents' view of the session is trimmed: the session service keeps
+    every event (within its own limits, e.g. `SESSION_MAX_EVENTS`).
+
+    Args:
+        keep_turns: Number of most recent turns, the current one included, kept verbatim.
+        summarize_every: Number of turns folded into the summary at once.
+        summarizer: The model (name or `BaseLlm`) that writes the summary, or
+                    None to drop the older turns without a summary.
+        max_summary_words: Length limit of the summary given to the summarizer.
+
+    Attributes:
+        summaries: Number of summary updates written.
+        summarized_turns: Number of turns folded into summaries.
+        failures: Number of summary updates that failed (they are retried on a later turn).
+        summary_ms: Total time spent writing summaries, in the background.
+
+    Examples:
+        history = HistoryPolicy(keep_turns=6)
+        apply_history(agent_teaching_assistant, history)
+        results = asyncio.run(send_conversation(agent_teaching_assistant, queries))
+    """
+
+    def __init__(self, keep_turns: int = HISTORY_KEEP_TURNS, summarize_every: int = HISTORY_SUMMARIZE_EVERY,
+                 summarizer: Union[str, BaseLlm, None] = HISTORY_SUMMARY_MODEL,
+                 max_summary_words: int = HISTORY_SUMMARY_WORDS):
+        if keep_turns < 1:
+            raise ValueError("keep_turns must be at least 1.")
+        self.keep_turns = keep_turns
+        self.summarize_every = max(1, summarize_every)
+        self.max_summary_words = max_summary_words
+        self._summarizer = summarizer
+        self.summaries = 0
+        self.summarized_turns = 0
+        self.failures = 0
+        self.summary_ms = 0.0
+        # Summary updates in flight, at most one per session
+        self._tasks: dict[tuple[str, str, str], asyncio.Task] = {}
+
+    @property
+    def summarizer(self) -> Optional[BaseLlm]:
+        """The model that writes the summary, built from its name on first use."""
+        if isinstance(self._summarizer, str):
+            self._summarizer = LLMRegistry.new_llm(self._summarizer)
+        return self._summarizer
+
+    @summarizer.setter
+    def summarizer(self, summarizer: Union[str, BaseLlm, None]) -> None:
+        self._summarizer = summarizer
+
+    def stats(self) -> dict:
+        """Returns the summary counters and the number of updates in flight."""
+        return {
+            "summaries": self.summaries,
+            "summarized_turns": self.summarized_turns,
+            "failures": self.failures,
+            "summary_ms": round(self.summary_ms, 3),
+            "pending": len(self._tasks),
+        }
+
+    async def drain(self) -> None:
+        """Waits for the summary updates in flight, e.g. before reading the stats."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def before_agent(self, callback_context: CallbackContext) -> None:
+        """Trims the root agent's view of the session to the window and the summary.
+
+        Used as the `before_agent_callback` of the root agent. The session the
+        runner holds is its own copy, so the stored session is left untouched,
+        and the events of this turn are still appended to both.
+        """
+        ctx = callback_context._invocation_context
+        session = ctx.session
+        turns = split_turns(session.events)
+        summary = session.state.get(SUMMARY_STATE_KEY) or ""
+        until = session.state.get(SUMMARY_UNTIL_STATE_KEY) or 0.0
+
+        window_start = max(len(turns) - self.keep_turns, 0)
+        if self._summarizer is not None:
+            # Turns the summary does not cover yet stay verbatim
+            unsummarized = next((index for index, turn in enumerate(turns) if turn[0].timestamp > until), len(turns))
+            overdue = turns[unsummarized:window_start]
+            if len(overdue) >= self.summarize_every:
+                self._schedule(ctx.session_service, session.app_name, session.user_id, session.id, summary, overdue)
+            window_start = min(window_start, unsummarized)
+        if window_start == 0:
+            return None
+
+        events = [event for turn in turns[window_start:] for event in turn]
+        if summary:
+            events.insert(0, Event(invocation_id=ctx.invocation_id, author="user", timestamp=events[0].timestamp,
+                                   content=types.Content(role="user",
+                                                         parts=[types.Part(text=SUMMARY_PREFIX + summary)])))
+        session.events = events
+        return None
+
+    def _schedule(self, session_service: BaseSessionService, app_name: str, user_id: str, session_id: str,
+                  summary: str, turns: list[list[Event]]) -> None:
+        key = (app_name, user_id, session_id)
+        if key in self._tasks:
+            return
+        task = asyncio.create_task(self._summarize(session_service, key, summary, turns))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+    async def _summarize(self, session_service: BaseSessionService, key: tuple[str, str, str], summary: str,
+                         turns: list[list[Event]]) -> None:
+        """Folds turns into the summary and stores it in the session state."""
+        start_time = time.perf_counter()
+        try:
+            prompt = SUMMARY_PROMPT.format(max_words=self.max_summary_words, summary=summary or "(none)",
+                                           transcript=turn_transcript(turns))
+            llm = self.summarizer
+            llm_request = LlmRequest(model=llm.model,
+                                     contents=[types.Content(role="user", parts=[types.Part(text=prompt)])],
+                                     config=types.GenerateContentConfig(temperature=0.0))
+            text = ""
+            async for llm_response in llm.generate_content_async(llm_request):
+                if llm_response.partial or not llm_response.content or not llm_response.content.parts:
+                    continue
+                text = "".join(part.text for part in llm_response.content.parts if part.text and not part.thought)
+            if not text.strip():
+                raise ValueError("the summarizer returned no text")
+
+            app_name, user_id, session_id = key
+            # Only the state is needed, so as few events as possible are loaded
+            session = await session_service.get_session(app_name=app_name, user_id=user_id, session_id=session_id,
+                                                        config=GetSessionConfig(num_recent_events=1))
+            if session is None:
+                return
+            await session_service.append_event(session, Event(
+                invocation_id="e-history", author=SUMMARY_AUTHOR,
+                actions=EventActions(state_delta={SUMMARY_STATE_KEY: text.strip(),
+                                                  SUMMARY_UNTIL_STATE_KEY: turns[-1][-1].timestamp})))
+            self.summaries += 1
+            self.summarized_turns += len(turns)
+        except Exception:
+            # The turns stay verbatim and the next turn tries again
+            self.failures += 1
+        finally:
+            self.summary_ms += (time.perf_counter() - start_time) * 1000
+
+
+def apply_history(agent: BaseAgent, policy: HistoryPolicy) -> None:
+    """Installs a history policy on the root agent of a tree.
+
+    The policy's callback is put first among the agent's `before_agent_callback`s,
+    so the sub-agents see the trimmed session. Installing the same policy twice
+    has no effect.
+    """
+    agent.before_agent_callback = prepend_callback(agent.before_agent_callback, policy.before_agent)
+    # Found by install_rate_limiter, which limits the summarizer too
+    record_installed(agent, policy)
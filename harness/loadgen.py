@@ -0,0 +1,442 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass, field
+from typing import Optional
+
+from harness.benchmark import CORPORA, install_fake_models, load_pipeline
+from harness.query import get_runner, send_query
+
+# Arrival processes
+POISSON = "poisson"
+CONSTANT = "constant"
+
+# Percentiles of the reports, as in the percentile distribution of HdrHistogram
+PERCENTILES = (50, 75, 90, 95, 99, 99.9)
+
+
+class LatencyHistogram:
+    """A log-linear histogram of latencies, after HdrHistogram.
+
+    Values are recorded in microseconds. Values below 128 µs have their own
+    bucket; above that, every power of two is split into 64 linear buckets,
+    so any value is known to within 1% whatever its magnitude, in a few
+    hundred buckets however many values are recorded. Histograms of several
+    runs or processes can be merged.
+
+    Examples:
+        histogram = LatencyHistogram()
+        histogram.record_ms(12.5)
+        histogram.percentile_ms(99)
+    """
+
+    SUB_BUCKET_BITS = 7
+    HALF = 1 << (SUB_BUCKET_BITS - 1)
+
+    def __init__(self):
+        self.counts: dict[int, int] = {}
+        self.count = 0
+        self.total_us = 0
+        self.min_us: Optional[int] = None
+        self.max_us = 0
+
+    @classmethod
+    def _index(cls, value_us: int) -> int:
+        shift = max(0, value_us.bit_length() - cls.SUB_BUCKET_BITS)
+        return shift * cls.HALF + (value_us >> shift)
+
+    @classmethod
+    def _value(cls, index: int) -> int:
+        """Returns the middle of a bucket."""
+        if index < 2 * cls.HALF:
+            return index
+        shift = (index - cls.HALF) // cls.HALF
+        return ((index - shift * cls.HALF) << shift) + (1 << (shift - 1))
+
+    def record_ms(self, value_ms: float) -> None:
+        """Records a latency in milliseconds."""
+        value_us = max(0, int(value_ms * 1000))
+        index = self._index(value_us)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total_us += value_us
+        self.min_us = value_us if self.min_us is None else min(self.min_us, value_us)
+        self.max_us = max(self.max_us, value_us)
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        """Adds the values recorded by another histogram."""
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total_us += other.total_us
+        if other.min_us is not None:
+            self.min_us = other.min_us if self.min_us is None else min(self.min_us, other.min_us)
+        self.max_us = max(self.max_us, other.max_us)
+
+    def percentile_ms(self, pct: float) -> float:
+        """Returns the value below which `pct` percent of the recorded values fall (0.0 if empty)."""
+        if not self.count:
+            return 0.0
+        rank = max(1, round(pct / 100 * self.count + 0.4999))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                # The exact extremes are known, so the estimate never leaves them
+                return min(max(self._value(index), self.min_us), self.max_us) / 1000
+        return self.max_us / 1000
+
+    def summary(self) -> dict:
+        """Returns the count, mean, percentiles and max in milliseconds."""
+        summary = {"count": self.count, "mean": round(self.total_us / self.count / 1000, 3) if self.count else 0.0}
+        for pct in PERCENTILES:
+            summary[f"p{pct:g}"] = round(self.percentile_ms(pct), 3)
+        summary["max"] = self.max_us / 1000
+        return summary
+
+    def to_dict(self) -> dict:
+        return {"counts": {str(index): count for index, count in sorted(self.counts.items())},
+                "count": self.count, "total_us": self.total_us, "min_us": self.min_us, "max_us": self.max_us}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatencyHistogram":
+        histogram = cls()
+        histogram.counts = {int(index): count for index, count in data["counts"].items()}
+        histogram.count = data["count"]
+        histogram.total_us = data["total_us"]
+        histogram.min_us = data["min_us"]
+        histogram.max_us = data["max_us"]
+        return histogram
+
+
+def load_corpus(path: Optional[str], pipeline: str) -> list[dict]:
+    """Reads a JSONL corpus of queries, or returns the benchmark corpus of the pipeline.
+
+    Every line is an object with a "query" and, optionally, the "user_id"
+    that sends it (a plain JSON string is a query too). Queries without a user
+    are each sent by a user of their own.
+    """
+    if not path:
+        return [{"query": query} for query in CORPORA[pipeline]]
+    corpus = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            corpus.append({"query": item} if isinstance(item, str) else item)
+    if not corpus:
+        raise ValueError(f"The corpus {path} has no queries.")
+    return corpus
+
+
+def arrival_times(rate_qps: float, duration_s: float, arrival: str = POISSON, seed: Optional[int] = None) -> list[float]:
+    """Returns the send times of a run, in seconds from its start.
+
+    Poisson arrivals have exponentially distributed gaps, like independent
+    users; constant arrivals are evenly spaced.
+    """
+    generator = random.Random(seed)
+    times, now = [], 0.0
+    while True:
+        now += generator.expovariate(rate_qps) if arrival == POISSON else 1 / rate_qps
+        if now >= duration_s:
+            return times
+        times.append(now)
+
+
+@dataclass
+class Outcome:
+    """The outcome of one request: its latency from the intended send time, and its error if it failed."""
+    scheduled_s: float
+    latency_ms: float = 0.0
+    first_token_ms: Optional[float] = None
+    error: Optional[str] = None
+    done_s: float = 0.0
+
+
+@dataclass
+class Target:
+    """Where the load goes: the in-process harness, or the HTTP server of `harness/server.py`.
+
+    Attributes:
+        pipeline: The agent to query.
+        url: The base URL of the server, or None for the in-process harness.
+        stream: Whether to stream the answers, to also measure the time to first token.
+        timeout_s: Time after which a request counts as failed.
+    """
+    pipeline: str
+    url: Optional[str] = None
+    stream: bool = False
+    timeout_s: float = 120.0
+    _runner: object = field(default=None, repr=False)
+    _client: object = field(default=None, repr=False)
+
+    async def open(self, fake_latency_ms: Optional[float] = None) -> None:
+        if self.url:
+            import httpx
+            # No connection limit: the arrival rate, not the client, decides the load
+            self._client = httpx.AsyncClient(timeout=self.timeout_s,
+                                             limits=httpx.Limits(max_connections=None, max_keepalive_connections=256))
+        else:
+            agent = load_pipeline(self.pipeline)
+            if fake_latency_ms is not None:
+                install_fake_models(agent, fake_latency_ms, tool_latency_ms=fake_latency_ms)
+            self._runner = get_runner(agent)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def send(self, item: dict) -> tuple[Optional[str], Optional[float]]:
+        """Sends one query. Returns its error (None if it succeeded) and its time to first token from now."""
+        user_id = item["user_id"]
+        if not self.url:
+            result = await asyncio.wait_for(send_query(self._runner, item["query"], user_id=user_id, stream=self.stream),
+                                            timeout=self.timeout_s)
+            # When the user starts reading the answer: the first token of the agent that gives it
+            first_token = result.time_to_first_token_ms.get(result.author)
+            return (result.error.split(":")[0] if result.error else None), first_token
+
+        url = f"{self.url.rstrip('/')}/agents/{self.pipeline}/query"
+        body = {"query": item["query"], "user_id": user_id, "stream": self.stream}
+        if not self.stream:
+            response = await self._client.post(url, json=body)
+            return (None if response.status_code == 200 else f"HTTP {response.status_code}"), None
+
+        start_time = time.perf_counter()
+        first_token = None
+        async with self._client.stream("POST", url, json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return f"HTTP {response.status_code}", None
+            error = None
+            async for line in response.aiter_lines():
+                if line.startswith("event: text") and first_token is None:
+                    first_token = (time.perf_counter() - start_time) * 1000
+                elif line.startswith("data: ") and '"latency_ms"' in line:
+                    result_error = json.loads(line[len("data: "):]).get("error")
+                    error = result_error.split(":")[0] if result_error else None
+            return error, first_token
+
+
+async def run_load(target: Target, corpus: list[dict], rate_qps: float, duration_s: float,
+                   warmup_s: float = 5.0, cooldown_s: float = 5.0, arrival: str = POISSON,
+                   seed: Optional[int] = None, max_outstanding: int = 10_000,
+                   fake_latency_ms: Optional[float] = None) -> dict:
+    """Sends queries at a fixed arrival rate and reports latency, errors and throughput.
+
+    The load is open loop: queries are sent at their scheduled times whether or
+    not the earlier ones have been answered, as independent users would, so a
+    slow server builds up a queue instead of slowing the load down. Latency is
+    measured from the scheduled send time, so time spent waiting for a late
+    send is counted too.
+
+    The run has three phases: `warmup_s` to fill caches and pools, the
+    measured `duration_s`, and `cooldown_s` during which queries keep arriving
+    so that the last measured queries see the same load as the first. Only the
+    queries sent during the measured phase count for latency and errors; the
+    throughput is the number of successful answers completed during it.
+
+    Args:
+        target: Where to send the queries.
+        corpus: The queries (see `load_corpus`), sent in order and repeated as needed.
+        rate_qps: The arrival rate in queries per second.
+        duration_s: The length of the measured phase.
+        warmup_s: The length of the warmup phase.
+        cooldown_s: The length of the cooldown phase.
+        arrival: "poisson" or "constant".
+        seed: Seed of the Poisson arrivals, for reproducible runs.
+        max_outstanding: Maximum number of queries in flight. Queries arriving
+                         beyond it are dropped and counted as errors, so the
+                         generator itself cannot run out of memory.
+        fake_latency_ms: For the in-process harness, replace the models with
+                         local fakes of this latency.
+
+    Returns:
+        A report with the settings, the "latency_ms" (and, when streaming,
+        "first_token_ms") percentiles and "histogram", "errors" by kind,
+        "error_rate", "throughput_qps" and "offered_qps".
+    """
+    await target.open(fake_latency_ms)
+    measure_start, measure_end = warmup_s, warmup_s + duration_s
+    schedule = arrival_times(rate_qps, warmup_s + duration_s + cooldown_s, arrival, seed)
+    outcomes: list[Outcome] = []
+    tasks: set[asyncio.Task] = set()
+    max_lag_ms = 0.0
+
+    async def _send(outcome: Outcome, item: dict):
+        sent_s = time.perf_counter() - start_time
+        try:
+            outcome.error, first_token = await target.send(item)
+            if first_token is not None:
+                # Counted from the scheduled send time, like the latency
+                outcome.first_token_ms = (sent_s - outcome.scheduled_s) * 1000 + first_token
+        except asyncio.TimeoutError:
+            outcome.error = "timeout"
+        except Exception as e:
+            outcome.error = type(e).__name__
+        outcome.done_s = time.perf_counter() - start_time
+        outcome.latency_ms = (outcome.done_s - outcome.scheduled_s) * 1000
+
+    start_time = time.perf_counter()
+    try:
+        for number, scheduled_s in enumerate(schedule):
+            delay = scheduled_s - (time.perf_counter() - start_time)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                max_lag_ms = max(max_lag_ms, -delay * 1000)
+            outcome = Outcome(scheduled_s=scheduled_s)
+            outcomes.append(outcome)
+            if len(tasks) >= max_outstanding:
+                outcome.error = "dropped"
+                outcome.done_s = scheduled_s
+                continue
+            item = corpus[number % len(corpus)]
+            # Every query is its own user unless the corpus says otherwise, as the server limits users
+            item = {**item, "user_id": item.get("user_id") or f"loadgen-{number}"}
+            task = asyncio.create_task(_send(outcome, item))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(list(tasks), timeout=target.timeout_s)
+        for task in list(tasks):
+            task.cancel()
+    finally:
+        await target.close()
+
+    measured = [outcome for outcome in outcomes if measure_start <= outcome.scheduled_s < measure_end]
+    latency, first_token = LatencyHistogram(), LatencyHistogram()
+    errors: dict[str, int] = {}
+    for outcome in measured:
+        if outcome.done_s == 0.0 and outcome.error is None:
+            outcome.error = "timeout"
+        if outcome.error:
+            errors[outcome.error] = errors.get(outcome.error, 0) + 1
+            continue
+        latency.record_ms(outcome.latency_ms)
+        if outcome.first_token_ms is not None:
+            first_token.record_ms(outcome.first_token_ms)
+    completed = sum(1 for outcome in outcomes
+                    if outcome.error is None and outcome.done_s and measure_start <= outcome.done_s < measure_end)
+
+    report = {
+        "target": target.url or "in-process",
+        "pipeline": target.pipeline,
+        "arrival": arrival,
+        "rate_qps": rate_qps,
+        "duration_s": duration_s,
+        "warmup_s": warmup_s,
+        "cooldown_s": cooldown_s,
+        "sent": len(measured),
+        "succeeded": latency.count,
+        "errors": dict(sorted(errors.items())),
+        "error_rate": round(sum(errors.values()) / len(measured), 4) if measured else 0.0,
+        "offered_qps": round(len(measured) / duration_s, 2),
+        "throughput_qps": round(completed / duration_s, 2),
+        "max_send_lag_ms": round(max_lag_ms, 3),
+        "latency_ms": latency.summary(),
+        "histogram": latency.to_dict(),
+    }
+    if first_token.count:
+        report["first_token_ms"] = first_token.summary()
+    return report
+
+
+def format_report(report: dict) -> str:
+    """Formats a load report: settings, throughput, errors and the latency percentile distribution."""
+    lines = [f"{report['pipeline']} @ {report['target']}: {report['arrival']} arrivals at {report['rate_qps']} qps "
+             f"for {report['duration_s']} s (warmup {report['warmup_s']} s, cooldown {report['cooldown_s']} s)",
+             f"sent {report['sent']}, succeeded {report['succeeded']}, error rate {report['error_rate']:.2%} "
+             f"{report['errors'] or ''}".rstrip(),
+             f"offered {report['offered_qps']} qps, throughput {report['throughput_qps']} qps, "
+             f"max send lag {report['max_send_lag_ms']} ms"]
+    histograms = [("latency", report["latency_ms"])]
+    if "first_token_ms" in report:
+        histograms.append(("first token", report["first_token_ms"]))
+    for name, summary in histograms:
+        lines.append(f"{name} (ms):")
+        for key, value in summary.items():
+            if key != "count":
+                lines.append(f"  {key:>6}: {value:>10.3f}")
+    return "\n".join(lines)
+
+
+def _delta(a: float, b: float) -> str:
+    return f"{(b - a) / a:+.1%}" if a else ""
+
+
+def compare_reports(a: dict, b: dict) -> str:
+    """Formats two load reports side by side, with the change from the first to the second."""
+    rows = [("offered_qps", a["offered_qps"], b["offered_qps"]),
+            ("throughput_qps", a["throughput_qps"], b["throughput_qps"]),
+            ("error_rate", a["error_rate"], b["error_rate"])]
+    rows += [(f"latency {key}", a["latency_ms"][key], b["latency_ms"][key])
+             for key in a["latency_ms"] if key != "count"]
+    if "first_token_ms" in a and "first_token_ms" in b:
+        rows += [(f"first token {key}", a["first_token_ms"][key], b["first_token_ms"][key])
+                 for key in a["first_token_ms"] if key != "count"]
+    width = max(len(row[0]) for row in rows)
+    lines = [f"{'':<{width}} {'A':>12} {'B':>12} {'change':>9}"]
+    for name, value_a, value_b in rows:
+        lines.append(f"{name:<{width}} {value_a:>12} {value_b:>12} {_delta(value_a, value_b):>9}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Open-loop load generator for the walkthrough pipelines.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Send queries at a fixed arrival rate.")
+    run.add_argument("--pipeline", choices=sorted(CORPORA), default="teaching")
+    run.add_argument("--corpus", metavar="PATH",
+                     help="JSONL file of queries ({\"query\": ..., \"user_id\": ...}). Defaults to the benchmark corpus.")
+    run.add_argument("--url", help="Base URL of harness/server.py. Defaults to the in-process harness.")
+    run.add_argument("--rate", type=float, required=True, help="Arrival rate in queries per second.")
+    run.add_argument("--arrival", choices=[POISSON, CONSTANT], default=POISSON)
+    run.add_argument("--duration-s", type=float, default=30.0, help="Length of the measured phase.")
+    run.add_argument("--warmup-s", type=float, default=5.0)
+    run.add_argument("--cooldown-s", type=float, default=5.0)
+    run.add_argument("--stream", action="store_true", help="Stream the answers and measure the time to first token.")
+    run.add_argument("--timeout-s", type=float, default=120.0, help="Time after which a query counts as failed.")
+    run.add_argument("--max-outstanding", type=int, default=10_000,
+                     help="Queries in flight beyond which new arrivals are dropped (and counted as errors).")
+    run.add_argument("--seed", type=int, help="Seed of the Poisson arrivals.")
+    run.add_argument("--fake-latency-ms", type=float,
+                     help="In process, replace the models with local fakes of this latency.")
+    run.add_argument("--output", metavar="PATH", help="Write the report, with its histogram, to PATH (JSON).")
+    run.add_argument("--json", action="store_true", help="Print the report as JSON.")
+
+    compare = commands.add_parser("compare", help="Compare two reports written with --output.")
+    compare.add_argument("a", help="The baseline report.")
+    compare.add_argument("b", help="The report to compare with the baseline.")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.a, encoding="utf-8") as f:
+            report_a = json.load(f)
+        with open(args.b, encoding="utf-8") as f:
+            report_b = json.load(f)
+        print(compare_reports(report_a, report_b))
+        return 0
+
+    target = Target(pipeline=args.pipeline, url=args.url, stream=args.stream, timeout_s=args.timeout_s)
+    report = asyncio.run(run_load(target, load_corpus(args.corpus, args.pipeline), args.rate, args.duration_s,
+                                  args.warmup_s, args.cooldown_s, args.arrival, args.seed, args.max_outstanding,
+                                  args.fake_latency_ms))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(format_report(report))
+    return 1 if report["error_rate"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
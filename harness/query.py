@@ -0,0 +1,297 @@
+import time
+import uuid
+import asyncio
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from google.adk.agents.run_config import RunConfig, StreamingMode
+from google.adk.events import Event
+from google.adk.runners import Runner
+from google.genai import types
+
+from harness.bounded_services import BoundedInMemoryArtifactService, BoundedInMemorySessionService
+from harness.deadlines import DEADLINE_AUTHOR, DeadlinePolicy
+from harness.response_cache import ResponseCache, agent_fingerprint, run_cached
+from harness.tracing import end_open_spans
+
+# Default number of queries allowed in flight at the same time
+DEFAULT_CONCURRENCY = 8
+
+# Services shared by every runner built in this module, unless the caller
+# provides its own. They are bounded, so long benchmark runs keep a flat memory
+# profile; sessions evicted from memory take their artifacts with them.
+default_artifact_service = BoundedInMemoryArtifactService()
+default_session_service = BoundedInMemorySessionService(on_evict=default_artifact_service.delete_session_artifacts)
+
+# One runner per (agent, app name). Runners are stateless between invocations,
+# so building them once and reusing them avoids paying the setup per query.
+_runners: dict[tuple[int, str], Runner] = {}
+
+
+@dataclass
+class QueryResult:
+    """The outcome of a single query sent to an agent.
+
+    Attributes:
+        query: The query text that was sent.
+        response: The text of the last final response, or None if the agent
+                  did not produce one.
+        latency_ms: Time from sending the query to the last final response.
+        author: The agent that authored the final response.
+        num_events: Number of events streamed back by the runner.
+        error: The error message if the query failed, otherwise None.
+        input_tokens: Prompt tokens of the model calls, keyed by the agent that made them.
+        time_to_first_token_ms: Time from sending the query to the first text of
+                                each agent, keyed by agent. When streaming, this is
+                                the first partial chunk.
+        time_to_last_token_ms: Time from sending the query to the last text of
+                               each agent, keyed by agent.
+        deadline_stage: The stage that was running when the deadline of the
+                        query expired (see `harness/deadlines.py`), or None if
+                        it did not. The response is then the partial or fallback
+                        answer, authored "deadline".
+    """
+    query: str
+    response: Optional[str] = None
+    latency_ms: float = 0.0
+    author: Optional[str] = None
+    num_events: int = 0
+    error: Optional[str] = None
+    input_tokens: dict[str, int] = field(default_factory=dict)
+    time_to_first_token_ms: dict[str, float] = field(default_factory=dict)
+    time_to_last_token_ms: dict[str, float] = field(default_factory=dict)
+    deadline_stage: Optional[str] = None
+
+
+class StreamPrinter:
+    """Prints text as it arrives, with the name of the agent before each new answer.
+
+    Use it as the `on_text` callback of `send_query`.
+
+    Examples:
+        result = await send_query(runner, "Multiply 1 and 10", stream=True, on_text=StreamPrinter())
+    """
+
+    def __init__(self):
+        self._author = None
+
+    def __call__(self, author: str, text: str) -> None:
+        if author != self._author:
+            print(f"\n[{author}] ", end="")
+            self._author = author
+        print(text, end="", flush=True)
+
+
+def _event_text(event: Event) -> str:
+    if not event.content or not event.content.parts:
+        return ""
+    return "".join(part.text for part in event.content.parts if part.text and not part.thought)
+
+
+def get_runner(agent, app_name: Optional[str] = None, session_service=None, artifact_service=None) -> Runner:
+    """Returns the shared runner for an agent, creating it on first use.
+
+    Args:
+        agent: The root agent the runner executes.
+        app_name: The application name used for sessions. Defaults to the agent name.
+        session_service: Session service for a newly created runner. Defaults to
+                         the module-level in-memory service.
+        artifact_service: Artifact service for a newly created runner. Defaults
+                          to the module-level in-memory service.
+
+    Returns:
+        A `Runner` that is reused by every later call with the same agent and app name
+        (and the same services, if given).
+    """
+    app_name = app_name or agent.name
+    key = (id(agent), app_name)
+    runner = _runners.get(key)
+    # The identity check guards against a recycled id() of a garbage collected agent
+    if (runner is None or runner.agent is not agent
+            or (session_service is not None and runner.session_service is not session_service)
+            or (artifact_service is not None and runner.artifact_service is not artifact_service)):
+        runner = Runner(app_name=app_name,
+                        agent=agent,
+                        artifact_service=artifact_service or default_artifact_service,
+                        session_service=session_service or default_session_service)
+        _runners[key] = runner
+    return runner
+
+
+async def send_query(runner: Runner, query: str, user_id: str = "user", session_id: Optional[str] = None,
+                     cache: Optional[ResponseCache] = None, fingerprint: Optional[str] = None,
+                     stream: bool = False, on_text: Optional[Callable[[str, str], None]] = None,
+                     new_session: bool = True, deadlines: Optional[DeadlinePolicy] = None,
+                     deadline_s: Optional[float] = None) -> QueryResult:
+    """Sends one query through a runner in a new session and collects the result.
+
+    Unlike the chapter scripts, nothing is printed, and failures are reported in
+    the result instead of being raised so that one bad query does not abort a batch.
+
+    With `stream`, the models stream their answers (SSE) and each agent's text
+    arrives in partial chunks before the final response, so the time to its
+    first token is much shorter than the time to its last token. Both are
+    recorded per agent either way.
+
+    Args:
+        runner: The runner to use, usually obtained from `get_runner`.
+        query: The query to send to the agent.
+        user_id: The user that owns the session.
+        session_id: The session to create. A unique id is generated if omitted.
+        cache: Optional response cache. Repeated queries are answered from it by
+               replaying the events of an earlier run (see `harness/response_cache.py`).
+        fingerprint: The `agent_fingerprint` of the runner's agent, used with `cache`.
+                     Computed per query if omitted.
+        stream: Whether to stream the model answers.
+        on_text: Optional callable `(author, text)` called with every new piece of
+                 text as it arrives: the partial chunks when streaming, and the
+                 whole text of answers that were not streamed (e.g. cached ones).
+                 `StreamPrinter` prints them.
+        new_session: Whether to create the session. Set it to False to continue
+                     an existing conversation (see `send_conversation`).
+        deadlines: Optional deadline policy. The query, session creation
+                   excepted, is cut short when its deadline expires, and
+                   answered with what the agents wrote so far or a fallback
+                   answer (see `harness/deadlines.py`).
+        deadline_s: The deadline of this query, in seconds. Defaults to the policy's.
+
+    Returns:
+        A `QueryResult` for the query.
+    """
+    result = QueryResult(query=query)
+    run_config = RunConfig(streaming_mode=StreamingMode.SSE if stream else StreamingMode.NONE)
+    # Agents whose partial text was passed to on_text since their last whole text
+    streamed_authors = set()
+    session_id = session_id or uuid.uuid4().hex
+
+    start_time = time.perf_counter()
+    try:
+        if new_session:
+            await runner.session_service.create_session(app_name=runner.app_name,
+                                                        user_id=user_id,
+                                                        session_id=session_id)
+        content = types.Content(role='user', parts=[types.Part(text=query)])
+
+        if cache is not None:
+            events = run_cached(runner, cache, user_id, session_id, content, fingerprint, run_config=run_config)
+        else:
+            events = runner.run_async(user_id=user_id, session_id=session_id, new_message=content,
+                                      run_config=run_config)
+        if deadlines is not None:
+            events = deadlines.run(events, deadline_s)
+
+        async for event in events:
+            result.num_events += 1
+            text = _event_text(event)
+            if text:
+                elapsed_ms = round((time.perf_counter() - start_time) * 1000, 3)
+                result.time_to_first_token_ms.setdefault(event.author, elapsed_ms)
+                result.time_to_last_token_ms[event.author] = elapsed_ms
+                # The final event of a streamed answer repeats the whole text
+                if event.partial:
+                    streamed_authors.add(event.author)
+                    if on_text:
+                        on_text(event.author, text)
+                elif event.author in streamed_authors:
+                    streamed_authors.discard(event.author)
+                elif event.author == DEADLINE_AUTHOR:
+                    # The partial answer may be text that was already passed on
+                    result.deadline_stage = (event.custom_metadata or {}).get("deadline_stage")
+                    if on_text and not streamed_authors and text != result.response:
+                        on_text(event.author, text)
+                elif on_text:
+                    on_text(event.author, text)
+            if event.usage_metadata and event.usage_metadata.prompt_token_count and not event.partial:
+                result.input_tokens[event.author] = (result.input_tokens.get(event.author, 0)
+                                                     + event.usage_metadata.prompt_token_count)
+            if event.content and event.content.parts and event.is_final_response():
+                result.latency_ms = round((time.perf_counter() - start_time) * 1000, 3)
+                result.response = event.content.parts[0].text
+                result.author = event.author
+    except Exception as e:
+        result.latency_ms = round((time.perf_counter() - start_time) * 1000, 3)
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        # A failed, cancelled or deadline-cut run leaves the spans of its unfinished agents open
+        end_open_spans(runner.agent, session_id)
+
+    return result
+
+
+async def send_queries(agent, queries: list[str], concurrency: int = DEFAULT_CONCURRENCY,
+                       user_id: str = "user", app_name: Optional[str] = None,
+                       cache: Optional[ResponseCache] = None, stream: bool = False,
+                       session_service=None, deadlines: Optional[DeadlinePolicy] = None) -> list[QueryResult]:
+    """Sends many independent queries to an agent concurrently.
+
+    All queries share one runner, and each query runs in its own session. At most
+    `concurrency` queries are in flight at the same time.
+
+    Args:
+        agent: The agent to send the queries to.
+        queries: The queries to send.
+        concurrency: The maximum number of queries in flight.
+        user_id: The user that owns the sessions.
+        app_name: The application name used for sessions. Defaults to the agent name.
+        cache: Optional response cache for repeated queries.
+        stream: Whether to stream the model answers, see `send_query`.
+        session_service: Session service of the runner, e.g. a `SqliteSessionService`.
+                         Defaults to the module-level in-memory service.
+        deadlines: Optional deadline policy applied to every query, see `send_query`.
+
+    Returns:
+        A list of `QueryResult`, in the same order as `queries`.
+
+    Examples:
+        results = asyncio.run(send_queries(agent_math, ["Multiply 1 and 10", "Add 123 and 3 and 4"]))
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1.")
+
+    runner = get_runner(agent, app_name=app_name, session_service=session_service)
+    semaphore = asyncio.Semaphore(concurrency)
+    # The agents do not change during a batch, so their fingerprint is computed once
+    fingerprint = agent_fingerprint(agent) if cache is not None else None
+
+    async def _bounded(query):
+        async with semaphore:
+            return await send_query(runner, query, user_id=user_id, cache=cache, fingerprint=fingerprint,
+                                    stream=stream, deadlines=deadlines)
+
+    # gather() keeps the results in the order of the input queries
+    return await asyncio.gather(*(_bounded(query) for query in queries))
+
+
+async def send_conversation(agent, queries: list[str], user_id: str = "user", session_id: Optional[str] = None,
+                            app_name: Optional[str] = None, stream: bool = False,
+                            session_service=None, deadlines: Optional[DeadlinePolicy] = None) -> list[QueryResult]:
+    """Sends queries one after the other in a single session, as one conversation.
+
+    Every query sees the history of the previous ones, so the prompts grow with
+    the conversation unless a `HistoryPolicy` is installed on the agent (see
+    `harness/history.py`). The input tokens of every turn are in its result.
+
+    Args:
+        agent: The agent to talk to.
+        queries: The user's messages, in order.
+        user_id: The user that owns the session.
+        session_id: The session of the conversation. A unique id is generated if omitted.
+        app_name: The application name used for sessions. Defaults to the agent name.
+        stream: Whether to stream the model answers, see `send_query`.
+        session_service: Session service of the runner. Defaults to the module-level in-memory service.
+        deadlines: Optional deadline policy applied to every turn, see `send_query`.
+
+    Returns:
+        A list of `QueryResult`, one per turn.
+
+    Examples:
+        results = asyncio.run(send_conversation(agent_teaching_assistant, ["Hi, I am Tom", "Add 1 and 2"]))
+        print([sum(result.input_tokens.values()) for result in results])
+    """
+    runner = get_runner(agent, app_name=app_name, session_service=session_service)
+    session_id = session_id or uuid.uuid4().hex
+    results = []
+    for turn, query in enumerate(queries):
+        results.append(await send_query(runner, query, user_id=user_id, session_id=session_id, stream=stream,
+                                        new_session=turn == 0, deadlines=deadlines))
+    return results
@@ -0,0 +1,508 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import threading
+from collections import deque
+from typing import AsyncGenerator, Awaitable, Callable, Optional, TypeVar
+
+from google.adk.agents import BaseAgent
+from google.adk.models.base_llm import BaseLlm
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+
+from harness.agent_tree import installed, set_models
+from harness.history import HistoryPolicy
+
+T = TypeVar("T")
+
+# Requests per minute allowed per model, matched on the longest model name prefix,
+# e.g. MODEL_RATE_LIMITS={"gemini-2.0-flash": 2000}. Models without a limit are not throttled.
+MODEL_RATE_LIMITS: dict[str, float] = json.loads(os.getenv("MODEL_RATE_LIMITS", "{}"))
+# Optional SQLite file that shares the request budget of every model across processes
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB") or None
+# Retries of failed model calls
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "4"))
+LLM_BACKOFF_BASE_MS = float(os.getenv("LLM_BACKOFF_BASE_MS", "250"))
+LLM_BACKOFF_MAX_MS = float(os.getenv("LLM_BACKOFF_MAX_MS", "10000"))
+LLM_RETRY_BUDGET = float(os.getenv("LLM_RETRY_BUDGET", "0.2"))
+# Adaptive limit of the calls in flight per model
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "256"))
+
+# Status codes worth retrying, and those that mean the endpoint is overloaded
+RETRYABLE_CODES = frozenset({408, 429, 500, 502, 503, 504})
+OVERLOAD_CODES = frozenset({429, 503})
+
+
+def error_code(error: BaseException) -> Optional[int]:
+    """Returns the HTTP status code of an error of the genai client, if it has one."""
+    code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a failed model call may succeed if sent again: throttling, server errors, timeouts, dropped connections."""
+    return error_code(error) in RETRYABLE_CODES or isinstance(error, (asyncio.TimeoutError, ConnectionError))
+
+
+class TokenBucket:
+    """A token bucket that paces the requests of one process.
+
+    Every request takes a token; tokens come back at `rate_per_s` up to
+    `burst`. A request that finds the bucket empty takes its token on credit
+    and waits until it is paid back, so waiting requests keep their order.
+    """
+
+    def __init__(self, rate_per_s: float, burst: float):
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how long to wait before using it, in seconds."""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate_per_s) - 1
+        self._updated = now
+        return max(0.0, -self._tokens / self.rate_per_s)
+
+
+class SqliteTokenBucket:
+    """A token bucket shared by the processes of one machine through a SQLite database.
+
+    Works like `TokenBucket`; the tokens and the time of their last update are
+    kept in one row per model and updated in an immediate transaction, so the
+    processes together stay within the rate. `connect` returns the connection
+    of the calling process. `reserve` blocks while another process holds the
+    database, so `ModelGate` calls it in a worker thread.
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection], lock: threading.Lock, key: str,
+                 rate_per_s: float, burst: float):
+        self._connect = connect
+        self._lock = lock
+        self.key = key
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+
+    def reserve(self) -> float:
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = db.execute("SELECT tokens, updated FROM token_buckets WHERE key = ?", (self.key,)).fetchone()
+                tokens = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate_per_s)
+                tokens -= 1
+                db.execute("INSERT OR REPLACE INTO token_buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                                 (self.key, tokens, now))
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        return max(0.0, -tokens / self.rate_per_s)
+
+
+class AimdLimiter:
+    """Limits the calls in flight, adapting the limit with additive increase and multiplicative decrease.
+
+    Every successful call raises the limit by `1 / limit` (so by one per
+    window of `limit` calls), and an overload error (429/503) cuts it by
+    `decrease`, at most once per `decrease_interval_s`, so that one burst of
+    errors counts once. The limit settles just below what the endpoint can
+    take, instead of every caller retrying into a wall of 429s.
+    """
+
+    def __init__(self, initial: float = 16, min_limit: float = 1, max_limit: float = LLM_MAX_CONCURRENCY,
+                 decrease: float = 0.5, decrease_interval_s: float = 1.0):
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.decrease_interval_s = decrease_interval_s
+        self.in_flight = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the caller gave up
+                self.release()
+            elif waiter in self._waiters:
+                # _wake pops the waiters it skips, so it may be gone already
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def on_success(self) -> None:
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._wake()
+
+    def on_overload(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease >= self.decrease_interval_s:
+            self.limit = max(self.min_limit, self.limit * self.decrease)
+            self._last_decrease = now
+            self.decreases += 1
+
+
+class RetryBudget:
+    """Caps retries at a fraction of the requests, so retries cannot multiply the load of an outage.
+
+    Every request deposits `ratio` of a retry, up to `max_tokens`, and every
+    retry withdraws one. With a ratio of 0.2, at most about one request in
+    five is retried when everything fails.
+    """
+
+    def __init__(self, ratio: float = LLM_RETRY_BUDGET, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+
+    def deposit(self) -> None:
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class ModelGate:
+    """Everything that stands between the callers and one model: its token bucket, AIMD limit and retry budget."""
+
+    def __init__(self, model: str, bucket, concurrency: AimdLimiter, budget: RetryBudget):
+        self.model = model
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self.budget = budget
+        self.requests = 0
+        self.attempts = 0
+        self.retries = 0
+        self.failures = 0
+        self.budget_exhausted = 0
+        self.throttled_ms = 0.0
+
+    async def acquire(self) -> None:
+        """Waits for a slot in flight and for a token."""
+        await self.concurrency.acquire()
+        try:
+            if self.bucket is not None:
+                if isinstance(self.bucket, SqliteTokenBucket):
+                    # The transaction may wait for other processes to release the database
+                    # (up to its busy timeout), which must not stall the event loop
+                    delay_s = await asyncio.to_thread(self.bucket.reserve)
+                else:
+                    delay_s = self.bucket.reserve()
+                if delay_s > 0:
+                    self.throttled_ms += delay_s * 1000
+                    await asyncio.sleep(delay_s)
+        except BaseException:
+            self.concurrency.release()
+            raise
+        self.attempts += 1
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "failures": self.failures,
+            "budget_exhausted": self.budget_exhausted,
+            "throttled_ms": round(self.throttled_ms, 3),
+            "concurrency_limit": round(self.concurrency.limit, 2),
+            "concurrency_decreases": self.concurrency.decreases,
+        }
+
+
+class RateLimiter:
+    """Paces, bounds and retries the model calls of a process, per model.
+
+    One limiter covers both the model calls of the agents (see `RateLimitedLlm`)
+    and the Gemini calls inside `check_grammar` (see `RateLimitedGenaiClient`),
+    so they share one budget per model:
+
+    - A token bucket per model keeps the requests within `requests_per_min`
+      (`MODEL_RATE_LIMITS`). With `db_path` (`RATE_LIMIT_DB`), the bucket is
+      kept in SQLite and shared by all processes on the machine, e.g. the
+      workers of `harness/server.py`.
+    - An AIMD limit per model bounds the calls in flight and halves when the
+      endpoint answers 429/503, then grows back slowly.
+    - Calls that fail with a retryable error are sent again after a jittered
+      exponential backoff ("full jitter": a random delay up to
+      `backoff_base_ms * 2 ** attempt`, capped at `backoff_max_ms`), at most
+      `max_attempts` times, and only while the model's retry budget lasts.
+
+    Args:
+        requests_per_min: Requests per minute per model name prefix. Defaults to `MODEL_RATE_LIMITS`.
+        db_path: SQLite file to share the token buckets across processes.
+        max_attempts: Maximum attempts of one call, the first included.
+        backoff_base_ms: Backoff before the first retry.
+        backoff_max_ms: Maximum backoff.
+        retry_budget: Retries allowed per request, on average.
+        max_concurrency: Upper bound of the AIMD limit of calls in flight per model.
+
+    Examples:
+        limiter = RateLimiter({"gemini-2.0-flash": 2000})
+        install_rate_limiter(agent_teaching_assistant, limiter)
+    """
+
+    def __init__(self, requests_per_min: Optional[dict[str, float]] = None, db_path: Optional[str] = RATE_LIMIT_DB,
+                 max_attempts: int = LLM_MAX_ATTEMPTS, backoff_base_ms: float = LLM_BACKOFF_BASE_MS,
+                 backoff_max_ms: float = LLM_BACKOFF_MAX_MS, retry_budget: float = LLM_RETRY_BUDGET,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY):
+        self.requests_per_min = MODEL_RATE_LIMITS if requests_per_min is None else requests_per_min
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base_ms = backoff_base_ms
+        self.backoff_max_ms = backoff_max_ms
+        self.retry_budget = retry_budget
+        self.max_concurrency = max_concurrency
+        self.db_path = db_path
+        self._gates: dict[str, ModelGate] = {}
+        self._lock = threading.Lock()
+        # Opened by the process that uses it, so a limiter built before a fork works in every worker
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_pid: Optional[int] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA busy_timeout=5000")
+            self._db.execute("CREATE TABLE IF NOT EXISTS token_buckets "
+                             "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _rate(self, model: str) -> Optional[float]:
+        matches = [prefix for prefix in self.requests_per_min if model.startswith(prefix)]
+        return float(self.requests_per_min[max(matches, key=len)]) if matches else None
+
+    def gate(self, model: str) -> ModelGate:
+        """Returns the gate of a model, creating it on first use."""
+        gate = self._gates.get(model)
+        if gate is None:
+            rate_per_min = self._rate(model)
+            bucket = None
+            if rate_per_min:
+                rate_per_s = rate_per_min / 60
+                # A second's worth of requests may go out at once
+                burst = max(1.0, rate_per_s)
+                bucket = (SqliteTokenBucket(self._connection, self._lock, model, rate_per_s, burst)
+                          if self.db_path else TokenBucket(rate_per_s, burst))
+            gate = ModelGate(model, bucket, AimdLimiter(initial=min(16, self.max_concurrency),
+                                                        max_limit=self.max_concurrency),
+                             RetryBudget(self.retry_budget))
+            self._gates[model] = gate
+        return gate
+
+    def backoff_s(self, attempt: int) -> float:
+        """Returns the jittered delay before retry number `attempt` (from 0)."""
+        return random.uniform(0, min(self.backoff_max_ms, self.backoff_base_ms * 2 ** attempt)) / 1000
+
+    def _should_retry(self, gate: ModelGate, error: BaseException, attempt: int) -> bool:
+        """Records a failed attempt and decides whether to send it again."""
+        if error_code(error) in OVERLOAD_CODES:
+            gate.concurrency.on_overload()
+        if not is_retryable(error) or attempt + 1 >= self.max_attempts:
+            gate.failures += 1
+            return False
+        if not gate.budget.withdraw():
+            gate.budget_exhausted += 1
+            gate.failures += 1
+            return False
+        gate.retries += 1
+        return True
+
+    async def call(self, model: str, send: Callable[[], Awaitable[T]]) -> T:
+        """Sends a call through the gate of its model, retrying it when it fails.
+
+        Args:
+            model: The model the call goes to.
+            send: Makes the call; called once per attempt.
+
+        Returns:
+            The result of the first successful attempt.
+
+        Raises:
+            The error of the last attempt, when it is not retryable or the
+            attempts or the retry budget are used up.
+        """
+        gate = self.gate(model)
+        gate.requests += 1
+        gate.budget.deposit()
+        attempt = 0
+        while True:
+            await gate.acquire()
+            try:
+                result = await send()
+            except Exception as e:
+                gate.concurrency.release()
+                if not self._should_retry(gate, e, attempt):
+                    raise
+            except BaseException:
+                gate.concurrency.release()
+                raise
+            else:
+                gate.concurrency.release()
+                gate.concurrency.on_success()
+                return result
+            await asyncio.sleep(self.backoff_s(attempt))
+            attempt += 1
+
+    def stats(self) -> dict:
+        """Returns the counters of every model: requests, attempts, retries, failures, time throttled and AIMD limit."""
+        return {model: gate.stats() for model, gate in self._gates.items()}
+
+
+class RateLimitedLlm(BaseLlm):
+    """Sends the model calls of an agent through a `RateLimiter`.
+
+    A call holds its slot in flight until its first response, and is retried
+    only if it failed before it; once a streamed answer has started, an error
+    is passed on as it is.
+
+    Attributes:
+        inner: The model that serves the calls.
+        limiter: The limiter shared with the other models and `check_grammar`.
+    """
+
+    inner: BaseLlm
+    limiter: RateLimiter
+
+    async def generate_content_async(
+        self, llm_request: LlmRequest, stream: bool = False
+    ) -> AsyncGenerator[LlmResponse, None]:
+        limiter = self.limiter
+        gate = limiter.gate(self.model)
+        gate.requests += 1
+        gate.budget.deposit()
+        attempt = 0
+        while True:
+            await gate.acquire()
+            responses = self.inner.generate_content_async(llm_request, stream=stream)
+            try:
+                first_response = await anext(responses)
+            except StopAsyncIteration:
+                gate.concurrency.release()
+                gate.concurrency.on_success()
+                return
+            except Exception as e:
+                gate.concurrency.release()
+                if not limiter._should_retry(gate, e, attempt):
+                    raise
+            except BaseException:
+                gate.concurrency.release()
+                raise
+            else:
+                # The slot covers the call up to its first response: the caller may stop
+                # reading a stream at any time, which would otherwise leave the slot taken
+                gate.concurrency.release()
+                gate.concurrency.on_success()
+                break
+            await asyncio.sleep(limiter.backoff_s(attempt))
+            attempt += 1
+
+        yield first_response
+        async for llm_response in responses:
+            yield llm_response
+
+
+class _RateLimitedModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, *, model, contents, config=None):
+        # The synchronous client is used by nothing in the walkthrough; it is passed through unthrottled
+        return self._client.inner.models.generate_content(model=model, contents=contents, config=config)
+
+
+class _RateLimitedAsyncModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    async def generate_content(self, *, model, contents, config=None):
+        return await self._client.limiter.call(
+            model, lambda: self._client.inner.aio.models.generate_content(model=model, contents=contents, config=config))
+
+
+class _RateLimitedAio:
+
+    def __init__(self, client):
+        self.models = _RateLimitedAsyncModels(client)
+
+
+class RateLimitedGenaiClient:
+    """Sends the `generate_content` calls a tool makes through a genai client through a `RateLimiter`.
+
+    Args:
+        limiter: The limiter shared with the agents' models.
+        inner: The client that serves the calls.
+    """
+
+    def __init__(self, limiter: RateLimiter, inner):
+        self.limiter = limiter
+        self.inner = inner
+        self.models = _RateLimitedModels(self)
+        self.aio = _RateLimitedAio(self)
+
+
+def install_rate_limiter(agent: BaseAgent, limiter: RateLimiter) -> None:
+    """Sends every model call of an agent tree, and those of `check_grammar`, through a limiter.
+
+    The summarizer of a `HistoryPolicy` applied to the root agent (see
+    `apply_history`) is limited too, so apply the history policy first.
+    Installing the same limiter twice has no effect.
+
+    Args:
+        agent: The root of the agent tree.
+        limiter: The limiter, usually one per process.
+    """
+    from agent_grammar import agent as grammar_module
+
+    def limited(model: BaseLlm) -> BaseLlm:
+        if isinstance(model, RateLimitedLlm) and model.limiter is limiter:
+            return model
+        return RateLimitedLlm(model=model.model, inner=model, limiter=limiter)
+
+    set_models(agent, lambda llm_agent: limited(llm_agent.canonical_model))
+
+    # The background summaries of the conversation history call a model of their own
+    for policy in installed(agent, HistoryPolicy):
+        if policy.summarizer is not None:
+            policy.summarizer = limited(policy.summarizer)
+
+    inner_factory = grammar_module.set_client_factory(None)
+    if getattr(inner_factory, "limiter", None) is limiter:
+        grammar_module.set_client_factory(inner_factory)
+        return
+
+    def limited_factory():
+        return RateLimitedGenaiClient(limiter, inner_factory())
+
+    limited_factory.limiter = limiter
+    grammar_module.set_client_factory(limited_factory)
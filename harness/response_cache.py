@@ -0,0 +1,406 @@
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import AsyncGenerator, Optional
+
+from google.adk.agents import BaseAgent, LlmAgent
+from google.adk.agents.run_config import RunConfig
+from google.adk.events import Event
+from google.adk.models.base_llm import BaseLlm
+from google.adk.runners import Runner
+from google.adk.tools import BaseTool
+from google.genai import types
+
+from harness.agent_tree import iter_agents
+
+# How long a lookup or a write waits for another process's transaction. A
+# locked database counts as a miss (or a skipped write), never as an error.
+DB_TIMEOUT_S = 0.1
+
+
+def normalize_query(text: str) -> str:
+    """Normalizes a query for use in a cache key.
+
+    Unicode is normalized (NFC) and surrounding and repeated whitespace is
+    removed. Case and punctuation are kept: the grammar agent comments on
+    exactly those, so "multiply 1 and 10" and "Multiply 1 and 10." can get
+    different answers.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def _hash_code_object(digest, code) -> None:
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode("utf-8"))
+    for const in code.co_consts:
+        # The repr of a nested code object (a lambda, comprehension or inner
+        # function) contains its memory address, which differs between runs
+        if hasattr(const, "co_code"):
+            _hash_code_object(digest, const)
+        else:
+            digest.update(repr(const).encode("utf-8"))
+
+
+def _code_hash(function) -> str:
+    """Hashes the compiled code of a function, so editing a tool changes its hash."""
+    code = getattr(function, "__code__", None)
+    if code is None:
+        return getattr(function, "__qualname__", type(function).__name__)
+    digest = hashlib.sha256()
+    _hash_code_object(digest, code)
+    return digest.hexdigest()[:16]
+
+
+def _tool_description(tool) -> dict:
+    if isinstance(tool, BaseTool):
+        function = getattr(tool, "func", None)
+        return {"name": tool.name, "description": tool.description,
+                "code": _code_hash(function) if function else None}
+    return {"name": getattr(tool, "__name__", repr(tool)), "code": _code_hash(tool)}
+
+
+def _model_description(model) -> str:
+    if isinstance(model, BaseLlm):
+        return f"{type(model).__name__}:{model.model}"
+    return model
+
+
+def _agent_description(agent: BaseAgent) -> dict:
+    description = {"class": type(agent).__name__, "name": agent.name,
+                   "sub_agents": [sub_agent.name for sub_agent in agent.sub_agents]}
+    if isinstance(agent, LlmAgent):
+        instruction = agent.instruction
+        description.update({
+            "model": _model_description(agent.model),
+            "instruction": instruction if isinstance(instruction, str) else _code_hash(instruction),
+            "global_instruction": agent.global_instruction if isinstance(agent.global_instruction, str) else None,
+            "tools": [_tool_description(tool) for tool in agent.tools],
+            "generate_content_config": (agent.generate_content_config.model_dump(mode="json", exclude_none=True)
+                                        if agent.generate_content_config else None),
+            "include_contents": agent.include_contents,
+            "output_key": agent.output_key,
+        })
+    return description
+
+
+def agent_fingerprint(agent: BaseAgent) -> str:
+    """Returns a hash of the configuration of every agent in a tree.
+
+    The hash covers the structure of the tree and, for every LLM agent, its
+    model, instruction, tools (including the code of function tools) and
+    `generate_content_config`. Changing any prompt, tool or model setting
+    therefore changes the fingerprint, which invalidates cached responses.
+    """
+    data = json.dumps([_agent_description(node) for node in iter_agents(agent)],
+                      sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def history_digest(events: list[Event]) -> str:
+    """Hashes the history of a session: who said what, and the state changes, of every event.
+
+    Ids and timestamps are left out, so a session rebuilt from cached events
+    has the same digest as the one that produced them.
+    """
+    data = json.dumps([[event.author,
+                        event.content.model_dump(mode="json", exclude_none=True) if event.content else None,
+                        event.actions.state_delta]
+                       for event in events if not event.partial],
+                      sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def make_key(query: str, fingerprint: str, history: str = "") -> str:
+    """Builds the cache key of a query from its normalized text, the agent fingerprint and the session history.
+
+    Args:
+        query: The text of the user's message.
+        fingerprint: The `agent_fingerprint` of the agent tree.
+        history: The `history_digest` of the session before the query; empty for a new session.
+    """
+    data = json.dumps([normalize_query(query), fingerprint, history], separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """A bounded two-tier cache of the event streams produced for a query.
+
+    The first tier is an in-memory LRU holding the events themselves, so a hit
+    costs no parsing. The optional second tier is a SQLite database holding the
+    events as JSON, so responses survive restarts and can be shared by
+    processes on the same machine. Both tiers expire entries after `ttl_s`
+    seconds and evict the least recently used entries beyond their maximum size.
+
+    The database calls block, so async code uses `get_async` and `put_async`,
+    which run the second tier (queries and JSON decoding) in a worker thread.
+    A database that stays locked by another process for `DB_TIMEOUT_S`, or
+    fails otherwise, counts as a miss or a skipped write.
+
+    Args:
+        max_entries: Maximum number of event streams kept in memory. 0 disables the cache.
+        ttl_s: Time to live of an entry in seconds. None keeps entries until evicted.
+        db_path: Path of the SQLite database of the second tier, or None for memory only.
+        max_db_entries: Maximum number of event streams kept in the database.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_s: Optional[float] = 86400,
+                 db_path: Optional[str] = None, max_db_entries: int = 100_000):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.max_db_entries = max_db_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.db_errors = 0
+        self._memory: OrderedDict[str, tuple[Optional[float], list[Event]]] = OrderedDict()
+        # The memory tier is used from the event loop, so it never waits for the database
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._db_entries = 0
+        if db_path and max_entries > 0:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=DB_TIMEOUT_S)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS response_cache ("
+                             "key TEXT PRIMARY KEY, events TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS response_cache_accessed ON response_cache (accessed_at)")
+            self._db_entries = self._db.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: str) -> Optional[list[Event]]:
+        """Returns the cached events for a key, or None on a miss. The events must not be modified."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        events = self._get_memory(key, now)
+        if events is None and self._db is not None:
+            events = self._get_db(key, now)
+        return self._count(events)
+
+    async def get_async(self, key: str) -> Optional[list[Event]]:
+        """Like `get`, with the database lookup in a worker thread so the event loop never waits for it."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        events = self._get_memory(key, now)
+        if events is None and self._db is not None:
+            events = await asyncio.to_thread(self._get_db, key, now)
+        return self._count(events)
+
+    def _count(self, events: Optional[list[Event]]) -> Optional[list[Event]]:
+        if events is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return events
+
+    def _get_memory(self, key: str, now: float) -> Optional[list[Event]]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            expires_at, events = entry
+            if expires_at is None or expires_at > now:
+                self._memory.move_to_end(key)
+                return events
+            del self._memory[key]
+            return None
+
+    def _get_db(self, key: str, now: float) -> Optional[list[Event]]:
+        try:
+            with self._db_lock:
+                row = self._db.execute("SELECT events, expires_at FROM response_cache WHERE key = ?",
+                                       (key,)).fetchone()
+                if row is None:
+                    return None
+                data, expires_at = row
+                if expires_at is not None and expires_at <= now:
+                    self._db.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                    self._db_entries -= 1
+                    return None
+                self._db.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.Error:
+            self.db_errors += 1
+            return None
+        events = [Event.model_validate(event) for event in json.loads(data)]
+        with self._lock:
+            self._put_memory(key, events, expires_at)
+        self.disk_hits += 1
+        return events
+
+    def put(self, key: str, events: list[Event]) -> None:
+        """Stores the events produced for a key in both tiers."""
+        if not self.enabled:
+            return
+        now = time.time()
+        self._put_memory_entry(key, events, now)
+        if self._db is not None:
+            self._put_db(key, events, now)
+
+    async def put_async(self, key: str, events: list[Event]) -> None:
+        """Like `put`, with the encoding and the database write in a worker thread."""
+        if not self.enabled:
+            return
+        now = time.time()
+        self._put_memory_entry(key, events, now)
+        if self._db is not None:
+            await asyncio.to_thread(self._put_db, key, events, now)
+
+    def _expires_at(self, now: float) -> Optional[float]:
+        return now + self.ttl_s if self.ttl_s is not None else None
+
+    def _put_memory_entry(self, key: str, events: list[Event], now: float) -> None:
+        with self._lock:
+            self._put_memory(key, events, self._expires_at(now))
+
+    def _put_db(self, key: str, events: list[Event], now: float) -> None:
+        data = json.dumps([event.model_dump(mode="json", exclude_none=True) for event in events],
+                          separators=(",", ":"))
+        try:
+            with self._db_lock:
+                cursor = self._db.execute("INSERT OR REPLACE INTO response_cache (key, events, expires_at, accessed_at) "
+                                          "VALUES (?, ?, ?, ?)", (key, data, self._expires_at(now), now))
+                self._db_entries += cursor.rowcount
+                self._evict_db(now)
+        except sqlite3.Error:
+            # The events stay in memory; the database misses them
+            self.db_errors += 1
+
+    def _put_memory(self, key: str, events: list[Event], expires_at: Optional[float]) -> None:
+        self._memory[key] = (expires_at, events)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _evict_db(self, now: float) -> None:
+        # The row count is tracked locally (it may drift when other processes share
+        # the database), so the table is only recounted when it looks full
+        if self._db_entries <= self.max_db_entries:
+            return
+        self._db.execute("DELETE FROM response_cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        self._db_entries = self._db.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+        excess = self._db_entries - self.max_db_entries
+        if excess > 0:
+            self._db.execute("DELETE FROM response_cache WHERE key IN "
+                             "(SELECT key FROM response_cache ORDER BY accessed_at LIMIT ?)", (excess,))
+            self._db_entries -= excess
+            self.evictions += excess
+
+    def clear(self) -> None:
+        """Removes all entries from both tiers."""
+        with self._lock:
+            self._memory.clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM response_cache")
+                self._db_entries = 0
+
+    def stats(self) -> dict:
+        """Returns the hit, miss and eviction counters and the current sizes."""
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "db_errors": self.db_errors,
+            "memory_entries": len(self._memory),
+            "db_entries": self._db_entries if self._db is not None else 0,
+        }
+
+
+def _is_error_response(response) -> bool:
+    """Whether a function response is a tool's error result rather than an answer.
+
+    The math tools return `{"error": ...}`, and `check_grammar` returns a
+    `None` "corrected_text" when it could not reach or parse the model.
+    """
+    return isinstance(response, dict) and ("error" in response
+                                           or ("corrected_text" in response and response["corrected_text"] is None))
+
+
+def _is_cacheable(events: list[Event]) -> bool:
+    """Whether an event stream is a complete, successful answer that does not depend on artifacts."""
+    if not events or not any(event.content and event.is_final_response() for event in events):
+        return False
+    # A tool that failed (e.g. a timeout of the grammar model) would have its
+    # failure replayed to every later user asking the same question
+    if any(_is_error_response(function_response.response)
+           for event in events for function_response in event.get_function_responses()):
+        return False
+    # Artifacts are stored outside of the events, so a replay could not restore them
+    return not any(event.error_code or event.actions.artifact_delta for event in events)
+
+
+def _replay(event: Event, invocation_id: str) -> Event:
+    """Copies a cached event as a new event of the current invocation."""
+    return event.model_copy(deep=True, update={"id": Event.new_id(), "invocation_id": invocation_id,
+                                               "timestamp": time.time()})
+
+
+async def run_cached(runner: Runner, cache: ResponseCache, user_id: str, session_id: str,
+                     new_message: types.Content, fingerprint: Optional[str] = None,
+                     run_config: Optional[RunConfig] = None) -> AsyncGenerator[Event, None]:
+    """Runs a query like `runner.run_async`, answering repeated queries from a cache.
+
+    The key covers the query, the agent tree and the history of the session,
+    so only a query asked at the same point of the same conversation is a hit.
+    On a hit, the cached events (function calls and responses included) are
+    replayed as new events and appended to the session, with the user's
+    message, as if the agents had produced them, so the session history and
+    state are the same as after a real run. On a miss, the runner's events are
+    passed through, and stored once the run completes successfully. Partial
+    (streamed) events are never cached. Runs that fail, in which a tool
+    returns an error result, or that save artifacts, are not stored.
+
+    Args:
+        runner: The runner of the agent tree.
+        cache: The cache to use.
+        user_id: The user that owns the session.
+        session_id: The session of the query. It must exist.
+        new_message: The user's message.
+        fingerprint: The `agent_fingerprint` of the runner's agent. Computed if omitted.
+        run_config: The run config of a real run, e.g. to stream the model answers.
+
+    Yields:
+        The events of the run.
+    """
+    session = await runner.session_service.get_session(app_name=runner.app_name, user_id=user_id,
+                                                       session_id=session_id)
+    if session is None:
+        raise ValueError(f"Session not found: {session_id}")
+    # The agents see the earlier turns of the conversation, so the same
+    # question can get a different answer in a different conversation
+    query = "".join(part.text for part in new_message.parts or [] if part.text)
+    key = make_key(query, fingerprint or agent_fingerprint(runner.agent),
+                   history_digest(session.events) if session.events else "")
+
+    cached_events = await cache.get_async(key)
+    if cached_events is not None:
+        invocation_id = "e-" + str(uuid.uuid4())
+        await runner.session_service.append_event(
+            session, Event(invocation_id=invocation_id, author="user", content=new_message))
+        for cached_event in cached_events:
+            event = _replay(cached_event, invocation_id)
+            await runner.session_service.append_event(session, event)
+            yield event
+        return
+
+    events = []
+    async for event in runner.run_async(user_id=user_id, session_id=session_id, new_message=new_message,
+                                        run_config=run_config or RunConfig()):
+        if not event.partial:
+            events.append(event.model_copy(deep=True))
+        yield event
+    if _is_cacheable(events):
+        await cache.put_async(key, events)
@@ -0,0 +1,429 @@
+import os
+import sys
+import json
+import uuid
+import signal
+import socket
+import asyncio
+import argparse
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from typing import AsyncGenerator, Optional
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+from google.adk.runners import Runner
+from google.adk.sessions.base_session_service import GetSessionConfig
+from pydantic import BaseModel
+
+from harness.benchmark import install_fake_models, load_pipeline
+from harness.rate_limit import RateLimiter, install_rate_limiter
+from harness.hedging import HedgePolicy, install_hedging
+from harness.deadlines import QUERY_DEADLINE_S, DeadlinePolicy, install_deadlines
+from harness.query import QueryResult, default_session_service, get_runner, send_query
+from harness.sqlite_sessions import SqliteSessionService
+
+# Agents that can be served, by the name used in the URL: chapter1's basic agent, chapter2's
+# math agent, the grammar agent and chapter3's teaching assistant (sequential and parallel)
+PIPELINES = ("basic", "math", "grammar", "teaching", "teaching_parallel")
+
+# Admission control of every worker process, configured from the .env file (0 disables a limit)
+SERVER_MAX_IN_FLIGHT = int(os.getenv("SERVER_MAX_IN_FLIGHT", "64"))
+SERVER_MAX_QUEUE = int(os.getenv("SERVER_MAX_QUEUE", "256"))
+SERVER_MAX_PER_USER = int(os.getenv("SERVER_MAX_PER_USER", "4"))
+SERVER_QUEUE_TIMEOUT_S = float(os.getenv("SERVER_QUEUE_TIMEOUT_S", "30"))
+
+
+class Rejected(Exception):
+    """Raised when a request is not admitted. `reason` is "queue_full", "user_limit" or "queue_timeout"."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """Bounds the queries a worker runs and queues, and the share of any one user.
+
+    At most `max_in_flight` queries run at the same time. Requests beyond that
+    wait in a queue of at most `max_queue` requests, for at most
+    `queue_timeout_s` seconds; when the queue is full, a request is rejected at
+    once instead of waiting, so an overloaded server sheds load quickly rather
+    than letting latency grow without bound. A user can have at most
+    `max_per_user` queries running or queued.
+
+    Args:
+        max_in_flight: Maximum number of queries running at the same time.
+        max_queue: Maximum number of queries waiting to run.
+        max_per_user: Maximum number of queries of one user, running or waiting.
+        queue_timeout_s: Maximum time a query waits to run.
+
+    Examples:
+        await admission.acquire(user_id)
+        try:
+            ...
+        finally:
+            admission.release(user_id)
+    """
+
+    def __init__(self, max_in_flight: int = SERVER_MAX_IN_FLIGHT, max_queue: int = SERVER_MAX_QUEUE,
+                 max_per_user: int = SERVER_MAX_PER_USER, queue_timeout_s: Optional[float] = SERVER_QUEUE_TIMEOUT_S):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1.")
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.queue_timeout_s = queue_timeout_s or None
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._per_user: dict[str, int] = {}
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected: dict[str, int] = {"queue_full": 0, "user_limit": 0, "queue_timeout": 0}
+
+    def stats(self) -> dict:
+        """Returns the queries running and queued, and the admission counters."""
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "users": len(self._per_user),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+        }
+
+    def _reject(self, reason: str) -> Rejected:
+        self.rejected[reason] += 1
+        return Rejected(reason)
+
+    async def acquire(self, user_id: str) -> None:
+        """Waits for a slot to run a query of a user.
+
+        Raises:
+            Rejected: If the user has too many queries, the queue is full, or
+                      no slot became free within `queue_timeout_s`.
+        """
+        if self.max_per_user and self._per_user.get(user_id, 0) >= self.max_per_user:
+            raise self._reject("user_limit")
+        # Counted here rather than read from the semaphore, which only takes a
+        # slot once the waiting task runs, after the rest of a burst was let in
+        if self.in_flight + self.queued >= self.max_in_flight + self.max_queue:
+            raise self._reject("queue_full")
+
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout_s)
+        except asyncio.TimeoutError:
+            self._release_user(user_id)
+            raise self._reject("queue_timeout")
+        except BaseException:
+            self._release_user(user_id)
+            raise
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        self.admitted += 1
+
+    def release(self, user_id: str) -> None:
+        """Frees the slot of a query admitted by `acquire`."""
+        self.in_flight -= 1
+        self._slots.release()
+        self._release_user(user_id)
+
+    def _release_user(self, user_id: str) -> None:
+        count = self._per_user.get(user_id, 0) - 1
+        if count > 0:
+            self._per_user[user_id] = count
+        else:
+            self._per_user.pop(user_id, None)
+
+
+class QueryRequest(BaseModel):
+    """The body of a query.
+
+    Attributes:
+        query: The user's message.
+        user_id: The user that owns the session; admission limits are per user.
+        session_id: The session of a conversation. The query continues the
+                    session if it exists, otherwise a session with this id is
+                    created. A new session is used if omitted; its id is
+                    returned as `session_id`, to send the next turns.
+        stream: Whether to stream the answer as server-sent events.
+        deadline_s: The deadline of the query in seconds, from its admission.
+                    Defaults to the server's (`QUERY_DEADLINE_S`, none by default).
+                    A query that runs out of time is answered with what the
+                    agents wrote so far, or a fallback answer.
+    """
+    query: str
+    user_id: str = "user"
+    session_id: Optional[str] = None
+    stream: bool = False
+    deadline_s: Optional[float] = None
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _result(result: QueryResult, session_id: str) -> dict:
+    return {**asdict(result), "session_id": session_id}
+
+
+def _rejection(error: Rejected) -> JSONResponse:
+    # A full queue or user limit is a signal to back off; a client that waited
+    # out the queue timeout should retry later too
+    return JSONResponse({"error": error.reason}, status_code=429, headers={"Retry-After": "1"})
+
+
+async def _open_session(runner: Runner, request: QueryRequest) -> tuple[str, bool]:
+    """Returns the session id of a query, and whether `send_query` has to create that session."""
+    if not request.session_id:
+        return uuid.uuid4().hex, True
+    session_service = runner.session_service
+    key = dict(app_name=runner.app_name, user_id=request.user_id, session_id=request.session_id)
+    if await session_service.get_session(**key, config=GetSessionConfig(num_recent_events=1)) is not None:
+        return request.session_id, False
+    try:
+        await session_service.create_session(**key, replace=False)
+    except ValueError:
+        # Another request starting the same conversation created it first: continue it
+        if await session_service.get_session(**key, config=GetSessionConfig(num_recent_events=1)) is None:
+            raise
+    return request.session_id, False
+
+
+def create_app(pipelines: tuple[str, ...] = PIPELINES, fake_latency_ms: Optional[float] = None,
+               session_db: Optional[str] = None, admission: Optional[AdmissionController] = None,
+               rate_limiter: Optional[RateLimiter] = None, hedging: Optional[HedgePolicy] = None,
+               deadlines: Optional[DeadlinePolicy] = None) -> FastAPI:
+    """Builds the HTTP application that serves the agents.
+
+    The runners of every agent are built when the application starts, so the
+    first request of a worker does not pay for them.
+
+    Endpoints:
+        POST /agents/{name}/query: Sends a `QueryRequest` to an agent. Returns
+            the `QueryResult` and the `session_id` of the conversation as JSON
+            (status 500 if the query failed) or, with `stream`, server-sent
+            events: a "text" event `{"author", "text"}` for every chunk of
+            text as the agents write it, then a "result" event with the
+            `QueryResult` and the `session_id`. Returns 429 when the query is
+            not admitted, 404 for an unknown agent.
+        GET /agents: The names of the served agents.
+        GET /stats: The admission, session store, rate limiter, hedging and deadline counters of the worker.
+        GET /healthz: Liveness check.
+
+    Args:
+        pipelines: The agents to serve, among `PIPELINES`.
+        fake_latency_ms: If given, the models (and the `check_grammar` client)
+                         are replaced with local fakes of this latency, to test
+                         the server offline.
+        session_db: If given, sessions are kept in this SQLite database, which
+                    all worker processes share, so a conversation can continue
+                    on any worker. Otherwise every worker keeps its own sessions in memory.
+        admission: The admission controller. Defaults to one configured from the SERVER_* variables.
+        rate_limiter: If given, every model call goes through this limiter (see
+                      `harness/rate_limit.py`). Give it a `db_path` to share
+                      the request budget of every model among the workers.
+        hedging: If given, slow model calls are hedged with this policy (see `harness/hedging.py`).
+        deadlines: The deadline policy of the queries (see `harness/deadlines.py`).
+                   Defaults to one configured from `QUERY_DEADLINE_S`.
+
+    Returns:
+        The FastAPI application.
+    """
+    agents = {}
+    for name in pipelines:
+        agents[name] = load_pipeline(name)
+        if fake_latency_ms is not None:
+            install_fake_models(agents[name], fake_latency_ms, tool_latency_ms=fake_latency_ms)
+        if rate_limiter is not None:
+            install_rate_limiter(agents[name], rate_limiter)
+        if hedging is not None:
+            install_hedging(agents[name], hedging)
+        # Last, so that one bound covers the retries and hedges of a call
+        install_deadlines(agents[name])
+    deadlines = deadlines or DeadlinePolicy()
+    session_service = SqliteSessionService(session_db) if session_db else default_session_service
+    runners: dict[str, Runner] = {}
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Built in the worker process itself, so nothing is shared across a fork
+        app.state.admission = admission or AdmissionController()
+        for name, agent in agents.items():
+            runners[name] = get_runner(agent, session_service=session_service)
+        yield
+
+    app = FastAPI(title="Teaching assistant agents", lifespan=lifespan)
+
+    @app.get("/healthz")
+    async def healthz():
+        return {"status": "ok", "pid": os.getpid()}
+
+    @app.get("/agents")
+    async def list_agents():
+        return {"agents": list(agents)}
+
+    @app.get("/stats")
+    async def stats():
+        report = {"pid": os.getpid(), "admission": app.state.admission.stats()}
+        if hasattr(session_service, "stats"):
+            report["session_store"] = session_service.stats()
+        if rate_limiter is not None:
+            report["rate_limiter"] = rate_limiter.stats()
+        if hedging is not None:
+            report["hedging"] = hedging.stats()
+        report["deadlines"] = deadlines.stats()
+        return report
+
+    @app.post("/agents/{name}/query")
+    async def query(name: str, request: QueryRequest):
+        runner = runners.get(name)
+        if runner is None:
+            return JSONResponse({"error": f"unknown agent: {name}"}, status_code=404)
+        admission_controller: AdmissionController = app.state.admission
+        try:
+            await admission_controller.acquire(request.user_id)
+        except Rejected as e:
+            return _rejection(e)
+
+        if request.stream:
+            # The slot is released by the stream, once it ends or the client goes away
+            return StreamingResponse(_stream(admission_controller, runner, request, deadlines),
+                                     media_type="text/event-stream")
+        try:
+            session_id, new_session = await _open_session(runner, request)
+            result = await send_query(runner, request.query, user_id=request.user_id,
+                                      session_id=session_id, new_session=new_session,
+                                      deadlines=deadlines, deadline_s=request.deadline_s)
+        finally:
+            admission_controller.release(request.user_id)
+        return JSONResponse(_result(result, session_id), status_code=500 if result.error else 200)
+
+    return app
+
+
+async def _stream(admission: AdmissionController, runner: Runner, request: QueryRequest,
+                  deadlines: DeadlinePolicy) -> AsyncGenerator[str, None]:
+    """Runs a query and yields its text chunks, then its result, as server-sent events."""
+    chunks: asyncio.Queue = asyncio.Queue()
+    task = None
+    try:
+        session_id, new_session = await _open_session(runner, request)
+        task = asyncio.create_task(send_query(runner, request.query, user_id=request.user_id,
+                                              session_id=session_id, new_session=new_session, stream=True,
+                                              on_text=lambda author, text: chunks.put_nowait((author, text)),
+                                              deadlines=deadlines, deadline_s=request.deadline_s))
+        task.add_done_callback(lambda _: chunks.put_nowait(None))
+        while (chunk := await chunks.get()) is not None:
+            yield _sse("text", {"author": chunk[0], "text": chunk[1]})
+        yield _sse("result", _result(task.result(), session_id))
+    finally:
+        # The client may have gone away: the query stops and frees its slot
+        if task is not None and not task.done():
+            task.cancel()
+        admission.release(request.user_id)
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve(host: str = "127.0.0.1", port: int = 8000, workers: int = 1, log_level: str = "warning", **options) -> None:
+    """Serves the agents over HTTP.
+
+    With more than one worker, the server pre-forks: the parent binds the
+    socket, then forks `workers` processes that accept connections from it,
+    each with its own event loop, admission controller and warm runners. The
+    models are network bound but the agent framework is not, so throughput
+    scales with the cores of the machine. Limits apply per worker; use
+    `session_db` so that conversations can continue on any worker.
+
+    Args:
+        host: The address to listen on.
+        port: The port to listen on.
+        workers: The number of worker processes.
+        log_level: The uvicorn log level.
+        **options: Passed to `create_app` in every worker.
+    """
+    if workers <= 1:
+        uvicorn.run(create_app(**options), host=host, port=port, log_level=log_level)
+        return
+
+    sock = _bind(host, port)
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # The worker builds its own application, so no event loop or client crosses the fork
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            server = uvicorn.Server(uvicorn.Config(create_app(**options), log_level=log_level))
+            server.run(sockets=[sock])
+            os._exit(0)
+        pids.append(pid)
+    print(f"Serving {', '.join(options.get('pipelines', PIPELINES))} on http://{host}:{port} with {workers} workers",
+          flush=True)
+
+    def _stop(signum, frame):
+        for worker_pid in pids:
+            try:
+                os.kill(worker_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    sock.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Serves the walkthrough agents over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="Number of pre-forked worker processes.")
+    parser.add_argument("--pipelines", nargs="+", choices=PIPELINES, default=list(PIPELINES),
+                        help="Agents to serve.")
+    parser.add_argument("--max-in-flight", type=int, default=SERVER_MAX_IN_FLIGHT,
+                        help="Maximum number of queries running in a worker.")
+    parser.add_argument("--max-queue", type=int, default=SERVER_MAX_QUEUE,
+                        help="Maximum number of queries waiting in a worker; more are rejected with 429.")
+    parser.add_argument("--max-per-user", type=int, default=SERVER_MAX_PER_USER,
+                        help="Maximum number of queries of one user in a worker (0 for no limit).")
+    parser.add_argument("--queue-timeout-s", type=float, default=SERVER_QUEUE_TIMEOUT_S,
+                        help="Maximum time a query waits in the queue before it is rejected with 429.")
+    parser.add_argument("--session-db", metavar="PATH",
+                        help="Keep the sessions in a SQLite database at PATH, shared by the workers.")
+    parser.add_argument("--fake-latency-ms", type=float,
+                        help="Serve with local fake models of this latency instead of Gemini.")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="Pace and retry the model calls (MODEL_RATE_LIMITS, RATE_LIMIT_DB, LLM_*).")
+    parser.add_argument("--hedge", action="store_true", help="Hedge slow model calls (HEDGE_*).")
+    parser.add_argument("--deadline-s", type=float, default=QUERY_DEADLINE_S,
+                        help="Default deadline of a query in seconds (0 for none); a request can set its own.")
+    parser.add_argument("--log-level", default="warning")
+    args = parser.parse_args(argv)
+
+    # Every forked worker gets its own copy of the controller
+    admission = AdmissionController(args.max_in_flight, args.max_queue, args.max_per_user, args.queue_timeout_s)
+    # Built before the fork: every worker gets its own copy, which shares RATE_LIMIT_DB (if set) with the others
+    rate_limiter = RateLimiter() if args.rate_limit else None
+    serve(args.host, args.port, args.workers, log_level=args.log_level, pipelines=tuple(args.pipelines),
+          fake_latency_ms=args.fake_latency_ms, session_db=args.session_db, admission=admission,
+          rate_limiter=rate_limiter, hedging=HedgePolicy() if args.hedge else None,
+          deadlines=DeadlinePolicy(timeout_s=args.deadline_s))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
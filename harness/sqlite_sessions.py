@@ -0,0 +1,293 @@
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+import contextlib
+from typing import Any, Optional
+
+from google.adk.events import Event
+from google.adk.sessions import BaseSessionService, Session
+from google.adk.sessions.base_session_service import GetSessionConfig, ListSessionsResponse
+from google.adk.sessions.state import State
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    create_time REAL NOT NULL,
+    update_time REAL NOT NULL,
+    num_events INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (app_name, user_id, session_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS events (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    event TEXT NOT NULL,
+    PRIMARY KEY (app_name, user_id, session_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS session_state (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (app_name, user_id, session_id, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_state (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (app_name, user_id, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS app_state (
+    app_name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (app_name, key)
+) WITHOUT ROWID;
+"""
+
+# How long a statement blocks the event loop waiting for another process's
+# transaction before it gives the loop back and tries again
+_INLINE_BUSY_TIMEOUT_MS = 5
+_MAX_RETRY_DELAY_S = 0.05
+
+
+def _is_busy(error: sqlite3.OperationalError) -> bool:
+    code = getattr(error, "sqlite_errorcode", None)
+    return code is not None and code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+
+def _split_state(state: dict[str, Any]) -> tuple[dict, dict, dict]:
+    """Splits a state (delta) into its session, user: and app: keys. temp: keys are dropped."""
+    session_state, user_state, app_state = {}, {}, {}
+    for key, value in state.items():
+        if key.startswith(State.TEMP_PREFIX):
+            continue
+        if key.startswith(State.APP_PREFIX):
+            app_state[key.removeprefix(State.APP_PREFIX)] = value
+        elif key.startswith(State.USER_PREFIX):
+            user_state[key.removeprefix(State.USER_PREFIX)] = value
+        else:
+            session_state[key] = value
+    return session_state, user_state, app_state
+
+
+class SqliteSessionService(BaseSessionService):
+    """A session service that keeps sessions in a SQLite database, for use across processes.
+
+    A drop-in replacement for `InMemorySessionService`: sessions survive
+    restarts and several worker processes can share one database file on the
+    same machine. The database runs in WAL mode, so readers never wait for the
+    writer. Every table is keyed by (app_name, user_id, session_id):
+
+    - Appending an event inserts one row and updates only the state keys the
+      event changed, so the session is never rewritten however long it grows.
+    - Events are numbered inside an immediate transaction, so writers in
+      different processes appending to the same session never lose events;
+      concurrent state changes of the same key keep the last write.
+    - `get_session` loads only the last `num_recent_events` events (or those
+      after `after_timestamp`) when asked, and `max_loaded_events` applies such
+      a limit to every load, so long sessions are cheap to resume.
+
+    As with `InMemorySessionService`, creating a session with the id of an
+    existing one replaces it, unless `create_session` is given `replace=False`;
+    call `get_session` first to resume a session.
+
+    Args:
+        db_path: Path of the SQLite database file.
+        max_loaded_events: Default number of most recent events loaded by
+                           `get_session`, or None to load all of them.
+        busy_timeout_ms: How long a statement waits for another process's transaction
+                         before failing. The wait does not block the event loop.
+
+    Examples:
+        session_service = SqliteSessionService("sessions.sqlite3")
+        runner = Runner(app_name=AGENT_APP_NAME, agent=agent, session_service=session_service)
+    """
+
+    def __init__(self, db_path: str, max_loaded_events: Optional[int] = None, busy_timeout_ms: int = 5000):
+        self.db_path = db_path
+        self.max_loaded_events = max_loaded_events
+        self.busy_timeout_ms = busy_timeout_ms
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        # From now on statements run on the event loop, see _run
+        self._db.execute(f"PRAGMA busy_timeout={_INLINE_BUSY_TIMEOUT_MS}")
+        self._lock = threading.Lock()
+
+    async def _run(self, function, *args):
+        # Statements take a fraction of a millisecond, less than handing them to a
+        # worker thread and back costs on a busy event loop, so they run inline.
+        # When another process holds the database, SQLite gives up after a few
+        # milliseconds and the statement is retried after an async backoff, so the
+        # wait (bounded by busy_timeout_ms) never stalls the other queries.
+        # Retrying is safe: a write that fails is rolled back (see _write).
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + self.busy_timeout_ms / 1000
+        delay_s = 0.001
+        while True:
+            try:
+                with self._lock:
+                    return function(*args)
+            except sqlite3.OperationalError as e:
+                if not _is_busy(e) or loop.time() >= give_up_at:
+                    raise
+            await asyncio.sleep(min(delay_s, max(0.0, give_up_at - loop.time())))
+            delay_s = min(delay_s * 2, _MAX_RETRY_DELAY_S)
+
+    def _write(self, function, *args):
+        """Runs a function in an immediate transaction, which takes the write lock up front."""
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            result = function(*args)
+            self._db.execute("COMMIT")
+        except BaseException:
+            # A failed COMMIT (e.g. busy) leaves the transaction open, and _run may
+            # retry. SQLite may already have rolled it back, and ROLLBACK can fail
+            # too; the original error is the one worth raising.
+            if self._db.in_transaction:
+                with contextlib.suppress(sqlite3.Error):
+                    self._db.execute("ROLLBACK")
+            raise
+        return result
+
+    def close(self) -> None:
+        """Closes the database connection."""
+        with self._lock:
+            self._db.close()
+
+    # Creating sessions
+
+    async def create_session(self, *, app_name: str, user_id: str, state: Optional[dict[str, Any]] = None,
+                             session_id: Optional[str] = None, replace: bool = True) -> Session:
+        """Creates a session.
+
+        Args:
+            replace: Whether the session replaces an existing one with the same id.
+                     If False, `ValueError` is raised instead. The check and the
+                     creation are one transaction, so of several processes creating
+                     the same session at once, exactly one succeeds.
+        """
+        session_id = session_id.strip() if session_id and session_id.strip() else str(uuid.uuid4())
+        await self._run(self._write, self._create, app_name, user_id, session_id, state or {}, replace)
+        return await self.get_session(app_name=app_name, user_id=user_id, session_id=session_id)
+
+    def _create(self, app_name: str, user_id: str, session_id: str, state: dict[str, Any], replace: bool) -> None:
+        now = time.time()
+        key = (app_name, user_id, session_id)
+        if not replace and self._db.execute("SELECT 1 FROM sessions WHERE app_name = ? AND user_id = ? "
+                                            "AND session_id = ?", key).fetchone():
+            raise ValueError(f"Session already exists: {session_id}")
+        self._delete(*key)
+        self._db.execute("INSERT INTO sessions (app_name, user_id, session_id, create_time, update_time) "
+                         "VALUES (?, ?, ?, ?, ?)", (*key, now, now))
+        self._update_state(app_name, user_id, session_id, state)
+
+    def _update_state(self, app_name: str, user_id: str, session_id: str, state: dict[str, Any]) -> None:
+        session_state, user_state, app_state = _split_state(state)
+        if session_state:
+            self._db.executemany("INSERT OR REPLACE INTO session_state (app_name, user_id, session_id, key, value) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 [(app_name, user_id, session_id, key, json.dumps(value, default=str))
+                                  for key, value in session_state.items()])
+        if user_state:
+            self._db.executemany("INSERT OR REPLACE INTO user_state (app_name, user_id, key, value) VALUES (?, ?, ?, ?)",
+                                 [(app_name, user_id, key, json.dumps(value, default=str)) for key, value in user_state.items()])
+        if app_state:
+            self._db.executemany("INSERT OR REPLACE INTO app_state (app_name, key, value) VALUES (?, ?, ?)",
+                                 [(app_name, key, json.dumps(value, default=str)) for key, value in app_state.items()])
+
+    # Reading sessions
+
+    async def get_session(self, *, app_name: str, user_id: str, session_id: str,
+                          config: Optional[GetSessionConfig] = None) -> Optional[Session]:
+        num_recent_events = config.num_recent_events if config and config.num_recent_events else self.max_loaded_events
+        after_timestamp = config.after_timestamp if config else None
+        return await self._run(self._get, app_name, user_id, session_id, num_recent_events, after_timestamp)
+
+    def _get(self, app_name: str, user_id: str, session_id: str, num_recent_events: Optional[int],
+             after_timestamp: Optional[float]) -> Optional[Session]:
+        key = (app_name, user_id, session_id)
+        row = self._db.execute("SELECT update_time FROM sessions WHERE app_name = ? AND user_id = ? AND session_id = ?",
+                               key).fetchone()
+        if row is None:
+            return None
+
+        query = "SELECT event FROM events WHERE app_name = ? AND user_id = ? AND session_id = ?"
+        params: list = list(key)
+        if after_timestamp:
+            query += " AND timestamp >= ?"
+            params.append(after_timestamp)
+        # The newest events are read backwards along the primary key, so only they are loaded
+        query += " ORDER BY seq DESC"
+        if num_recent_events:
+            query += " LIMIT ?"
+            params.append(num_recent_events)
+        events = [Event.model_validate_json(data) for (data,) in self._db.execute(query, params).fetchall()]
+        events.reverse()
+
+        state = {name: json.loads(value) for name, value in self._db.execute(
+            "SELECT key, value FROM session_state WHERE app_name = ? AND user_id = ? AND session_id = ?", key)}
+        for name, value in self._db.execute("SELECT key, value FROM app_state WHERE app_name = ?", (app_name,)):
+            state[State.APP_PREFIX + name] = json.loads(value)
+        for name, value in self._db.execute("SELECT key, value FROM user_state WHERE app_name = ? AND user_id = ?",
+                                            (app_name, user_id)):
+            state[State.USER_PREFIX + name] = json.loads(value)
+
+        return Session(app_name=app_name, user_id=user_id, id=session_id, state=state, events=events,
+                       last_update_time=row[0])
+
+    async def list_sessions(self, *, app_name: str, user_id: str) -> ListSessionsResponse:
+        rows = await self._run(lambda: self._db.execute(
+            "SELECT session_id, update_time FROM sessions WHERE app_name = ? AND user_id = ?",
+            (app_name, user_id)).fetchall())
+        return ListSessionsResponse(sessions=[
+            Session(app_name=app_name, user_id=user_id, id=session_id, last_update_time=update_time)
+            for session_id, update_time in rows])
+
+    # Deleting sessions
+
+    async def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        await self._run(self._write, self._delete, app_name, user_id, session_id)
+
+    def _delete(self, app_name: str, user_id: str, session_id: str) -> None:
+        key = (app_name, user_id, session_id)
+        for table in ("events", "session_state", "sessions"):
+            self._db.execute(f"DELETE FROM {table} WHERE app_name = ? AND user_id = ? AND session_id = ?", key)
+
+    # Appending events
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        if event.partial:
+            return event
+        # Updates the session object the runner holds, as the in-memory service does
+        await super().append_event(session=session, event=event)
+        session.last_update_time = event.timestamp
+        data = event.model_dump_json(exclude_none=True)
+        await self._run(self._write, self._append, session, event, data)
+        return event
+
+    def _append(self, session: Session, event: Event, data: str) -> None:
+        key = (session.app_name, session.user_id, session.id)
+        row = self._db.execute("SELECT num_events FROM sessions WHERE app_name = ? AND user_id = ? AND session_id = ?",
+                               key).fetchone()
+        if row is None:
+            raise ValueError(f"Session not found: {session.id}")
+        seq = row[0] + 1
+        self._db.execute("INSERT INTO events (app_name, user_id, session_id, seq, timestamp, event) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (*key, seq, event.timestamp, data))
+        self._db.execute("UPDATE sessions SET num_events = ?, update_time = ? "
+                         "WHERE app_name = ? AND user_id = ? AND session_id = ?", (seq, event.timestamp, *key))
+        if event.actions and event.actions.state_delta:
+            self._update_state(*key, event.actions.state_delta)
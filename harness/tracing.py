@@ -0,0 +1,490 @@
+import json
+import time
+import uuid
+import itertools
+import threading
+import contextvars
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+from google.adk.agents import BaseAgent, LlmAgent
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+
+from agent_grammar.batching import current_batch_size
+from harness.agent_tree import installed, iter_agents, prepend_callback, record_installed
+
+# Span kinds
+AGENT = "agent"
+LLM = "llm"
+TOOL = "tool"
+TOOL_LLM = "tool_llm"
+
+# The tool span of the tool running in the current task. Tool calls run from
+# their before to their after callback inside one step of the agent, so
+# (unlike agent turns, see Tracer) they can be found through a context variable.
+_current_tool_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_tool_span",
+                                                                                     default=None)
+
+
+@dataclass
+class Span:
+    """One timed stage of a query.
+
+    Times are `time.perf_counter_ns()` values, so durations are monotonic and
+    precise, but only comparable within one process.
+
+    Attributes:
+        name: e.g. "agent_grammar", "llm agent_grammar" or "tool check_grammar".
+        kind: "agent" (agent turn), "llm" (model call), "tool" (tool call) or
+              "tool_llm" (model call made inside a tool).
+        trace_id: The invocation id of the query the span belongs to.
+        span_id: Unique id of the span.
+        parent_id: The span this one is nested in, or None for the root.
+        start_ns: Start time (perf_counter_ns).
+        end_ns: End time (perf_counter_ns), or None while the span is open.
+        branch: The agent branch, e.g. "grammar_and_math.agent_math" inside a ParallelAgent.
+        status: "ok", "error", or "incomplete" if the span was never ended normally.
+        attributes: Details such as the model, token counts or the function call id.
+    """
+    name: str
+    kind: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int
+    end_ns: Optional[int] = None
+    branch: Optional[str] = None
+    status: str = "ok"
+    attributes: dict = field(default_factory=dict)
+
+    @property
+    def duration_ms(self) -> float:
+        return round(((self.end_ns or self.start_ns) - self.start_ns) / 1e6, 3)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": self.duration_ms,
+            "branch": self.branch,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+def _usage(usage_metadata) -> dict:
+    if usage_metadata is None:
+        return {}
+    usage = {"input_tokens": usage_metadata.prompt_token_count or 0,
+             "output_tokens": usage_metadata.candidates_token_count or 0}
+    if usage_metadata.cached_content_token_count:
+        usage["cached_tokens"] = usage_metadata.cached_content_token_count
+    return usage
+
+
+class Tracer:
+    """Collects nested spans for agent turns, model calls and tool calls.
+
+    Install it on an agent tree with `instrument`. Agent spans nest like the
+    agents do, model and tool spans nest in the agent turn that made them, and
+    the Gemini call inside `check_grammar` nests in its tool span.
+
+    Agents run as async generators, and ParallelAgent advances each of its
+    sub-agents in a new task for every event, so a context variable set when an
+    agent starts is gone by the time it ends. Open agent and model spans are
+    therefore kept per (invocation, branch, agent) instead.
+
+    Args:
+        max_spans: Maximum number of finished spans kept; the oldest are dropped.
+    """
+
+    def __init__(self, max_spans: int = 100_000):
+        self.spans: deque[Span] = deque(maxlen=max_spans)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # Open agent spans keyed by (invocation id, branch, agent name)
+        self._agents: dict[tuple, Span] = {}
+        # Open model spans keyed by the key of their agent span
+        self._llm_calls: dict[tuple, Span] = {}
+        # Open tool spans keyed by function call id
+        self._tools: dict[str, Span] = {}
+        # Converts perf_counter_ns to Unix time for exporters that need wall-clock times
+        self.epoch_offset_ns = time.time_ns() - time.perf_counter_ns()
+
+    def start(self, name: str, kind: str, parent: Optional[Span] = None, trace_id: Optional[str] = None,
+              branch: Optional[str] = None, **attributes) -> Span:
+        """Starts a span, nested in `parent` if given."""
+        return Span(name=name, kind=kind,
+                    trace_id=parent.trace_id if parent else (trace_id or uuid.uuid4().hex),
+                    span_id=f"{next(self._ids):016x}",
+                    parent_id=parent.span_id if parent else None,
+                    start_ns=time.perf_counter_ns(),
+                    branch=branch if branch is not None else (parent.branch if parent else None),
+                    attributes=attributes)
+
+    def end(self, span: Span, status: str = "ok", **attributes) -> None:
+        """Ends a span and keeps it with the finished spans."""
+        if span.end_ns is not None:
+            return
+        span.end_ns = time.perf_counter_ns()
+        span.status = status
+        span.attributes.update(attributes)
+        with self._lock:
+            self.spans.append(span)
+
+    def clear(self) -> None:
+        """Removes all finished and open spans."""
+        with self._lock:
+            self.spans.clear()
+        self._agents.clear()
+        self._llm_calls.clear()
+        self._tools.clear()
+
+    def traces(self) -> dict[str, list[Span]]:
+        """Returns the finished spans grouped by trace, each sorted by start time."""
+        with self._lock:
+            spans = list(self.spans)
+        traces: dict[str, list[Span]] = {}
+        for span in sorted(spans, key=lambda span: span.start_ns):
+            traces.setdefault(span.trace_id, []).append(span)
+        return traces
+
+    # Agent turns
+
+    def _agent_key(self, callback_context: CallbackContext) -> tuple:
+        ctx = callback_context._invocation_context
+        return ctx.invocation_id, ctx.branch, ctx.agent.name
+
+    def _parent_agent_span(self, callback_context: CallbackContext) -> Optional[Span]:
+        """Finds the open span of the parent agent, whose branch is a prefix of this agent's branch."""
+        ctx = callback_context._invocation_context
+        parent = ctx.agent.parent_agent
+        if parent is None:
+            return None
+        branch = ctx.branch
+        while True:
+            span = self._agents.get((ctx.invocation_id, branch, parent.name))
+            if span is not None or branch is None:
+                return span
+            branch = branch.rpartition(".")[0] or None
+
+    def before_agent(self, callback_context: CallbackContext) -> None:
+        ctx = callback_context._invocation_context
+        parent = self._parent_agent_span(callback_context)
+        self._agents[self._agent_key(callback_context)] = self.start(
+            ctx.agent.name, AGENT, parent, trace_id=ctx.invocation_id, branch=ctx.branch,
+            agent=ctx.agent.name, session_id=ctx.session.id)
+        return None
+
+    def after_agent(self, callback_context: CallbackContext) -> None:
+        key = self._agent_key(callback_context)
+        span = self._agents.pop(key, None)
+        if span is None:
+            return None
+        if span.parent_id is None:
+            # The query is over: close whatever an error or an early return left open
+            self._end_invocation(key[0])
+        self.end(span)
+        return None
+
+    def _end_invocation(self, invocation_id: str) -> None:
+        for spans in (self._agents, self._llm_calls):
+            for key in [key for key in spans if key[0] == invocation_id]:
+                self.end(spans.pop(key), status="incomplete")
+        for call_id in [call_id for call_id, span in self._tools.items() if span.trace_id == invocation_id]:
+            self.end(self._tools.pop(call_id), status="incomplete")
+
+    def end_session(self, session_id: str) -> None:
+        """Ends the spans that the queries of a session left open.
+
+        A query that is cancelled, or cut short by its deadline, never reaches
+        the after callbacks of its agents, so its open spans are ended here,
+        as "incomplete", instead of being kept forever.
+        """
+        invocation_ids = {key[0] for key, span in self._agents.items()
+                          if span.attributes.get("session_id") == session_id}
+        for invocation_id in invocation_ids:
+            self._end_invocation(invocation_id)
+
+    # Model calls
+
+    def before_model(self, callback_context: CallbackContext, llm_request: LlmRequest) -> None:
+        key = self._agent_key(callback_context)
+        parent = self._agents.get(key)
+        self._llm_calls[key] = self.start(f"llm {key[2]}", LLM, parent, trace_id=key[0], branch=key[1],
+                                          model=llm_request.model, agent=key[2])
+        return None
+
+    def after_model(self, callback_context: CallbackContext, llm_response: LlmResponse) -> None:
+        key = self._agent_key(callback_context)
+        span = self._llm_calls.get(key)
+        if span is None:
+            return None
+        if llm_response.partial:
+            # Streaming: the first chunk marks the time to first token
+            span.attributes.setdefault("first_token_ms", round((time.perf_counter_ns() - span.start_ns) / 1e6, 3))
+            return None
+        del self._llm_calls[key]
+        self.end(span, status="error" if llm_response.error_code else "ok", **_usage(llm_response.usage_metadata))
+        return None
+
+    # Tool calls
+
+    def before_tool(self, tool, args: dict, tool_context) -> None:
+        ctx = tool_context._invocation_context
+        parent = self._agents.get((ctx.invocation_id, ctx.branch, ctx.agent.name))
+        span = self.start(f"tool {tool.name}", TOOL, parent, trace_id=ctx.invocation_id, branch=ctx.branch,
+                          tool=tool.name, agent=ctx.agent.name, function_call_id=tool_context.function_call_id)
+        self._tools[tool_context.function_call_id] = span
+        _current_tool_span.set(span)
+        return None
+
+    def after_tool(self, tool, args: dict, tool_context, tool_response) -> None:
+        span = self._tools.pop(tool_context.function_call_id, None)
+        _current_tool_span.set(None)
+        if span is not None:
+            failed = isinstance(tool_response, dict) and "error" in tool_response
+            self.end(span, status="error" if failed else "ok")
+        return None
+
+
+def _batch_attributes() -> dict:
+    batch_size = current_batch_size.get()
+    return {"batched": True, "batch_size": batch_size} if batch_size is not None else {}
+
+
+class _TracedModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, *, model, contents, config=None):
+        tracer = self._client.tracer
+        span = tracer.start(f"tool_llm {model}", TOOL_LLM, _current_tool_span.get(), model=model,
+                            **_batch_attributes())
+        try:
+            response = self._client.inner.models.generate_content(model=model, contents=contents, config=config)
+        except Exception:
+            tracer.end(span, status="error")
+            raise
+        tracer.end(span, **_usage(getattr(response, "usage_metadata", None)))
+        return response
+
+
+class _TracedAsyncModels:
+
+    def __init__(self, client):
+        self._client = client
+
+    async def generate_content(self, *, model, contents, config=None):
+        tracer = self._client.tracer
+        span = tracer.start(f"tool_llm {model}", TOOL_LLM, _current_tool_span.get(), model=model,
+                            **_batch_attributes())
+        try:
+            response = await self._client.inner.aio.models.generate_content(model=model, contents=contents,
+                                                                            config=config)
+        except BaseException:
+            # Cancellation (e.g. the check_grammar timeout) ends the span too
+            tracer.end(span, status="error")
+            raise
+        tracer.end(span, **_usage(getattr(response, "usage_metadata", None)))
+        return response
+
+
+class _TracedAio:
+
+    def __init__(self, client):
+        self.models = _TracedAsyncModels(client)
+
+
+class TracedGenaiClient:
+    """Times the `generate_content` calls a tool makes through a genai client.
+
+    Calls made while a tool runs are nested in its span. Batched grammar checks
+    (`GRAMMAR_BATCH_WINDOW_MS`) are sent from the batcher's own task on behalf
+    of several tool calls, so they become root spans of a trace of their own.
+
+    Args:
+        tracer: The tracer to record into.
+        inner: The client that serves the calls.
+    """
+
+    def __init__(self, tracer: Tracer, inner):
+        self.tracer = tracer
+        self.inner = inner
+        self.models = _TracedModels(self)
+        self.aio = _TracedAio(self)
+
+
+def instrument(agent: BaseAgent, tracer: Tracer, trace_tools: bool = True) -> None:
+    """Records spans for every agent turn, model call and tool call of an agent tree.
+
+    The tracer's callbacks are put first in the callback lists of every agent
+    (the existing callbacks keep working), so instrumenting twice is harmless.
+
+    Args:
+        agent: The root of the agent tree.
+        tracer: The tracer to record into.
+        trace_tools: Whether to also time the Gemini calls made inside `check_grammar`.
+
+    Examples:
+        tracer = Tracer()
+        instrument(agent_teaching_assistant, tracer)
+        ...
+        export_chrome_trace(tracer, "trace.json")
+    """
+    for node in iter_agents(agent):
+        node.before_agent_callback = prepend_callback(node.before_agent_callback, tracer.before_agent)
+        node.after_agent_callback = prepend_callback(node.after_agent_callback, tracer.after_agent)
+        if isinstance(node, LlmAgent):
+            node.before_model_callback = prepend_callback(node.before_model_callback, tracer.before_model)
+            node.after_model_callback = prepend_callback(node.after_model_callback, tracer.after_model)
+            node.before_tool_callback = prepend_callback(node.before_tool_callback, tracer.before_tool)
+            node.after_tool_callback = prepend_callback(node.after_tool_callback, tracer.after_tool)
+    # Found by end_open_spans
+    record_installed(agent, tracer)
+
+    if trace_tools:
+        from agent_grammar import agent as grammar_module
+
+        inner_factory = grammar_module.set_client_factory(None)
+        if getattr(inner_factory, "tracer", None) is tracer:
+            # Already traced by this tracer
+            grammar_module.set_client_factory(inner_factory)
+            return
+
+        def traced_factory():
+            return TracedGenaiClient(tracer, inner_factory())
+
+        traced_factory.tracer = tracer
+        grammar_module.set_client_factory(traced_factory)
+
+
+def end_open_spans(agent: BaseAgent, session_id: str) -> None:
+    """Ends the open spans of a session in every tracer instrumenting an agent tree (see `Tracer.end_session`)."""
+    for tracer in installed(agent, Tracer):
+        tracer.end_session(session_id)
+
+
+def format_trace(spans: Iterable[Span]) -> str:
+    """Formats the spans of one trace as an indented tree with start offsets and durations.
+
+    Examples:
+        for trace_id, spans in tracer.traces().items():
+            print(format_trace(spans))
+    """
+    spans = sorted(spans, key=lambda span: span.start_ns)
+    if not spans:
+        return ""
+    origin = spans[0].start_ns
+    ids = {span.span_id for span in spans}
+    children: dict[Optional[str], list[Span]] = {}
+    for span in spans:
+        children.setdefault(span.parent_id if span.parent_id in ids else None, []).append(span)
+
+    lines = []
+
+    def add(span: Span, depth: int) -> None:
+        details = " ".join(f"{key}={value}" for key, value in span.attributes.items()
+                           if key in ("model", "input_tokens", "output_tokens", "first_token_ms"))
+        status = "" if span.status == "ok" else f" [{span.status}]"
+        lines.append(f"{'  ' * depth}{span.name}: +{(span.start_ns - origin) / 1e6:.1f} ms, "
+                     f"{span.duration_ms:.1f} ms{status}{' ' + details if details else ''}")
+        for child in children.get(span.span_id, []):
+            add(child, depth + 1)
+
+    for root in children.get(None, []):
+        add(root, 0)
+    return "\n".join(lines)
+
+
+def export_jsonl(tracer: Tracer, path: str) -> int:
+    """Writes every finished span as one JSON object per line. Returns the number of spans."""
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for spans in tracer.traces().values():
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), separators=(",", ":"), default=str) + "\n")
+                count += 1
+    return count
+
+
+def export_chrome_trace(tracer: Tracer, path: str) -> int:
+    """Writes the finished spans in the Chrome trace event format.
+
+    Open the file in chrome://tracing or https://ui.perfetto.dev. Each query is
+    a process and each agent branch a thread, so the stages of a query nest and
+    the branches of a ParallelAgent appear side by side.
+
+    Returns:
+        The number of spans written.
+    """
+    events = []
+    count = 0
+    for pid, (trace_id, spans) in enumerate(tracer.traces().items(), start=1):
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"query {trace_id}"}})
+        threads: dict[Optional[str], int] = {}
+        for span in spans:
+            if span.branch not in threads:
+                threads[span.branch] = len(threads) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": threads[span.branch],
+                               "args": {"name": span.branch or "main"}})
+            events.append({
+                "name": span.name,
+                "cat": span.kind,
+                "ph": "X",
+                "ts": span.start_ns / 1000,
+                "dur": ((span.end_ns or span.start_ns) - span.start_ns) / 1000,
+                "pid": pid,
+                "tid": threads[span.branch],
+                "args": {"status": span.status, **span.attributes},
+            })
+            count += 1
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+    return count
+
+
+def export_otel(tracer: Tracer, tracer_provider=None) -> int:
+    """Sends the finished spans to OpenTelemetry, keeping their nesting and timings.
+
+    The spans are re-created with their recorded start and end times through the
+    OpenTelemetry API, so they go to whatever exporter the provider has, e.g.
+    Cloud Trace or an OTLP collector. Without a configured SDK provider, the API
+    discards them.
+
+    Args:
+        tracer: The tracer whose spans to send.
+        tracer_provider: The provider to use. Defaults to the global provider.
+
+    Returns:
+        The number of spans sent.
+    """
+    from opentelemetry import trace
+
+    otel_tracer = trace.get_tracer("harness.tracing", tracer_provider=tracer_provider)
+    count = 0
+    for spans in tracer.traces().values():
+        otel_spans = {}
+        # Sorted by start time, so a parent is always created before its children
+        for span in spans:
+            parent = otel_spans.get(span.parent_id)
+            context = trace.set_span_in_context(parent) if parent is not None else None
+            attributes = {key: value if isinstance(value, (str, bool, int, float)) else str(value)
+                          for key, value in span.attributes.items() if value is not None}
+            otel_span = otel_tracer.start_span(span.name, context=context,
+                                               start_time=span.start_ns + tracer.epoch_offset_ns,
+                                               attributes={"kind": span.kind, "status": span.status,
+                                                           "trace_id": span.trace_id, **attributes})
+            otel_span.end(end_time=(span.end_ns or span.start_ns) + tracer.epoch_offset_ns)
+            otel_spans[span.span_id] = otel_span
+            count += 1
+    return count
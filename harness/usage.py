@@ -0,0 +1,193 @@
+import os
+import json
+from typing import Iterable, Optional, Union
+
+from harness.tracing import LLM, TOOL_LLM, Span, Tracer
+
+# Prices in USD per million (input, output) tokens, matched on the longest model
+# name prefix. Override or extend them with MODEL_PRICES in the .env file, e.g.
+# MODEL_PRICES={"gemini-2.0-flash": [0.10, 0.40]}. Models without a price cost nothing.
+DEFAULT_PRICES: dict[str, tuple[float, float]] = {
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-2.0-flash-lite": (0.075, 0.30),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.5-pro": (1.25, 10.00),
+}
+
+
+def parse_prices(value: str) -> dict[str, tuple[float, float]]:
+    """Parses MODEL_PRICES: a JSON object of model name prefixes to [input, output] prices.
+
+    Raises:
+        ValueError: If the value is not such an object, naming the entry at fault.
+    """
+    example = 'e.g. MODEL_PRICES={"gemini-2.0-flash": [0.10, 0.40]}'
+    try:
+        prices = json.loads(value)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"MODEL_PRICES is not valid JSON ({e}), {example}") from None
+    if not isinstance(prices, dict):
+        raise ValueError(f"MODEL_PRICES must be a JSON object, {example}")
+    parsed = {}
+    for model, model_price in prices.items():
+        if (not isinstance(model_price, list) or len(model_price) != 2
+                or not all(isinstance(part, (int, float)) and not isinstance(part, bool) for part in model_price)):
+            raise ValueError(f"MODEL_PRICES[{model!r}] must be [input, output] prices per million tokens, "
+                             f"got {model_price!r}")
+        parsed[model] = (float(model_price[0]), float(model_price[1]))
+    return parsed
+
+
+PRICES = {**DEFAULT_PRICES, **parse_prices(os.getenv("MODEL_PRICES") or "{}")}
+
+# Groupings of the usage report
+BY_AGENT = "agent"
+BY_MODEL = "model"
+BY_TOOL = "tool"
+
+
+def price(model: Optional[str]) -> tuple[float, float]:
+    """Returns the (input, output) price per million tokens of a model, (0, 0) if unknown."""
+    if not model:
+        return 0.0, 0.0
+    matches = [prefix for prefix in PRICES if model.startswith(prefix)]
+    return PRICES[max(matches, key=len)] if matches else (0.0, 0.0)
+
+
+def estimate_cost(model: Optional[str], input_tokens: int, output_tokens: int) -> float:
+    """Estimates the cost of a model call in USD."""
+    input_price, output_price = price(model)
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def usage_records(spans: Iterable[Span]) -> list[dict]:
+    """Extracts one usage record per model call from the spans of a `Tracer`.
+
+    Model calls made by an agent are attributed to that agent with no tool. The
+    Gemini calls made inside a tool (e.g. `check_grammar`) are attributed to the
+    tool and to the agent that called it. Batched grammar checks are sent on
+    behalf of several tool calls, so they have no agent and their tool is
+    "(batched)"; a tool call whose tool span is missing is "(unknown)".
+
+    Returns:
+        A list of dictionaries with "trace_id", "agent", "model", "tool",
+        "input_tokens", "output_tokens", "cached_tokens", "duration_ms" and "cost_usd".
+    """
+    spans = list(spans)
+    by_id = {span.span_id: span for span in spans}
+    records = []
+    for span in spans:
+        if span.kind not in (LLM, TOOL_LLM):
+            continue
+        agent, tool = span.attributes.get("agent"), None
+        if span.kind == TOOL_LLM:
+            parent = by_id.get(span.parent_id)
+            agent = parent.attributes.get("agent") if parent else None
+            if parent is not None:
+                tool = parent.attributes.get("tool")
+            else:
+                # A batched check has no tool span; any other orphan lost its parent (e.g. evicted)
+                tool = "(batched)" if span.attributes.get("batched") else "(unknown)"
+        model = span.attributes.get("model")
+        input_tokens = span.attributes.get("input_tokens", 0)
+        output_tokens = span.attributes.get("output_tokens", 0)
+        records.append({
+            "trace_id": span.trace_id,
+            "agent": agent,
+            "model": model,
+            "tool": tool,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cached_tokens": span.attributes.get("cached_tokens", 0),
+            "duration_ms": span.duration_ms,
+            "cost_usd": estimate_cost(model, input_tokens, output_tokens),
+        })
+    return records
+
+
+def _summarize(records: list[dict]) -> dict:
+    input_tokens = sum(record["input_tokens"] for record in records)
+    output_tokens = sum(record["output_tokens"] for record in records)
+    duration_s = sum(record["duration_ms"] for record in records) / 1000
+    return {
+        "calls": len(records),
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cached_tokens": sum(record["cached_tokens"] for record in records),
+        "total_tokens": input_tokens + output_tokens,
+        "cost_usd": round(sum(record["cost_usd"] for record in records), 8),
+        # Generation speed while the models were busy
+        "output_tokens_per_s": round(output_tokens / duration_s, 1) if duration_s else 0.0,
+    }
+
+
+def aggregate(records: list[dict], by: str) -> dict[str, dict]:
+    """Sums usage records by "agent", "model" or "tool", biggest total first.
+
+    Calls without a tool are grouped under "(none)" when grouping by tool.
+    """
+    groups: dict[str, list[dict]] = {}
+    for record in records:
+        groups.setdefault(record[by] or "(none)", []).append(record)
+    summaries = {key: _summarize(group) for key, group in groups.items()}
+    return dict(sorted(summaries.items(), key=lambda item: -item[1]["total_tokens"]))
+
+
+def usage_report(source: Union[Tracer, Iterable[Span]], per_query: bool = False) -> dict:
+    """Builds a token and cost report for one query or a batch of queries.
+
+    Args:
+        source: A `Tracer` (for all the queries it traced) or the spans of one trace.
+        per_query: Whether to add the totals of every query (trace) of the batch.
+
+    Returns:
+        A dictionary with the "total" usage, its breakdown "by_agent", "by_model"
+        and "by_tool", and, with `per_query`, the totals keyed by trace id in "queries".
+
+    Examples:
+        tracer = Tracer()
+        instrument(agent_teaching_assistant, tracer)
+        ...
+        print(json.dumps(usage_report(tracer), indent=2))
+    """
+    spans = [span for spans in source.traces().values() for span in spans] if isinstance(source, Tracer) else list(source)
+    records = usage_records(spans)
+    queries = {record["trace_id"] for record in records}
+    report = {
+        "queries": len(queries),
+        "total": _summarize(records),
+        "by_agent": aggregate(records, BY_AGENT),
+        "by_model": aggregate(records, BY_MODEL),
+        "by_tool": aggregate(records, BY_TOOL),
+    }
+    if queries:
+        report["cost_usd_per_query"] = round(report["total"]["cost_usd"] / len(queries), 8)
+        report["tokens_per_query"] = round(report["total"]["total_tokens"] / len(queries), 1)
+    if per_query:
+        by_trace: dict[str, list[dict]] = {}
+        for record in records:
+            by_trace.setdefault(record["trace_id"], []).append(record)
+        report["per_query"] = {trace_id: _summarize(trace_records) for trace_id, trace_records in by_trace.items()}
+    return report
+
+
+def format_usage_report(report: dict) -> str:
+    """Formats a usage report as tables of tokens, cost and speed by agent, model and tool."""
+    lines = []
+    header = f"{'':<28}{'calls':>7}{'input':>10}{'output':>9}{'cost USD':>12}{'out tok/s':>11}"
+    for title, key in (("Agent", "by_agent"), ("Model", "by_model"), ("Tool", "by_tool")):
+        lines.append(f"{title:<28}" + header[28:])
+        for name, row in report[key].items():
+            lines.append(f"  {name[:26]:<26}{row['calls']:>7}{row['input_tokens']:>10}{row['output_tokens']:>9}"
+                         f"{row['cost_usd']:>12.6f}{row['output_tokens_per_s']:>11}")
+    total = report["total"]
+    lines.append(f"{'Total':<28}{total['calls']:>7}{total['input_tokens']:>10}{total['output_tokens']:>9}"
+                 f"{total['cost_usd']:>12.6f}{total['output_tokens_per_s']:>11}")
+    return "\n".join(lines)
+
+
+def export_usage_report(report: dict, path: str) -> None:
+    """Writes a usage report as JSON."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)